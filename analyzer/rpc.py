@@ -1,10 +1,42 @@
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
+from typing import Optional
+import asyncio
+import hashlib
+import os
+import re
+import shutil
+import signal
 import subprocess
-import shlex
+import time
 import traceback
 app = FastAPI()
 
+# Сколько анализов gigahorse выполняется одновременно, остальные ждут в очереди
+ANALYZER_WORKERS = int(os.environ.get('ANALYZER_WORKERS', str(os.cpu_count() or 1)))
+# Ограничение времени одного анализа (без ожидания в очереди)
+ANALYZER_JOB_TIMEOUT = float(os.environ.get('ANALYZER_JOB_TIMEOUT', '3000'))
+# Сколько секунд хранить результаты завершённых задач
+ANALYZER_JOB_TTL = float(os.environ.get('ANALYZER_JOB_TTL', '3600'))
+# Максимальное время long-poll ожидания в GET /jobs/{job_id}
+ANALYZER_MAX_WAIT = float(os.environ.get('ANALYZER_MAX_WAIT', '60'))
+ANALYZER_JOBS_DIR = os.environ.get('ANALYZER_JOBS_DIR', '/app/jobs')
+GIGAHORSE_PATH = "/opt/gigahorse/gigahorse-toolchain/gigahorse.py"
+VISUALIZE_PATH = "/opt/gigahorse/gigahorse-toolchain/clients/visualizeout.py"
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_TIMEOUT = "timeout"
+JOB_CANCELLED = "cancelled"
+# Задачи, к которым присоединяются повторные запросы с тем же байткодом
+JOB_REUSABLE = {JOB_QUEUED, JOB_RUNNING, JOB_DONE}
+
+HEX_RE = re.compile(r"[0-9a-f]*")
+# Сколько последних символов stderr сохранять в ошибке
+STDERR_TAIL = 2000
+
 
 class RunRequest(BaseModel):
     cmd: str
@@ -14,8 +46,206 @@ class RunResponse(BaseModel):
     stdout: str
     stderr: str
 
+class JobRequest(BaseModel):
+    bytecode: str
+    timeout: Optional[float] = None
+
+class JobResponse(BaseModel):
+    job_id: str
+    status: str
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    queued_for: Optional[float] = None
+    duration: Optional[float] = None
+
+
+class JobError(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, job_id: str, bytecode: str, timeout: float):
+        self.id = job_id
+        self.bytecode = bytecode
+        self.timeout = timeout
+        self.status = JOB_QUEUED
+        self.result = None
+        self.error = None
+        self.created_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self.done = asyncio.Event()
+        self.task = None
+
+    def finished(self) -> bool:
+        return self.done.is_set()
+
+    def describe(self) -> JobResponse:
+        now = time.monotonic()
+        return JobResponse(
+            job_id=self.id,
+            status=self.status,
+            result=self.result,
+            error=self.error,
+            queued_for=(self.started_at or now) - self.created_at,
+            duration=(self.finished_at or now) - self.started_at if self.started_at else None,
+        )
+
+
+jobs = {}
+slots = asyncio.Semaphore(ANALYZER_WORKERS)
+stats = {"submitted": 0, "deduplicated": 0, JOB_DONE: 0, JOB_FAILED: 0, JOB_TIMEOUT: 0, JOB_CANCELLED: 0}
+
+
+def kill(proc):
+    # Gigahorse запускает дочерние процессы (souffle), поэтому завершается вся группа
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+async def run_step(args: list, cwd: str) -> str:
+    """
+    Запускает шаг анализа отдельным процессом, не блокируя event loop.
+    Возвращает хвост stderr.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *args,
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        start_new_session=True
+    )
+    try:
+        _, stderr = await proc.communicate()
+    except asyncio.CancelledError:
+        # Таймаут или отмена задачи
+        kill(proc)
+        await proc.wait()
+        raise
+    return stderr.decode(errors="replace")[-STDERR_TAIL:]
+
+
+async def analyze_bytecode(bytecode: str, workdir: str) -> dict:
+    with open(os.path.join(workdir, "contract.hex"), "w") as f:
+        f.write(bytecode)
+    stderr = await run_step([GIGAHORSE_PATH, "contract.hex"], workdir)
+    out_dir = os.path.join(workdir, ".temp", "contract", "out")
+    if not os.path.isdir(out_dir):
+        raise JobError(f"gigahorse produced no output: {stderr}")
+    stderr = await run_step(["python3", VISUALIZE_PATH], out_dir)
+    tac_path = os.path.join(out_dir, "contract.tac")
+    if not os.path.exists(tac_path):
+        raise JobError(f"visualizeout produced no contract.tac: {stderr}")
+    with open(tac_path) as f:
+        return {"tac": f.read()}
+
+
+async def execute(job: Job):
+    # Каждая задача работает в своём каталоге: gigahorse пишет .temp и results.json в текущий каталог
+    workdir = os.path.join(ANALYZER_JOBS_DIR, job.id)
+    try:
+        async with slots:
+            job.status = JOB_RUNNING
+            job.started_at = time.monotonic()
+            os.makedirs(workdir, exist_ok=True)
+            job.result = await asyncio.wait_for(analyze_bytecode(job.bytecode, workdir), job.timeout)
+            job.status = JOB_DONE
+    except asyncio.TimeoutError:
+        job.status = JOB_TIMEOUT
+        job.error = f"Analysis timed out after {job.timeout} s"
+    except asyncio.CancelledError:
+        job.status = JOB_CANCELLED
+    except JobError as e:
+        job.status = JOB_FAILED
+        job.error = str(e)
+    except Exception as e:
+        traceback.print_exc()
+        job.status = JOB_FAILED
+        job.error = f"Failed to run analysis: {e}"
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        job.finished_at = time.monotonic()
+        stats[job.status] += 1
+        job.done.set()
+
+
+def purge_jobs():
+    now = time.monotonic()
+    for job_id in [job.id for job in jobs.values() if job.finished() and now - job.finished_at > ANALYZER_JOB_TTL]:
+        del jobs[job_id]
+
+
+def normalize_bytecode(bytecode: str) -> str:
+    bytecode = bytecode.strip().lower().removeprefix("0x")
+    if not bytecode or len(bytecode) % 2 or not HEX_RE.fullmatch(bytecode):
+        raise HTTPException(400, "bytecode must be a non-empty hex string")
+    return bytecode
+
+
+@app.post("/jobs", response_model=JobResponse)
+async def submit_job(req: JobRequest):
+    """
+    Ставит байткод в очередь на анализ. Одинаковый байткод, отправленный повторно,
+    присоединяется к уже существующей задаче.
+    """
+    bytecode = normalize_bytecode(req.bytecode)
+    purge_jobs()
+    job_id = hashlib.sha256(bytecode.encode()).hexdigest()
+    job = jobs.get(job_id)
+    if job is not None and job.status in JOB_REUSABLE:
+        stats["deduplicated"] += 1
+        return job.describe()
+    job = Job(job_id, bytecode, min(req.timeout or ANALYZER_JOB_TIMEOUT, ANALYZER_JOB_TIMEOUT))
+    jobs[job_id] = job
+    job.task = asyncio.create_task(execute(job))
+    stats["submitted"] += 1
+    return job.describe()
+
+
+@app.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: str, wait: float = 0):
+    """
+    Статус задачи. С параметром wait ждёт завершения не дольше wait секунд (long-poll).
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(404, "Job not found")
+    if wait > 0 and not job.finished():
+        try:
+            await asyncio.wait_for(job.done.wait(), min(wait, ANALYZER_MAX_WAIT))
+        except asyncio.TimeoutError:
+            pass
+    return job.describe()
+
+
+@app.delete("/jobs/{job_id}", response_model=JobResponse)
+async def cancel_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(404, "Job not found")
+    if not job.finished():
+        job.task.cancel()
+        await job.done.wait()
+    return job.describe()
+
+
+@app.get("/stats")
+async def get_stats():
+    return {
+        "workers": ANALYZER_WORKERS,
+        "queued": sum(1 for job in jobs.values() if job.status == JOB_QUEUED),
+        "running": sum(1 for job in jobs.values() if job.status == JOB_RUNNING),
+        "stored": len(jobs),
+        **stats,
+    }
+
+
+# Выполняет произвольную команду; анализ контрактов идёт через /jobs.
+# Обычная (не async) функция выполняется в пуле потоков и не блокирует event loop
 @app.post("/run", response_model=RunResponse)
-async def run_cli(req: RunRequest):
+def run_cli(req: RunRequest):
     try:
         proc = subprocess.run(
             req.cmd,
@@ -36,4 +266,3 @@ async def run_cli(req: RunRequest):
         stdout=proc.stdout,
         stderr=proc.stderr,
     )
-
@@ -15,6 +15,7 @@ from handlers import (
     format_transaction, 
     normalize_address
 )
+from sender import SendScheduler, PRIORITY_APPROVAL, PRIORITY_LIST
 
 # Настройка логирования
 logging.basicConfig(
@@ -38,6 +39,9 @@ class EthereumTelegramBot:
         self.updater = Updater(token=API_TOKEN)
         self.dispatcher = self.updater.dispatcher
         self.api_base_url = API_URL
+        # Все уведомления и списки транзакций отправляются через очередь с учётом лимитов Telegram
+        self.sender = SendScheduler(self.updater.bot)
+        self.sender.start()
         
         # Обработчики команд
         self.dispatcher.add_handler(CommandHandler('start', self.start_command))
@@ -64,17 +68,23 @@ class EthereumTelegramBot:
         self.updater.start_polling()
         logger.info("Бот запущен")
 
-    def notify_user_about_transaction(self, chat_id, tx_id):
-        """Отправляет сообщение пользователю о новой транзакции"""
-        response = requests.post(f"{self.api_base_url}/get_transaction", json={"tx_id": tx_id})
-        json_response = response.json()
+    def notify_user_about_transaction(self, chat_id, tx_id, tx=None, notification_id=None, simulation_status=None):
+        """
+        Ставит в очередь сообщение пользователю о новой транзакции.
+        Возвращает Future, который завершается после отправки.
+        Повтор уведомления с тем же notification_id не отправляется второй раз.
+        """
+        json_response = {}
+        if tx is None:
+            # Старый формат уведомления без данных транзакции
+            response = requests.post(f"{self.api_base_url}/get_transaction", json={"tx_id": tx_id})
+            json_response = response.json()
+            tx = json_response.get('transaction', {})
+            simulation_status = json_response.get('simulation_status')
         if json_response.get('error'):
             logger.error(f"Ошибка при получении транзакции {tx_id}: {json_response['error']}")
         else:
-            tx = json_response.get('transaction', {})
-            pending = json_response.get('pending', False)
-            confirmed = json_response.get('confirmed', False)
-            message = format_transaction(tx_id, tx)
+            message = format_transaction(tx_id, tx, simulation_status=simulation_status)
             print(tx_id)
             keyboard = [
                 [InlineKeyboardButton("✅ Подтвердить", callback_data=f"confirm_tx_{tx_id}"),
@@ -84,7 +94,10 @@ class EthereumTelegramBot:
                 [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            self.updater.bot.send_message(chat_id=chat_id, text=message, reply_markup=reply_markup, parse_mode='Markdown')
+            return self.sender.send_message(
+                chat_id, message, reply_markup=reply_markup, parse_mode='Markdown', priority=PRIORITY_APPROVAL,
+                dedupe_key=f"notification_{notification_id}" if notification_id is not None else None
+            )
            
     def start_command(self, update: Update, context: CallbackContext) -> None:
         """Обрабатывает команду /start"""
@@ -470,17 +483,24 @@ class EthereumTelegramBot:
         """Показывает список ожидающих транзакций"""
         user_id = str(query.from_user.id)
                
-        # Получаем транзакции для этих адресов
+        # Получаем сводки всех ожидающих транзакций постранично, без запроса на каждую
         transactions = []
-        response = requests.post(f"{self.api_base_url}/get_pending_transactions", json={"user_id": user_id})
-        json_response = response.json()
-        if json_response.get('error'):
-            logger.error(f"Ошибка при получении транзакций для пользователя {user_id}: {json_response['error']}")
-            update.message.reply_text(
-                f"❌ Произошла ошибка: {json_response['error']}"
+        cursor = None
+        while True:
+            response = requests.post(f"{self.api_base_url}/list_pending_transactions", json={"user_id": user_id, "cursor": cursor})
+            json_response = response.json()
+            if json_response.get('status') != 'success':
+                break
+            transactions.extend(json_response.get('transactions') or [])
+            cursor = json_response.get('next_cursor')
+            if cursor is None:
+                break
+        if json_response.get('status') != 'success':
+            logger.error(f"Ошибка при получении транзакций для пользователя {user_id}: {json_response.get('message')}")
+            query.edit_message_text(
+                f"❌ Произошла ошибка: {json_response.get('message')}"
             )
         else:
-            transactions = json_response.get('transactions', [])
             if not transactions:
                 keyboard = [
                     # [InlineKeyboardButton("🔄 Обновить", callback_data="pending_transactions")],
@@ -494,32 +514,27 @@ class EthereumTelegramBot:
             else:
                 # Выводим транзакции из списка
                 for transaction in transactions:
-                    tx_id = transaction
-                    tx_data = requests.post(f"{self.api_base_url}/get_transaction", json={"tx_id": tx_id})
-                    json_response = tx_data.json()
-                    if json_response.get('error'):
-                        logger.error(f"Ошибка при получении транзакции {tx_id}: {json_response['error']}")
-                    else:
-                        tx = json_response.get('transaction', {})
-                        pending = json_response.get('pending', False)
-                        confirmed = json_response.get('confirmed', False)
-                        
-                    formatted_tx = format_transaction(tx_id, tx)
+                    tx_id = transaction['id']
+                    tx = transaction.get('transaction', {})
+                    formatted_tx = format_transaction(tx_id, tx, simulation_status=transaction.get('simulation_status'))
                     # отправляем отдельные сообщения в чат с каждой транзакцией
-                    chat_id = query.effective_chat.id
+                    chat_id = query.message.chat_id
+                    # Номер в кнопках нужен, если очередь объединит несколько транзакций в одно сообщение
                     keyboard = [
-                        [InlineKeyboardButton("✅ Подтвердить", callback_data=f"confirm_tx_{tx_id}"),
-                         InlineKeyboardButton("❌ Отклонить", callback_data=f"reject_tx_{tx_id}")
+                        [InlineKeyboardButton(f"✅ Подтвердить #{tx_id}", callback_data=f"confirm_tx_{tx_id}"),
+                         InlineKeyboardButton(f"❌ Отклонить #{tx_id}", callback_data=f"reject_tx_{tx_id}")
                         ],
                         [InlineKeyboardButton("🔙 Назад", callback_data="pending_transactions")],
                         [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
                     ]
                     reply_markup = InlineKeyboardMarkup(keyboard)
-                    self.updater.bot.send_message(
-                        chat_id=chat_id,
-                        text=formatted_tx,
+                    self.sender.send_message(
+                        chat_id,
+                        formatted_tx,
                         reply_markup=reply_markup,
-                        parse_mode='Markdown'
+                        parse_mode='Markdown',
+                        priority=PRIORITY_LIST,
+                        coalesce=True
                     )
         
     
@@ -583,7 +598,7 @@ class EthereumTelegramBot:
                 status = "Подтверждена"
             else:
                 status = "Отклонена"
-            formatted_tx = format_transaction(tx_id, tx)
+            formatted_tx = format_transaction(tx_id, tx, simulation_status=json_response.get('simulation_status'))
             keyboard = [
                 [InlineKeyboardButton("✅ Подтвердить", callback_data=f"confirm_tx_{tx_id}"),
                  InlineKeyboardButton("❌ Отклонить", callback_data=f"reject_tx_{tx_id}")
@@ -12,14 +12,23 @@ def normalize_address(address):
     return w3.to_checksum_address(address)
 
 
-def format_transaction(tx_id, tx_data, simulation_result=None):
+# Статус симуляции, при котором данные транзакции не содержат её последствий
+SIMULATION_FAILED = 'failed'
+
+
+def format_transaction(tx_id, tx_data, simulation_result=None, simulation_status=None):
     """
-    Форматирует транзакцию для отображения в сообщении Telegram
+    Форматирует транзакцию для отображения в сообщении Telegram.
+    Если симуляция не удалась, сообщение явно предупреждает об этом: отсутствие логов
+    в таком случае не означает, что транзакция ничего не переводит
     """
     # Определяем базовую информацию о транзакции
     method = tx_data.get('method') if isinstance(tx_data, dict) else 'Unknown'
     
     formatted_text = f"🔔 *Новая транзакция*\n\n"
+    if simulation_status == SIMULATION_FAILED:
+        formatted_text += "⚠️ *Симуляция не удалась*\n"
+        formatted_text += "Последствия транзакции (переводы токенов, события) неизвестны. Подтверждайте, только если уверены в ней.\n\n"
     formatted_text += f"*ID:* `0x{tx_data.get('tx_hash')}`\n"
     formatted_text += f"*Отправитель:* `{tx_data.get('from')}`\n"
     if tx_data.get('to') == 'None' or tx_data.get('to') == None:
@@ -1,4 +1,7 @@
+import asyncio
 import logging
+import os
+import time
 import traceback
 from fastapi import FastAPI, Request
 from bot import EthereumTelegramBot
@@ -19,6 +22,8 @@ logger.info("Bot Runner сервис запущен")
 app = FastAPI(title="Telegram Bot Notification API")
 
 bot = EthereumTelegramBot()
+# Сколько ждать отправки уведомления через очередь бота
+NOTIFY_SEND_TIMEOUT = float(os.getenv('NOTIFY_SEND_TIMEOUT', '30'))
 
 # API эндпоинты
 @app.post("/notify-transaction")
@@ -34,7 +39,11 @@ async def notify_transaction(request: Request):
         logger.info(f"Получено уведомление о транзакции: {tx_id}")
         
         # Вызываем функцию обработки уведомления напрямую
-        bot.notify_user_about_transaction(chat_id, tx_id)
+        sent = bot.notify_user_about_transaction(
+            chat_id, tx_id, data.get('transaction'), simulation_status=data.get('simulation_status')
+        )
+        if sent is not None:
+            await asyncio.wait_for(asyncio.wrap_future(sent), NOTIFY_SEND_TIMEOUT)
         logger.info(f"Уведомление о транзакции {tx_id} отправлено пользователю {chat_id}")
         
         return {"status": "success"}
@@ -44,6 +53,45 @@ async def notify_transaction(request: Request):
         logger.error(traceback.format_exc())
         return {"status": "error", "message": error_msg}
 
+@app.post("/notify-transactions")
+def notify_transactions(payload: dict):
+    """
+    Пачка уведомлений от диспетчера outbox. Каждое уведомление самодостаточно,
+    результат возвращается по каждому отдельно, чтобы повторялись только неудачные.
+    """
+    queued = []
+    for notification in payload.get('notifications', []):
+        try:
+            sent = bot.notify_user_about_transaction(
+                notification.get('chat_id'), notification.get('tx_id'), notification.get('transaction'),
+                notification_id=notification.get('id'),
+                simulation_status=notification.get('simulation_status')
+            )
+            queued.append((notification, sent, None))
+        except Exception as e:
+            queued.append((notification, None, e))
+    # Сообщения уходят через очередь отправки, ответ ждёт фактической доставки.
+    # Не дождавшиеся отправки остаются в очереди; повтор диспетчера с тем же id
+    # присоединяется к ним, а не отправляет сообщение второй раз
+    deadline = time.monotonic() + NOTIFY_SEND_TIMEOUT
+    results = []
+    for notification, sent, error in queued:
+        try:
+            if error is not None:
+                raise error
+            if sent is not None:
+                sent.result(timeout=max(0.0, deadline - time.monotonic()))
+            results.append({"id": notification.get('id'), "status": "success"})
+        except Exception as e:
+            logger.error(f"Ошибка при отправке уведомления {notification.get('id')}: {str(e)}")
+            results.append({"id": notification.get('id'), "status": "error", "message": str(e) or type(e).__name__})
+    return {"status": "success", "results": results}
+
+
+@app.get("/stats")
+def stats():
+    return {"sender": bot.sender.stats()}
+
 # Запуск телеграм-бота
 def start_telegram_bot():
     """Запускает телеграм-бота"""
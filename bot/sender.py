@@ -0,0 +1,270 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from telegram import InlineKeyboardMarkup
+from telegram.error import RetryAfter, TimedOut, NetworkError
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота и не больше одного в секунду в чат
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '25'))
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))
+TELEGRAM_CHAT_BURST = float(os.getenv('TELEGRAM_CHAT_BURST', '1'))
+# Сколько раз повторять отправку при сетевых ошибках
+TELEGRAM_SEND_RETRIES = int(os.getenv('TELEGRAM_SEND_RETRIES', '3'))
+# Максимальная длина сообщения Telegram
+MESSAGE_MAX_LENGTH = 4096
+# Сколько ключей уже поставленных в очередь сообщений помнить для защиты от повторов
+TELEGRAM_DEDUPE_SIZE = int(os.getenv('TELEGRAM_DEDUPE_SIZE', '10000'))
+
+# Приоритеты: чем меньше, тем раньше
+PRIORITY_APPROVAL = 0
+PRIORITY_LIST = 1
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """
+        Сколько секунд ждать до появления токена
+        """
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self.refill(now)
+        self.tokens -= 1
+
+
+class OutgoingMessage:
+    def __init__(self, chat_id, text, reply_markup=None, parse_mode=None, priority=PRIORITY_APPROVAL, coalesce=False, seq=0):
+        self.chat_id = chat_id
+        self.text = text
+        self.reply_markup = reply_markup
+        self.parse_mode = parse_mode
+        self.priority = priority
+        self.coalesce = coalesce
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+        self.future = Future()
+
+    def key(self):
+        return self.priority, self.seq
+
+
+class SendScheduler:
+    """
+    Очередь исходящих сообщений бота. Отправляет из одного потока с учётом
+    глобального и по-чатового token bucket, сначала сообщения с подтверждением
+    новых транзакций, затем списки. Несколько ожидающих сообщений списка в один чат
+    объединяются в одно.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.chats = {}
+        self.chat_buckets = {}
+        self.global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        self.condition = threading.Condition()
+        self.seq = 0
+        self.thread = None
+        # dedupe_key -> Future: повторная постановка того же сообщения возвращает ту же отправку
+        self.dedupe = OrderedDict()
+        self.deduplicated = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.failed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, name="telegram-sender", daemon=True)
+            self.thread.start()
+
+    def send_message(self, chat_id, text, reply_markup=None, parse_mode=None, priority=PRIORITY_APPROVAL, coalesce=False, dedupe_key=None) -> Future:
+        """
+        Ставит сообщение в очередь. Future завершается после фактической отправки.
+        Сообщение с dedupe_key, которое уже ждёт в очереди или отправлено, повторно не ставится:
+        возвращается Future первой постановки.
+        """
+        with self.condition:
+            if dedupe_key is not None:
+                existing = self.dedupe.get(dedupe_key)
+                if existing is not None and not (existing.done() and existing.exception() is not None):
+                    self.deduplicated += 1
+                    return existing
+            self.seq += 1
+            message = OutgoingMessage(chat_id, text, reply_markup, parse_mode, priority, coalesce, self.seq)
+            self.chats.setdefault(chat_id, deque()).append(message)
+            if dedupe_key is not None:
+                self.dedupe[dedupe_key] = message.future
+                self.dedupe.move_to_end(dedupe_key)
+                while len(self.dedupe) > TELEGRAM_DEDUPE_SIZE:
+                    self.dedupe.popitem(last=False)
+            self.condition.notify()
+        return message.future
+
+    def chat_bucket(self, chat_id) -> TokenBucket:
+        if chat_id not in self.chat_buckets:
+            self.chat_buckets[chat_id] = TokenBucket(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+        return self.chat_buckets[chat_id]
+
+    def next_batch(self):
+        """
+        Выбирает чат с самым приоритетным сообщением, в который уже можно писать.
+        Возвращает список сообщений для одной отправки или время ожидания.
+        """
+        now = time.monotonic()
+        wait = self.global_bucket.wait_time(now)
+        if wait > 0:
+            return None, wait
+        best = None
+        wait = None
+        for chat_id, queue in self.chats.items():
+            head = min(queue, key=OutgoingMessage.key)
+            chat_wait = self.chat_bucket(chat_id).wait_time(now)
+            if chat_wait > 0:
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+                continue
+            if best is None or head.key() < best[1].key():
+                best = (chat_id, head)
+        if best is None:
+            return None, wait
+        chat_id, head = best
+        queue = self.chats[chat_id]
+        batch = [head]
+        if head.coalesce:
+            length = len(head.text)
+            for message in sorted(queue, key=OutgoingMessage.key):
+                if message is head or not message.coalesce or message.parse_mode != head.parse_mode:
+                    continue
+                if length + len(message.text) + 2 > MESSAGE_MAX_LENGTH:
+                    break
+                length += len(message.text) + 2
+                batch.append(message)
+        for message in batch:
+            queue.remove(message)
+        if not queue:
+            del self.chats[chat_id]
+        self.global_bucket.take(now)
+        self.chat_bucket(chat_id).take(now)
+        return batch, None
+
+    def merge(self, batch):
+        """
+        Объединяет тексты и клавиатуры; общие ряды кнопок (навигация) идут один раз в конце
+        """
+        if len(batch) == 1:
+            return batch[0].text, batch[0].reply_markup
+        text = "\n\n".join(message.text for message in batch)
+        rows = [
+            (tuple(button.callback_data or button.url for button in row), list(row))
+            for message in batch if message.reply_markup is not None
+            for row in message.reply_markup.inline_keyboard
+        ]
+        counts = {}
+        for key, _ in rows:
+            counts[key] = counts.get(key, 0) + 1
+        own = [row for key, row in rows if counts[key] == 1]
+        shared = {}
+        for key, row in rows:
+            if counts[key] > 1:
+                shared.setdefault(key, row)
+        keyboard = own + list(shared.values())
+        return text, InlineKeyboardMarkup(keyboard) if keyboard else None
+
+    def deliver(self, batch):
+        head = batch[0]
+        text, reply_markup = self.merge(batch)
+        try:
+            result = self.bot.send_message(chat_id=head.chat_id, text=text, reply_markup=reply_markup, parse_mode=head.parse_mode)
+        except RetryAfter as e:
+            # Telegram сам сообщил, сколько ждать: откладываем чат целиком
+            self.requeue(batch, delay=e.retry_after)
+            return
+        except (TimedOut, NetworkError) as e:
+            if head.attempts + 1 < TELEGRAM_SEND_RETRIES:
+                self.requeue(batch)
+                return
+            self.fail(batch, e)
+            return
+        except Exception as e:
+            self.fail(batch, e)
+            return
+        now = time.monotonic()
+        with self.condition:
+            self.sent += 1
+            self.coalesced += len(batch) - 1
+            for message in batch:
+                latency = now - message.enqueued_at
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+        for message in batch:
+            message.future.set_result(result)
+
+    def requeue(self, batch, delay: float = 0.0):
+        with self.condition:
+            self.retries += 1
+            for message in batch:
+                message.attempts += 1
+                self.chats.setdefault(message.chat_id, deque()).appendleft(message)
+            if delay:
+                bucket = self.chat_bucket(batch[0].chat_id)
+                bucket.refill(time.monotonic())
+                bucket.tokens = -delay * bucket.rate
+            self.condition.notify()
+
+    def fail(self, batch, error: Exception):
+        logger.error(f"Не удалось отправить сообщение в чат {batch[0].chat_id}: {str(error)}")
+        with self.condition:
+            self.failed += len(batch)
+        for message in batch:
+            message.future.set_exception(error)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.chats:
+                    self.condition.wait()
+                batch, wait = self.next_batch()
+                if batch is None:
+                    self.condition.wait(wait)
+                    continue
+            self.deliver(batch)
+
+    def stats(self) -> dict:
+        with self.condition:
+            queued = [message for queue in self.chats.values() for message in queue]
+            now = time.monotonic()
+            delivered = self.sent + self.coalesced
+            return {
+                "queue_depth": len(queued),
+                "queue_depth_by_priority": {
+                    "approval": sum(1 for message in queued if message.priority == PRIORITY_APPROVAL),
+                    "list": sum(1 for message in queued if message.priority == PRIORITY_LIST),
+                },
+                "chats_waiting": len(self.chats),
+                "oldest_wait": max((now - message.enqueued_at for message in queued), default=0.0),
+                "sent": self.sent,
+                "coalesced": self.coalesced,
+                "deduplicated": self.deduplicated,
+                "retries": self.retries,
+                "failed": self.failed,
+                "latency_avg": self.latency_total / delivered if delivered else 0.0,
+                "latency_max": self.latency_max,
+            }
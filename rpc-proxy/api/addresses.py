@@ -0,0 +1,63 @@
+import os
+import threading
+import time
+from django.db.models import Count, Max
+from .models import UserAdress, normalize_address
+
+
+# Как часто проверять, не изменился ли список адресов в другом процессе
+WATCHED_ADDRESSES_SYNC_INTERVAL = float(os.environ.get('WATCHED_ADDRESSES_SYNC_INTERVAL', '2'))
+
+
+class WatchedAddresses:
+    """
+    Адреса, транзакции которых перехватываются, в памяти процесса: адрес -> (id UserAdress, id User).
+    Сбрасывается add_address / remove_address; изменения из других процессов
+    замечаются по версии таблицы (число строк и последнее изменение).
+    """
+
+    def __init__(self):
+        self.addresses = None
+        self.version = None
+        self.lock = threading.Lock()
+        self.next_sync = 0.0
+        self.reloads = 0
+
+    def table_version(self):
+        return tuple(UserAdress.objects.aggregate(count=Count('id'), updated=Max('updated_at')).values())
+
+    def sync(self) -> dict:
+        addresses = self.addresses
+        if addresses is not None and time.monotonic() < self.next_sync:
+            return addresses
+        with self.lock:
+            if self.addresses is not None and time.monotonic() < self.next_sync:
+                return self.addresses
+            version = self.table_version()
+            if self.addresses is None or version != self.version:
+                # Если адрес отслеживают несколько пользователей, берётся первая запись, как и раньше
+                rows = UserAdress.objects.order_by('-id').values_list('normalized_address', 'id', 'user_id')
+                self.addresses = {address: (address_id, user_id) for address, address_id, user_id in rows}
+                self.version = version
+                self.reloads += 1
+            self.next_sync = time.monotonic() + WATCHED_ADDRESSES_SYNC_INTERVAL
+            return self.addresses
+
+    def invalidate(self):
+        with self.lock:
+            self.addresses = None
+
+    def get(self, address: str) -> tuple | None:
+        """
+        (id UserAdress, id User) для отслеживаемого адреса или None
+        """
+        return self.sync().get(normalize_address(address))
+
+    def stats(self) -> dict:
+        return {
+            "addresses": len(self.addresses or {}),
+            "reloads": self.reloads,
+        }
+
+
+watched_addresses = WatchedAddresses()
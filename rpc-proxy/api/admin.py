@@ -1,19 +1,37 @@
 from django.contrib import admin
-from .models import User, UserAdress, PendingTransaction, DisassembledContractFunction, ContractStaticAnalysis
+from .models import User, UserAdress, PendingTransaction, Notification, DisassembledContractFunction, ContractStaticAnalysis, ContractCode, LLMResponse
 
 # Register your models here.
 admin.site.register(User)
 admin.site.register(UserAdress)
 admin.site.register(PendingTransaction)
 
+class NotificationAdmin(admin.ModelAdmin):
+    list_display = ('id', 'chat_id', 'pending_transaction', 'status', 'attempts', 'next_attempt_at', 'sent_at')
+    list_filter = ('status',)
+
+admin.site.register(Notification, NotificationAdmin)
+
 class DisassembledContractFunctionAdmin(admin.ModelAdmin):
-    list_display = ('contract_address', 'function_name', 'function_code', 'solidity_code')
-    search_fields = ('contract_address', 'function_name')
+    list_display = ('contract_address', 'code_hash', 'function_name', 'function_code', 'solidity_code')
+    search_fields = ('contract_address', 'code_hash', 'function_name')
 
 admin.site.register(DisassembledContractFunction, DisassembledContractFunctionAdmin)
 
 class ContractStaticAnalysisAdmin(admin.ModelAdmin):
-    list_display = ('contract_address', 'bytecode_hash')
-    search_fields = ('contract_address', 'bytecode_hash')
+    list_display = ('contract_address', 'code_hash', 'bytecode_hash')
+    search_fields = ('contract_address', 'code_hash', 'bytecode_hash')
 
 admin.site.register(ContractStaticAnalysis, ContractStaticAnalysisAdmin)
+
+class ContractCodeAdmin(admin.ModelAdmin):
+    list_display = ('address', 'code_hash', 'is_proxy', 'updated_at')
+    search_fields = ('address', 'code_hash')
+
+admin.site.register(ContractCode, ContractCodeAdmin)
+
+class LLMResponseAdmin(admin.ModelAdmin):
+    list_display = ('key', 'model', 'size', 'hits', 'created_at', 'last_used_at')
+    search_fields = ('key', 'model')
+
+admin.site.register(LLMResponse, LLMResponseAdmin)
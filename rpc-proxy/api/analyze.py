@@ -3,19 +3,42 @@ import httpx
 import requests
 from web3 import Web3
 import os
+import time
 from hexbytes import HexBytes
 from eth_account import Account
 import traceback
-from .models import DisassembledContractFunction, PendingTransaction, ContractStaticAnalysis
+from .models import DisassembledContractFunction, PendingTransaction, ContractStaticAnalysis, ContractCode, normalize_address
 import json
 from hashlib import md5
+from .pool import UpstreamProvider
+from .trace import related_contracts as trace_related_contracts, trace_for_prompt
+from .llm import llm_runner, single_messages
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from django.db import connections
 
 socks_url = os.environ.get("SOCKS_URL")
 client = OpenAI(
     api_key=os.environ.get("OPENAI_API_KEY"), http_client=DefaultHttpxClient(proxy=socks_url)
 )
-w3 = Web3(Web3.HTTPProvider("http://hardhat-network:8545"))
-API_URL = "http://gigahorse:8000/run"
+# Код и storage читаются из основной сети: ноды форка арендуются воркером симуляций и откатываются
+w3 = Web3(UpstreamProvider())
+ANALYZER_URL = os.environ.get('ANALYZER_URL', 'http://gigahorse:8000')
+# Сколько ждать результата gigahorse и на сколько секунд делать один long-poll запрос
+ANALYZER_JOB_TIMEOUT = float(os.environ.get('ANALYZER_JOB_TIMEOUT', '3000'))
+ANALYZER_POLL_WAIT = float(os.environ.get('ANALYZER_POLL_WAIT', '30'))
+
+# Сколько контрактов транзакции анализируется одновременно
+ANALYZE_CONTRACT_CONCURRENCY = int(os.environ.get('ANALYZE_CONTRACT_CONCURRENCY', '8'))
+# Ограничение на одновременные запросы к ноде. Очередь gigahorse ведёт сам анализатор,
+# параллельность запросов к LLM регулирует llm_runner
+ANALYZE_RPC_CONCURRENCY = int(os.environ.get('ANALYZE_RPC_CONCURRENCY', '4'))
+RPC_SLOTS = threading.BoundedSemaphore(ANALYZE_RPC_CONCURRENCY)
+# Контракты с одинаковым кодом анализируются по очереди: второй берёт готовый результат из БД.
+# code_hash -> [блокировка, число потоков, которые её держат или ждут]
+CODE_LOCKS = {}
+CODE_LOCKS_GUARD = threading.Lock()
 
 
 def list_openai_models():
@@ -26,7 +49,7 @@ def list_openai_models():
     return return_list
 
 def call_openai_compile_contract(content: str, model: str = "gpt-4o-mini"):
-    response = client.chat.completions.create(
+    return llm_runner.complete_sync(
         model=model,
         temperature=0,
         messages=[
@@ -40,12 +63,11 @@ def call_openai_compile_contract(content: str, model: str = "gpt-4o-mini"):
             }
         ]
     )
-    return response.choices[0].message.content
 
 def call_openai(content: str, model: str = "gpt-4o-mini"):
     result_content = f"Контракт: ```\n{content}\n```\n"
 
-    response = client.chat.completions.create(
+    return llm_runner.complete_sync(
         model=model,
         temperature=0,
         messages=[
@@ -59,10 +81,9 @@ def call_openai(content: str, model: str = "gpt-4o-mini"):
             }
         ]
     )
-    return response.choices[0].message.content
 
 def call_openai_on_schemas(content: str, model: str = "gpt-4o-mini"):
-    response = client.chat.completions.create(
+    return llm_runner.complete_sync(
         model=model,
         temperature=0,
         messages=[
@@ -76,83 +97,126 @@ def call_openai_on_schemas(content: str, model: str = "gpt-4o-mini"):
             }
         ]
     )
-    return response.choices[0].message.content
+
+DECOMPILE_SYSTEM_PROMPT = "Отвечай _только_ solidity-кодом без каких-либо описаний, пояснений, классов, `pragma` и `solidity` - только код функции без использования assembly, сохраняя адреса используемых storage-слотов. Ты - профессиональный разработчик смарт-контрактов и реверс-инженер EVM-байткода."
+DECOMPILE_PROMPT = "Напиши solidity-подобный псевдокод для дизассемблированной функции, не изменяя её название и названия аргументов и не добавляя f в начале названия функции. Конструкции вида CALLPRIVATE обозначают вызовы функции, указанной в скобках в первом аргументе, замени CALLPRIVATE на название функции, которое начинается обычно на 0x и находится в скобках в первом аргументе, и дополни такой вызов остальными аргументов вызова функции согласно конструкции CALLPRIVATE. Если название event'а, которое происходит в emit тебе точно известно, то замени хеш на название event'а в псевдокоде. Конструкция MLOAD загружает значение из storage-слота - учитывай это и обозначай в псевдокоде какой storage-слот ."
+
 
 def call_openai_one_function(content: str, model: str = "gpt-4o-mini"):
-    response = client.chat.completions.create(
-        model=model,
-        messages=[
-            {
-                "role": "system",
-                "content": "Отвечай _только_ solidity-кодом без каких-либо описаний, пояснений, классов, `pragma` и `solidity` - только код функции без использования assembly, сохраняя адреса используемых storage-слотов. Ты - профессиональный разработчик смарт-контрактов и реверс-инженер EVM-байткода."
-            },
-            {
-                "role": "user",
-                "content":f"Напиши solidity-подобный псевдокод для дизассемблированной функции, не изменяя её название и названия аргументов и не добавляя f в начале названия функции. Конструкции вида CALLPRIVATE обозначают вызовы функции, указанной в скобках в первом аргументе, замени CALLPRIVATE на название функции, которое начинается обычно на 0x и находится в скобках в первом аргументе, и дополни такой вызов остальными аргументов вызова функции согласно конструкции CALLPRIVATE. Если название event'а, которое происходит в emit тебе точно известно, то замени хеш на название event'а в псевдокоде. Конструкция MLOAD загружает значение из storage-слота - учитывай это и обозначай в псевдокоде какой storage-слот .\n{content}."
-            }
-        ]
-    )
-    return response.choices[0].message.content
+    return llm_runner.complete_sync(single_messages(DECOMPILE_SYSTEM_PROMPT, DECOMPILE_PROMPT, content), model)
 
-def run_gigahorse_command(cmd: str):
-    payload = {
-        "cmd": cmd
-    }
+
+def call_openai_functions(contents: list, model: str = "gpt-4o-mini") -> list:
+    """
+    Декомпилирует несколько функций конкурентно, мелкие функции упаковываются в общие запросы
+    """
+    return llm_runner.complete_many_sync(DECOMPILE_SYSTEM_PROMPT, DECOMPILE_PROMPT, contents, model)
+
+def run_gigahorse_job(bytecode: str) -> str | None:
+    """
+    Отправляет байткод в анализатор и ждёт результата long-poll запросами.
+    Возвращает contract.tac или None, если анализ не удался.
+    """
+    deadline = time.monotonic() + ANALYZER_JOB_TIMEOUT
     try:
-        resp = requests.post(API_URL, json=payload, timeout=1000)
+        resp = requests.post(f"{ANALYZER_URL}/jobs", json={"bytecode": bytecode, "timeout": ANALYZER_JOB_TIMEOUT}, timeout=30)
         resp.raise_for_status()
+        job = resp.json()
+        # Задачу не отменяем по своему таймауту: её мог ждать и другой воркер с тем же байткодом
+        while job["status"] in ("queued", "running") and time.monotonic() < deadline:
+            resp = requests.get(
+                f"{ANALYZER_URL}/jobs/{job['job_id']}",
+                params={"wait": ANALYZER_POLL_WAIT},
+                timeout=ANALYZER_POLL_WAIT + 30
+            )
+            resp.raise_for_status()
+            job = resp.json()
     except requests.RequestException as e:
         print(f"Ошибка при запросе к API: {e}")
         return
+    if job["status"] != "done":
+        print(f"Анализ gigahorse не выполнен ({job['status']}): {job.get('error')}")
+        return
+    return job["result"]["tac"]
 
-    data = resp.json()
-    # print("Код возврата:", data["returncode"])
-    # print("STDOUT:\n", data["stdout"])
-    # print("STDERR:\n", data["stderr"])
-    return data["stdout"]
-
-def get_implementation_address(address: str) -> bool:
+def implementation_address(address: str) -> str | None:
     """
-    Проверяет, есть ли в контракте по адресу `address` хранилище
-    implementation согласно EIP-1967.
+    Адрес реализации из слота implementation EIP-1967 или None, если слот пуст
     """
     addr = w3.to_checksum_address(address)
-    # вычисляем слот: keccak256("eip1967.proxy.implementation") - 1
     slot_raw = w3.keccak(text="eip1967.proxy.implementation")
     slot_int = int.from_bytes(slot_raw, "big") - 1
-    slot = HexBytes(slot_int)
-
-    # читаем storage по этому слоту
-    impl_bytes = w3.eth.get_storage_at(addr, slot)
-    impl_int = int.from_bytes(impl_bytes, "big")
-
-    if impl_int == 0:
-        # нет записи — вряд ли это EIP-1967 прокси
-        return False
-
-    # из последних 20 байт строим адрес реализации
-    impl_addr = w3.to_checksum_address(impl_bytes[-20:].hex())
-    # проверяем, что по этому адресу есть код
-    code = w3.eth.get_code(impl_addr)
-    if len(code) > 0:
-        return code
-    else:
-        return False
+    impl_bytes = w3.eth.get_storage_at(addr, HexBytes(slot_int))
+    if int.from_bytes(impl_bytes, "big") == 0:
+        return None
+    return w3.to_checksum_address(impl_bytes[-20:].hex())
 
 
 def parse_contract_address(contract_address: str):
-    # Приводим к checksum-формату
+    """
+    Байткод для анализа: код реализации EIP-1967 прокси, если он есть, иначе код самого контракта
+    """
     checksum_addr = w3.to_checksum_address(contract_address)
-    impl_addr = get_implementation_address(checksum_addr)
-    if impl_addr:
-        bytecode_bytes = w3.eth.get_code(impl_addr)
-        bytecode_hex = bytecode_bytes.hex()
-        # print("Bytecode of implementation:", bytecode_hex)
-    else:
+    impl_addr = implementation_address(checksum_addr)
+    bytecode_bytes = w3.eth.get_code(impl_addr) if impl_addr else b""
+    if not bytecode_bytes:
         bytecode_bytes = w3.eth.get_code(checksum_addr)
-        bytecode_hex = bytecode_bytes.hex()
-        # print("Bytecode:", bytecode_hex)
-    return bytecode_hex
+    return bytecode_bytes.hex()
+
+
+def code_hash_of(bytecode: bytes) -> str:
+    return Web3.to_hex(Web3.keccak(bytecode))
+
+
+def resolve_contract_code(address: str, follow_proxy: bool = True) -> tuple:
+    """
+    Возвращает keccak анализируемого кода (для EIP-1967 прокси — кода реализации)
+    и байткод в hex, если его пришлось загрузить. Для известных адресов без прокси
+    запросов к ноде нет. Для адресов без кода (EOA, прекомпайлы) возвращает (None, None).
+    """
+    address = normalize_address(address)
+    known = ContractCode.objects.filter(address=address).first()
+    if known and not known.is_proxy:
+        return known.code_hash, None
+    checksum_addr = w3.to_checksum_address(address)
+    if follow_proxy:
+        impl_addr = implementation_address(checksum_addr)
+        if impl_addr:
+            code_hash, bytecode_hex = resolve_contract_code(impl_addr, follow_proxy=False)
+            if code_hash:
+                if known is None:
+                    ContractCode.objects.get_or_create(
+                        address=address,
+                        defaults={"code_hash": code_hash_of(w3.eth.get_code(checksum_addr)), "is_proxy": True}
+                    )
+                return code_hash, bytecode_hex
+    bytecode_bytes = w3.eth.get_code(checksum_addr)
+    if not bytecode_bytes:
+        # Код может появиться позже (CREATE2), поэтому пустой адрес не запоминается.
+        # Если кода нет у реализации прокси, анализируется код самого прокси
+        return None, None
+    code_hash = code_hash_of(bytecode_bytes)
+    ContractCode.objects.get_or_create(address=address, defaults={"code_hash": code_hash})
+    return code_hash, bytecode_bytes.hex()
+
+
+@contextmanager
+def code_lock(code_hash: str):
+    """
+    Блокировка на время анализа кода. Запись удаляется, когда её больше никто не ждёт,
+    поэтому словарь не растёт с каждым новым кодом
+    """
+    with CODE_LOCKS_GUARD:
+        entry = CODE_LOCKS.setdefault(code_hash, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with CODE_LOCKS_GUARD:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del CODE_LOCKS[code_hash]
 
 # def evm_disasm(bytecode: str):
 #     from evmdasm import EvmBytecode
@@ -187,122 +251,137 @@ def parse_contract_address(contract_address: str):
 
 #     print("Call-graph:", call_graph)
 
-def evm_simulate_tx(signed_raw: str):
-    from_address = Account.recover_transaction(signed_raw)
-    print(from_address)
-    rpc_w3 = Web3(Web3.HTTPProvider(os.environ.get('RPC_URL')))
-    params = [{
-        "forking": {
-            "jsonRpcUrl": os.environ.get('RPC_URL'),
-            "blockNumber": rpc_w3.eth.get_block_number() - 10
-        }
-    }]
-    w3.manager.request_blocking("hardhat_reset", params)
-    snapshot_id = w3.provider.make_request("evm_snapshot", [])
-    related = set()
+def in_worker_thread(func, *args):
+    """
+    Выполняет func в потоке пула и закрывает соединения с БД, открытые этим потоком
+    """
     try:
-        tx_hash = w3.eth.send_raw_transaction(HexBytes(signed_raw))
-        trace = w3.provider.make_request("debug_traceTransaction", [tx_hash, {}])
-        # print("trace:", trace)
-        for struct in trace["result"]["structLogs"]:
-            op = struct["op"]
-            if op in ("CALL","DELEGATECALL","STATICCALL"):
-                # в простейшем случае адрес лежит в stack[-2] или stack[-3] после PUSH
-                addr_hex = struct["stack"][-2][-40:]
-                related.add("0x" + addr_hex.lower())
-
-    except Exception as e:
-        traceback.print_exc()
+        return func(*args)
     finally:
-        w3.provider.make_request("evm_revert", [snapshot_id])
-        params = [{
-            "forking": {
-                "jsonRpcUrl": os.environ.get('RPC_URL'),
-                "blockNumber": rpc_w3.eth.get_block_number() - 10
+        connections.close_all()
+
+
+def decompile_functions(code_hash: str, related_address: str, functions_dict: dict) -> list:
+    """
+    Декомпилирует функции кода: уже известные (в том числе по другим адресам с тем же кодом) берутся из БД одним запросом,
+    остальные отправляются в LLM конкурентно. Результаты в порядке functions_dict.
+    """
+    existing = {
+        function.function_name: function.function_code
+        for function in DisassembledContractFunction.objects.filter(
+            code_hash=code_hash, function_name__in=list(functions_dict)
+        )
+    }
+    missing = [function_name for function_name in functions_dict if function_name not in existing]
+    if missing:
+        llm_responses = call_openai_functions([functions_dict[function_name] for function_name in missing], "o4-mini")
+        DisassembledContractFunction.objects.bulk_create([
+            DisassembledContractFunction(
+                function_name=function_name,
+                contract_address=related_address,
+                code_hash=code_hash,
+                function_code=llm_response,
+                solidity_code=functions_dict[function_name]
+            )
+            for function_name, llm_response in zip(missing, llm_responses)
+        ], ignore_conflicts=True)
+        existing.update(zip(missing, llm_responses))
+    return [existing[function_name] for function_name in functions_dict]
+
+
+def analyze_contract(related_address: str):
+    """
+    Статический анализ, декомпиляция и диаграмма одного контракта.
+    Возвращает результат статического анализа и схему контракта.
+    """
+    with RPC_SLOTS:
+        code_hash, parsed_contract = resolve_contract_code(related_address)
+    if code_hash is None:
+        # Анализировать нечего: gigahorse и LLM не вызываются
+        return {"functions": {}, "decoded_functions": []}, ""
+    with code_lock(code_hash):
+        return analyze_code(code_hash, related_address, parsed_contract)
+
+
+def analyze_code(code_hash: str, related_address: str, parsed_contract: str = None):
+    contract_static_analysis = ContractStaticAnalysis.objects.filter(code_hash=code_hash).first()
+    if not contract_static_analysis:
+        if parsed_contract is None:
+            with RPC_SLOTS:
+                parsed_contract = parse_contract_address(related_address)
+        raw_disassembled = run_gigahorse_job(parsed_contract)
+        if raw_disassembled is None:
+            raise RuntimeError(f"Static analysis of {related_address} failed")
+        contract_static_analysis, _ = ContractStaticAnalysis.objects.get_or_create(
+            code_hash=code_hash,
+            defaults={
+                "contract_address": related_address,
+                "raw": raw_disassembled,
+                "bytecode_hash": md5(parsed_contract.encode()).hexdigest()
             }
-        }]
-        w3.manager.request_blocking("hardhat_reset", params)
-    
-    print("Взаимодействия с:", related)
-    return related, trace
+        )
+    raw_disassembled = contract_static_analysis.raw
+    contract_output = {}
+    functions_dict = {}
+    current = []
+    in_func = False
+    function_name = ''
+    for line in raw_disassembled.split("\n"):
+        # Начало новой функции
+        if not in_func and '{' in line:
+            function_name = line
+            in_func = True
+            current = []
+
+        if in_func:
+            current.append(line)
+            if '}' in line:
+                functions_dict[function_name] = ''.join(current)
+                in_func = False
+    contract_output["functions"] = functions_dict
+    contract_output["decoded_functions"] = decompile_functions(code_hash, related_address, functions_dict)
+    total_decoded_functions = ""
+    for func in contract_output["decoded_functions"]:
+        total_decoded_functions += f"{func}\n"
+
+    compiled_contract = call_openai_compile_contract(total_decoded_functions, "gpt-4o-mini")
+    return contract_output, call_openai(compiled_contract, "o4-mini-high")
+
 
 def analyze_transaction(signed_raw: str, from_address: str, to_address: str, trace: str = None, pending_transaction: PendingTransaction = None):
+    if not trace and pending_transaction is not None and pending_transaction.trace_artifact_id is not None:
+        # Сохранённый трейс читается потоково из сжатого артефакта, на каждый проход — новый поток
+        trace = pending_transaction.open_trace
     if not trace:
-        related_contracts, trace = evm_simulate_tx(signed_raw)
-        if pending_transaction:
-            pending_transaction.trace = json.dumps(trace)
-            pending_transaction.save()
-    else:
-        trace = json.loads(trace)
-        related_contracts = set()
-        for struct in trace["result"]["structLogs"]:
-            op = struct["op"]
-            if op in ("CALL","DELEGATECALL","STATICCALL"):
-                # в простейшем случае адрес лежит в stack[-2] или stack[-3] после PUSH
-                addr_hex = struct["stack"][-2][-40:]
-                related_contracts.add("0x" + addr_hex.lower())
+        # Трейс сохраняет воркер симуляции; симулировать здесь нельзя — аренда нод hardhat
+        # эксклюзивна только внутри процесса воркера
+        raise RuntimeError("Transaction trace is not available")
+    # Трейс не разбирается целиком: адреса и часть для промпта извлекаются потоково
+    related_contracts = trace_related_contracts(trace)
+    print("Взаимодействия с:", related_contracts)
     static_analysis_output = {}
     schemas = {}
-    for related_address in related_contracts:
-        parsed_contract = parse_contract_address(related_address)
-        bytecode_hash = md5(parsed_contract.encode()).hexdigest()
-        contract_static_analysis = ContractStaticAnalysis.objects.filter(bytecode_hash=bytecode_hash, contract_address=related_address).first()
-        if not contract_static_analysis:
-            run_gigahorse_command(f"cd /app && > {related_address}.hex && echo '{parsed_contract}' >> {related_address}.hex && /opt/gigahorse/gigahorse-toolchain/gigahorse.py {related_address}.hex")
-            run_gigahorse_command(f"cd /app/.temp/{related_address}/out && python3 /opt/gigahorse/gigahorse-toolchain/clients/visualizeout.py")
-            raw_disassembled = run_gigahorse_command(f"cat /app/.temp/{related_address}/out/contract.tac")
-            ContractStaticAnalysis.objects.create(
-                contract_address=related_address,
-                raw=raw_disassembled,
-                bytecode_hash=bytecode_hash
-            )
-        else:
-            raw_disassembled = contract_static_analysis.raw
-        static_analysis_output[related_address] = {}
-        functions_dict = {}
-        current = []
-        in_func = False
-        # print(static_analysis_output[related_address]["raw"])
-        function_name = ''
-        for line in raw_disassembled.split("\n"):
-            # Начало новой функции
-            if not in_func and '{' in line:
-                function_name = line
-                in_func = True
-                current = []
-
-            if in_func:
-                current.append(line)
-                if '}' in line:
-                    functions_dict[function_name] = ''.join(current)
-                    in_func = False
-        static_analysis_output[related_address]["functions"] = functions_dict
-        static_analysis_output[related_address]["decoded_functions"] = []
-        for function_name, function_code in static_analysis_output[related_address]["functions"].items():
-            function_exists = DisassembledContractFunction.objects.filter(function_name=function_name, contract_address=related_address).first()
-            if not function_exists:
-                print(function_name)
-                llm_response = call_openai_one_function(function_code, "o4-mini")
-                DisassembledContractFunction.objects.create(
-                    function_name=function_name,
-                    contract_address=related_address,
-                    function_code=llm_response,
-                    solidity_code=function_code
-                )
-            else:
-                llm_response = function_exists.function_code
-            static_analysis_output[related_address]["decoded_functions"].append(llm_response)
-        total_decoded_functions = ""
-        for func in static_analysis_output[related_address]["decoded_functions"]:
-            total_decoded_functions += f"{func}\n"
-        
-        compiled_contract = call_openai_compile_contract(total_decoded_functions, "gpt-4o-mini")
-        schemas[related_address] = call_openai(compiled_contract, "o4-mini-high")
+    # Контракты анализируются параллельно; доступ к RPC ограничен семафором, очередь gigahorse
+    # ведёт анализатор, запросы к LLM выполняет llm_runner с адаптивным ограничением
+    with ThreadPoolExecutor(max_workers=ANALYZE_CONTRACT_CONCURRENCY) as contract_pool:
+        futures = {
+            related_address: contract_pool.submit(in_worker_thread, analyze_contract, related_address)
+            for related_address in related_contracts
+        }
+        for related_address, future in futures.items():
+            # Ошибка одного контракта не отменяет анализ остальных
+            try:
+                static_analysis_output[related_address], schemas[related_address] = future.result()
+            except Exception as e:
+                traceback.print_exc()
+                static_analysis_output[related_address] = {"error": str(e)}
     result_content = ""
     print(schemas)
     for key, value in schemas.items():
+        if not value:
+            continue
         result_content += f"Диаграма контракта {key}: ```\n{value}\n```\n"
-    result_content += f"Trace транзакции пользователя: ```\n{trace['result']['structLogs']}\n```\n"
+    result_content += f"Trace транзакции пользователя: ```\n{trace_for_prompt(trace)}\n```\n"
     openai_response = call_openai_on_schemas(result_content, "gpt-4o-mini")
     return openai_response, schemas, static_analysis_output, trace
 
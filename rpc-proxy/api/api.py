@@ -1,12 +1,21 @@
 from ninja import NinjaAPI, Schema, Body
 import requests
 import json
-from .models import PendingTransaction, User, UserAdress
+from .models import PendingTransaction, User, UserAdress, normalize_address
 import os
-from .simulate import simulate_transaction
+from .simulate import decode_transaction
+from .upstream import rpc_error
+from .cache import forward_cached, response_cache
+from .coalesce import single_flight
+from .pool import upstream_pool
+from .rejected import rejected_transactions
+from .addresses import watched_addresses
+from .llm_cache import llm_cache
 from .analyze import *
 from typing import Any
+from django.db import IntegrityError
 from web3.auto import Web3
+from asgiref.sync import sync_to_async
 
 
 api = NinjaAPI(title="RPC Proxy API", version="1.0.0")
@@ -15,6 +24,8 @@ TX_METHODS = {
     "eth_sendTransaction",
     "personal_sendTransaction"
 }
+# Методы, которые может перехватить intercept_request; остальные уходят в ноду без похода в sync-код
+INTERCEPTED_METHODS = TX_METHODS | {"eth_getTransactionReceipt"}
 
 @api.get("/")
 def root(request):
@@ -26,8 +37,132 @@ def health(request):
     return {"status": "ok"}
 
 
+@api.get("/stats")
+def stats(request):
+    return {
+        "cache": response_cache.stats(),
+        "coalescing": single_flight.stats(),
+        "upstream": upstream_pool.stats(),
+        "rejected": rejected_transactions.stats(),
+        "watched_addresses": watched_addresses.stats(),
+        "llm_cache": llm_cache.stats(),
+    }
+
+
+def existing_transaction_response(req, existed_tx):
+    """
+    Ответ на повторную отправку уже сохранённой транзакции
+    """
+    if existed_tx.confirmed and not existed_tx.pending:
+        return {
+            "id": req.get("id"),
+            "jsonrpc": "2.0",
+            "result": existed_tx.transaction_id
+        }
+    elif not existed_tx.confirmed and not existed_tx.pending:
+        return {
+            "jsonrpc": "2.0",
+            "value": {
+                "code": -32000,
+                "message": "nonce too low"
+            },
+            "error": {
+                "code": -32000,
+                "message": "nonce too low"
+            },
+            "id": req.get("id")
+        }
+    return {
+        "id": req.get("id"),
+        "jsonrpc": req.get("jsonrpc", "2.0"),
+        "result": existed_tx.transaction_id
+    }
+
+
+def intercept_request(req):
+    """
+    Обрабатывает запросы, которые прокси не отдаёт в ноду напрямую.
+    Возвращает ответ или None, если запрос нужно проксировать.
+    """
+    method = req.get("method")
+    # Проверяем, является ли метод методом отправки транзакции
+    if method == "eth_getTransactionReceipt":
+        # Фильтр отклонённых отвечает на промахи без запроса в БД
+        if rejected_transactions.is_rejected(str(req.get("params")[0])):
+            return {
+                "id": req.get("id"),
+                "jsonrpc": "2.0",
+                "value": {
+                    "code": -32000,
+                    "message": "nonce too low"
+                },
+                "error": {
+                    "code": -32000,
+                    "message": "nonce too low"
+                }
+            }
+        return None
+    if method not in TX_METHODS:
+        return None
+    # Хеш и отправитель вычисляются локально, симуляция выполняется воркером в фоне
+    result, tx_hash, from_address = decode_transaction(req.get("params")[0])
+    watched = watched_addresses.get(from_address)
+    if watched is None:
+        # Отправитель не отслеживается — транзакция уходит в ноду без симуляции
+        return None
+    # Создаем новую транзакцию через наш API
+    # Хеш транзакции — отпечаток подписанных байт, дубликаты ищутся по уникальному индексу
+    existed_tx = PendingTransaction.objects.filter(transaction_id=tx_hash).first()
+    if existed_tx:
+        return existing_transaction_response(req, existed_tx)
+    try:
+        # Воркер симулирует транзакцию и отправит уведомление в telegram
+        transaction_object = PendingTransaction.objects.create(
+            raw_data=req,
+            address_id=watched[0],
+            user_id=watched[1],
+            data=result,
+            raw_transaction=req.get("params")[0],
+            transaction_id=tx_hash
+        )
+        # !!
+        # ATTENTION: Запускайте на свой страх и риск, жрёт очень много времени и денег с OPEN_AI аккаунта!!
+        # !!
+        # analyze_result, schemas, static_analysis_output, trace = analyze_transaction(req.get("params")[0], from_address, result["to"])
+        # transaction_object.analyze_result = analyze_result
+        # transaction_object.schemas = json.dumps(schemas)
+        # transaction_object.static_analysis_output = json.dumps(static_analysis_output)
+        # transaction_object.trace = json.dumps(trace)
+        # transaction_object.save()
+    except IntegrityError:
+        # Тот же повтор мог быть сохранён параллельным запросом. Другие нарушения целостности
+        # (например, адрес удалён в другом процессе) не должны возвращать кошельку хеш
+        # транзакции, которая не сохранена и не отправлена
+        existed_tx = PendingTransaction.objects.filter(transaction_id=tx_hash).first()
+        if existed_tx is None:
+            watched_addresses.invalidate()
+            raise
+        return existing_transaction_response(req, existed_tx)
+    # Формируем ответ клиенту
+    return {
+        "id": req.get("id"),
+        "jsonrpc": req.get("jsonrpc", "2.0"),
+        "result": tx_hash
+    }
+
+
+def intercept_requests(reqs):
+    responses = []
+    for req in reqs:
+        try:
+            responses.append(intercept_request(req))
+        except Exception as e:
+            responses.append(rpc_error(req, -32603, f"Internal error: {str(e)}"))
+    return responses
+
+
 @api.post("/")
-def process_rpc(request):
+async def process_rpc(request):
     """
     Обрабатывает RPC запросы
     """
@@ -42,128 +177,26 @@ def process_rpc(request):
     is_batch = isinstance(body, list)
     requests_from_body = body if is_batch else [body]
     
-    responses = []
-    
-    for req in requests_from_body:
-        method = req.get("method")
-        # Проверяем, является ли метод методом отправки транзакции
-        if method == "eth_getTransactionReceipt":
-            existed_tx = PendingTransaction.objects.filter(transaction_id=req.get("params")[0]).first()
-            if existed_tx and not existed_tx.pending and not existed_tx.confirmed:
-                responses.append({
-                    "id": req.get("id"),
-                    "jsonrpc": "2.0",
-                    "value": {
-                        "code": -32000,
-                        "message": "nonce too low"
-                    },
-                    "error": {
-                        "code": -32000,
-                        "message": "nonce too low"
-                    }
-                })
-                continue
-        if method in TX_METHODS:
-            # Создаем новую транзакцию через наш API
-            existed_tx = PendingTransaction.objects.filter(raw_transaction=req.get("params")[0]).first()
-            if existed_tx:
-                if existed_tx.confirmed and not existed_tx.pending:
-                    responses.append({
-                        "id": req.get("id"),
-                        "jsonrpc": "2.0",
-                        "result": existed_tx.transaction_id
-                    })
-                elif not existed_tx.confirmed and not existed_tx.pending:
-                    responses.append({
-                        "jsonrpc": "2.0",
-                        "value": {
-                            "code": -32000,
-                            "message": "nonce too low"
-                        },
-                        "error": {
-                            "code": -32000,
-                            "message": "nonce too low"
-                        },
-                        "id": req.get("id")
-                    })
-                continue
-            else:
-                result, tx_hash, from_address = simulate_transaction(req.get("params")[0])
-                
-            address = UserAdress.objects.filter(address=from_address).first()
-            if not address:
-                error_msg = f"No such user's address: {str(e)}"
-                responses.append({
-                    "id": req.get("id"),
-                    "jsonrpc": req.get("jsonrpc", "2.0"),
-                    "error": {
-                        "code": -32603,
-                        "message": error_msg
-                    }
-                })
-                continue
-            pending_transaction = PendingTransaction.objects.filter(transaction_id=tx_hash).first()
-            if not pending_transaction:
-                transaction_object = PendingTransaction.objects.create(
-                    raw_data=req,
-                    address=address,
-                    data=result,
-                    raw_transaction=req.get("params")[0],
-                    transaction_id=tx_hash
-                )
-                # !!
-                # ATTENTION: Запускайте на свой страх и риск, жрёт очень много времени и денег с OPEN_AI аккаунта!!
-                # !!
-                # analyze_result, schemas, static_analysis_output, trace = analyze_transaction(req.get("params")[0], from_address, result["to"])
-                # transaction_object.analyze_result = analyze_result
-                # transaction_object.schemas = json.dumps(schemas)
-                # transaction_object.static_analysis_output = json.dumps(static_analysis_output)
-                # transaction_object.trace = json.dumps(trace)
-                # transaction_object.save()
-                requests.post(
-                    "http://telegram-bot:8000/notify-transaction",
-                    json={
-                        "chat_id": address.user.chat_id,
-                        "tx_id": transaction_object.id
-                    }
-                )
-            # Формируем ответ клиенту
-            responses.append({
-                "id": req.get("id"),
-                "jsonrpc": req.get("jsonrpc", "2.0"),
-                "result": tx_hash
-            })
-            
-        else:
-            # Проксируем запрос к Ethereum ноде в асинхронном режиме
-            try:
-                ethereum_response = requests.post(
-                    os.environ.get('RPC_URL'),
-                    json=req,
-                    headers={"Content-Type": "application/json"}
-                )
-                if ethereum_response.status_code == 200:
-                    responses.append(ethereum_response.json())
-                else:
-                    error_msg = f"Ethereum node returned error: {ethereum_response.text}"
-                    responses.append({
-                        "id": req.get("id"),
-                        "jsonrpc": req.get("jsonrpc", "2.0"),
-                        "error": {
-                            "code": ethereum_response.status_code,
-                            "message": error_msg
-                        }
-                    })
-            except Exception as e:
-                error_msg = f"Internal error: {str(e)}"
-                responses.append({
-                    "id": req.get("id"),
-                    "jsonrpc": req.get("jsonrpc", "2.0"),
-                    "error": {
-                        "code": -32603,
-                        "message": error_msg
-                    }
-                })
+    # Разделяем batch на перехватываемые запросы и запросы, которые уходят в ноду.
+    # sync_to_async выполняет код в одном общем потоке, поэтому в него попадают
+    # только запросы перехватываемых методов, а чтения (eth_call, eth_getBalance, ...) его не ждут
+    responses = [None] * len(requests_from_body)
+    intercepted = [
+        index for index, req in enumerate(requests_from_body)
+        if isinstance(req, dict) and req.get("method") in INTERCEPTED_METHODS
+    ]
+    if intercepted:
+        intercepted_responses = await sync_to_async(intercept_requests)(
+            [requests_from_body[index] for index in intercepted]
+        )
+        for index, response in zip(intercepted, intercepted_responses):
+            responses[index] = response
+    passthrough = [index for index, response in enumerate(responses) if response is None]
+
+    # Проксируем остальные запросы к Ethereum ноде одним batch-ем
+    forwarded = await forward_cached([requests_from_body[index] for index in passthrough])
+    for index, response in zip(passthrough, forwarded):
+        responses[index] = response
     
     # Возвращаем результат в соответствующем формате (batch или single)
     return responses if is_batch else responses[0] 
@@ -190,8 +223,16 @@ def new_user(request, payload: NewUserInput):
 def resimulate_latest_transaction(request):
     try:
         latest_transaction = PendingTransaction.objects.filter(pending=True).order_by('-id').first()
+        if latest_transaction and latest_transaction.trace_artifact_id is None:
+            # Симулирует только воркер: ноды hardhat арендуются эксклюзивно лишь внутри процесса,
+            # и hardhat_reset отсюда сломал бы симуляцию воркера на той же ноде
+            latest_transaction.simulation_status = PendingTransaction.SIMULATION_QUEUED
+            latest_transaction.simulate_after = None
+            latest_transaction.simulation_attempts = 0
+            latest_transaction.save(update_fields=['simulation_status', 'simulate_after', 'simulation_attempts', 'updated_at'])
+            return {"status": "queued", "message": "Transaction has no trace yet, queued for simulation"}
         if latest_transaction:
-            response, schemas, static_analysis_output, _ = analyze_transaction(latest_transaction.raw_transaction, latest_transaction.address.address, latest_transaction.data["to"], trace=latest_transaction.trace, pending_transaction=latest_transaction)
+            response, schemas, static_analysis_output, _ = analyze_transaction(latest_transaction.raw_transaction, latest_transaction.address.address, latest_transaction.data["to"], pending_transaction=latest_transaction)
             latest_transaction.analyze_result = response
             latest_transaction.schemas = json.dumps(schemas)
             latest_transaction.static_analysis_output = json.dumps(static_analysis_output)
@@ -224,6 +265,7 @@ def add_address(request, payload: AddAddressInput):
     try:
         user = User.objects.get(telegram_id=payload.user_id)
         UserAdress.objects.create(user=user, address=payload.address)
+        watched_addresses.invalidate()
         return {"status": "success"}
     except Exception as e:
         return {"status": "error", "message": str(e)}
@@ -240,8 +282,10 @@ class RemoveAddressOutput(Schema):
 def remove_address(request, payload: RemoveAddressInput):
     try:
         user = User.objects.get(telegram_id=payload.user_id)
-        address = UserAdress.objects.get(user=user, address=payload.address)
-        address.delete()
+        deleted, _ = UserAdress.objects.filter(user=user, normalized_address=normalize_address(payload.address)).delete()
+        watched_addresses.invalidate()
+        if not deleted:
+            return {"status": "error", "message": "Address not found"}
         return {"status": "success"}
     except Exception as e:
         return {"status": "error", "message": str(e)}
@@ -282,6 +326,63 @@ def get_pending_transactions(request, payload: GetPendingTransactionsInput):
         return {"status": "error", "message": str(e)}
 
 
+class ListPendingTransactionsInput(Schema):
+    user_id: str
+    cursor: int | None = None
+    limit: int = 20
+
+class PendingTransactionSummary(Schema):
+    id: int
+    transaction: dict
+    pending: bool
+    confirmed: bool
+    simulation_status: str | None = None
+
+class ListPendingTransactionsOutput(Schema):
+    status: str
+    transactions: list[PendingTransactionSummary] | None = None
+    next_cursor: int | None = None
+    message: str | None = None
+
+PENDING_TRANSACTIONS_MAX_LIMIT = 100
+
+@api.post("/list_pending_transactions", response=ListPendingTransactionsOutput)
+def list_pending_transactions(request, payload: ListPendingTransactionsInput):
+    """
+    Сводки ожидающих транзакций пользователя одним запросом.
+    Пагинация по курсору: next_cursor — id последней транзакции страницы.
+    """
+    try:
+        limit = max(1, min(payload.limit, PENDING_TRANSACTIONS_MAX_LIMIT))
+        pending_transactions = (
+            PendingTransaction.objects
+            .filter(user__telegram_id=payload.user_id, pending=True)
+            .only('id', 'data', 'pending', 'confirmed', 'simulation_status')
+            .order_by('id')
+        )
+        if payload.cursor is not None:
+            pending_transactions = pending_transactions.filter(id__gt=payload.cursor)
+        page = list(pending_transactions[:limit + 1])
+        has_more = len(page) > limit
+        page = page[:limit]
+        return {
+            "status": "success",
+            "transactions": [
+                {
+                    "id": transaction.id,
+                    "transaction": transaction.data,
+                    "pending": transaction.pending,
+                    "confirmed": transaction.confirmed,
+                    "simulation_status": transaction.simulation_status,
+                }
+                for transaction in page
+            ],
+            "next_cursor": page[-1].id if has_more else None,
+        }
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
 class GetTransactionInput(Schema):
     tx_id: Any
 
@@ -290,13 +391,20 @@ class GetTransactionOutput(Schema):
     transaction: dict
     pending: bool
     confirmed: bool
+    simulation_status: str | None = None
     message: str | None = None
 
 @api.post("/get_transaction", response=GetTransactionOutput)
 def get_transaction(request, payload: GetTransactionInput):
     try:
         transaction = PendingTransaction.objects.get(id=payload.tx_id)
-        return {"status": "success", "transaction": transaction.data, "pending": transaction.pending, "confirmed": transaction.confirmed}
+        return {
+            "status": "success",
+            "transaction": transaction.data,
+            "pending": transaction.pending,
+            "confirmed": transaction.confirmed,
+            "simulation_status": transaction.simulation_status,
+        }
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
@@ -314,22 +422,10 @@ def confirm_transaction(request, payload: ConfirmTransactionInput):
         transaction = PendingTransaction.objects.get(id=payload.tx_id)
         transaction.confirmed = True
         transaction.pending = False
-        transaction.save()
+        transaction.save(update_fields=['pending', 'confirmed', 'updated_at'])
+        rejected_transactions.discard(transaction.transaction_id)
         # send web3 raw transaction
-        requests.post(
-            os.environ.get('RPC_URL'),
-            json=transaction.raw_data,
-            headers={"Content-Type": "application/json"}
-        )
-        rpc_w3 = Web3(Web3.HTTPProvider(os.environ.get('RPC_URL')))
-        params = [{
-            "forking": {
-                "jsonRpcUrl": os.environ.get('RPC_URL'),
-                "blockNumber": rpc_w3.eth.get_block_number() - 10
-            }
-        }]
-        w3 = Web3(Web3.HTTPProvider("http://hardhat-network:8545", request_kwargs={"timeout": 100}))
-        w3.manager.request_blocking("hardhat_reset", params)
+        upstream_pool.post_sync(transaction.raw_data)
         return {"status": "success"}
     except Exception as e:
         return {"status": "error", "message": str(e)}
@@ -348,7 +444,8 @@ def reject_transaction(request, payload: RejectTransactionInput):
         transaction = PendingTransaction.objects.get(id=payload.tx_id)
         transaction.pending = False
         transaction.confirmed = False
-        transaction.save()
+        transaction.save(update_fields=['pending', 'confirmed', 'updated_at'])
+        rejected_transactions.add(transaction.transaction_id)
         return {"status": "success"}
     except Exception as e:
         return {"status": "error", "message": str(e)}
@@ -0,0 +1,33 @@
+import hashlib
+import io
+import os
+import zstandard
+
+
+# Уровень сжатия zstd для трейсов и результатов анализа
+ARTIFACT_COMPRESSION_LEVEL = int(os.environ.get('ARTIFACT_COMPRESSION_LEVEL', '9'))
+# Как часто удалять артефакты, на которые не ссылается ни одна запись, и минимальный их возраст
+ARTIFACT_GC_INTERVAL = float(os.environ.get('ARTIFACT_GC_INTERVAL', '3600'))
+ARTIFACT_GC_MIN_AGE = float(os.environ.get('ARTIFACT_GC_MIN_AGE', '3600'))
+
+
+def artifact_digest(content: bytes) -> str:
+    """
+    Адрес артефакта — sha256 несжатого содержимого, одинаковые артефакты хранятся один раз
+    """
+    return hashlib.sha256(content).hexdigest()
+
+
+def compress(content: bytes) -> bytes:
+    return zstandard.ZstdCompressor(level=ARTIFACT_COMPRESSION_LEVEL).compress(content)
+
+
+def decompress(data: bytes) -> bytes:
+    return zstandard.ZstdDecompressor().decompress(bytes(data))
+
+
+def decompress_stream(data):
+    """
+    Поток распакованных байт: большой трейс не распаковывается в память целиком
+    """
+    return zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data))
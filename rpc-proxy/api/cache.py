@@ -0,0 +1,239 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from .upstream import forward_request, request_key
+from .coalesce import forward_coalesced
+
+
+# Лимит памяти под закешированные ответы (примерно, по размеру JSON)
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+# Как часто (в секундах) проверять номер последнего блока
+CACHE_HEAD_TTL = float(os.environ.get('CACHE_HEAD_TTL', '2'))
+# Сколько блоков под головой цепи ещё может быть реорганизовано: ответы по таким блокам
+# кешируются только до следующего блока, как latest
+CACHE_REORG_DEPTH = int(os.environ.get('CACHE_REORG_DEPTH', '64'))
+
+# Ответы, которые не меняются никогда
+IMMUTABLE = "immutable"
+# Ответы, которые актуальны только до следующего блока
+LATEST = "latest"
+
+# Методы, ответы на которые не зависят от блока
+CHAIN_METHODS = {"eth_chainId", "net_version"}
+# Методы, у которых блок передаётся последним параметром
+BLOCK_SCOPED_METHODS = {
+    "eth_call": 1,
+    "eth_getBalance": 1,
+    "eth_getCode": 1,
+}
+BLOCK_TAGS = {"latest", "safe", "finalized"}
+
+
+def number_scope(number: str, head: int | None) -> str | None:
+    """
+    Номер блока не меняется, только если блок на CACHE_REORG_DEPTH глубже головы цепи.
+    Без известной головы и у свежих блоков ответ привязывается к голове, как latest
+    """
+    try:
+        number = int(number, 16)
+    except ValueError:
+        return None
+    if head is not None and number <= head - CACHE_REORG_DEPTH:
+        return IMMUTABLE
+    return LATEST
+
+
+def block_scope(block, head: int | None = None) -> str | None:
+    """
+    Определяет, к какому блоку привязан запрос: хеш блока и старый номер — навсегда,
+    тег latest и недавний номер — до следующего блока, pending — не кешируется
+    """
+    if block is None:
+        return LATEST
+    if isinstance(block, dict):
+        if block.get("blockHash"):
+            return IMMUTABLE
+        return number_scope(block["blockNumber"], head) if isinstance(block.get("blockNumber"), str) else None
+    if not isinstance(block, str):
+        return None
+    block = block.lower()
+    if block in BLOCK_TAGS:
+        return LATEST
+    if block == "earliest":
+        return IMMUTABLE
+    if block.startswith("0x"):
+        return number_scope(block, head)
+    return None
+
+
+def request_scope(req: dict, head: int | None = None) -> str | None:
+    """
+    Возвращает область кеширования запроса или None, если запрос не кешируется.
+    head — номер последнего блока, если он уже известен
+    """
+    method = req.get("method")
+    params = req.get("params") or []
+    if method in CHAIN_METHODS:
+        return IMMUTABLE
+    if method == "eth_getTransactionByHash":
+        return IMMUTABLE
+    if method == "eth_getBlockByNumber":
+        return block_scope(params[0] if params else None, head)
+    if method in BLOCK_SCOPED_METHODS:
+        position = BLOCK_SCOPED_METHODS[method]
+        block = params[position] if len(params) > position else None
+        if method == "eth_getCode" and block_scope(block, head) == LATEST:
+            # Код контракта не меняется после деплоя, но пустой ответ может измениться
+            return IMMUTABLE
+        return block_scope(block, head)
+    return None
+
+
+def is_cacheable(req: dict, scope: str, result) -> bool:
+    """
+    Проверяет, можно ли кешировать конкретный ответ ноды
+    """
+    method = req.get("method")
+    if result is None:
+        # Блок или транзакция ещё не существуют
+        return False
+    if method == "eth_getTransactionByHash":
+        # Кешируем только уже смайненные транзакции
+        return bool(result.get("blockNumber"))
+    if method == "eth_getCode" and scope == IMMUTABLE and result in ("0x", ""):
+        return False
+    return True
+
+
+class ResponseCache:
+    """
+    LRU-кеш ответов ноды с ограничением по памяти
+    """
+
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str, head: int | None = None):
+        """
+        Возвращает (True, result) при попадании; для записей latest проверяет, что блок не сменился
+        """
+        entry = self.entries.get(key)
+        if entry is None or (entry[2] is not None and entry[2] != head):
+            if entry is not None:
+                self.pop(key)
+            self.misses += 1
+            return False, None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return True, entry[0]
+
+    def set(self, key: str, result, head: int | None = None):
+        size = len(key) + len(json.dumps(result))
+        if size > self.max_bytes:
+            return
+        self.pop(key)
+        self.entries[key] = (result, size, head)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted_size, _) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def pop(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def drop_latest(self, head: int):
+        """
+        Удаляет записи latest, которые относятся к предыдущим блокам
+        """
+        for key in [key for key, entry in self.entries.items() if entry[2] is not None and entry[2] != head]:
+            self.pop(key)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "size": self.size,
+            "max_size": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class HeadTracker:
+    """
+    Отслеживает номер последнего блока, опрашивая ноду не чаще раза в CACHE_HEAD_TTL секунд
+    """
+
+    def __init__(self, ttl: float = CACHE_HEAD_TTL):
+        self.ttl = ttl
+        self.head = None
+        self.checked_at = 0.0
+        self.lock = None
+
+    async def current(self) -> int | None:
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if time.monotonic() - self.checked_at < self.ttl:
+                return self.head
+            response = await forward_request({"jsonrpc": "2.0", "id": 0, "method": "eth_blockNumber", "params": []})
+            self.checked_at = time.monotonic()
+            try:
+                head = int(response["result"], 16)
+            except (KeyError, TypeError, ValueError):
+                self.head = None
+                return None
+            if head != self.head:
+                self.head = head
+                response_cache.drop_latest(head)
+            return self.head
+
+
+response_cache = ResponseCache()
+head_tracker = HeadTracker()
+
+
+async def forward_cached(reqs: list) -> list:
+    """
+    Отвечает на кешируемые запросы из кеша, остальные проксирует в ноду
+    """
+    responses = [None] * len(reqs)
+    misses = []
+    for index, req in enumerate(reqs):
+        scope = request_scope(req)
+        if scope is None:
+            misses.append((index, None, None, None))
+            continue
+        head = await head_tracker.current() if scope == LATEST else None
+        if scope == LATEST and head is None:
+            misses.append((index, None, None, None))
+            continue
+        if scope == LATEST:
+            # Номер блока достаточно глубоко под головой кешируется навсегда
+            scope = request_scope(req, head)
+            head = head if scope == LATEST else None
+        key = request_key(req)
+        hit, result = response_cache.get(key, head)
+        if hit:
+            responses[index] = {"jsonrpc": req.get("jsonrpc", "2.0"), "id": req.get("id"), "result": result}
+        else:
+            misses.append((index, scope, key, head))
+
+    forwarded = await forward_coalesced([reqs[index] for index, _, _, _ in misses])
+    for (index, scope, key, head), response in zip(misses, forwarded):
+        responses[index] = response
+        if scope and "result" in response and is_cacheable(reqs[index], scope, response["result"]):
+            response_cache.set(key, response["result"], head)
+    return responses
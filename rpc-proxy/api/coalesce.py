@@ -0,0 +1,85 @@
+import asyncio
+from .upstream import forward_requests, has_side_effects, request_key
+
+
+class SingleFlight:
+    """
+    Объединяет одновременные одинаковые запросы к ноде в один вызов.
+    Ключ — метод и нормализованные параметры, id каждого клиента сохраняется в его ответе.
+    """
+
+    def __init__(self):
+        self.inflight = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def forward(self, reqs: list) -> list:
+        loop = asyncio.get_running_loop()
+        responses = [None] * len(reqs)
+        own = []
+        waits = []
+        for index, req in enumerate(reqs):
+            if has_side_effects(req):
+                own.append((index, None, None))
+                continue
+            key = request_key(req)
+            future = self.inflight.get(key)
+            if future is not None:
+                # Такой же запрос уже отправлен (другим клиентом или ранее в этом batch)
+                waits.append((index, future))
+                self.followers += 1
+                continue
+            future = loop.create_future()
+            self.inflight[key] = future
+            own.append((index, key, future))
+            self.leaders += 1
+
+        # Вызов ноды идёт отдельной задачей: отмена запроса лидера (клиент отключился)
+        # не должна обрывать ответ для других клиентов, ждущих тот же запрос
+        call = asyncio.ensure_future(forward_requests([reqs[index] for index, _, _ in own]))
+        call.add_done_callback(lambda call: self.settle(call, own))
+        forwarded = await asyncio.shield(call)
+        for (index, _, _), response in zip(own, forwarded):
+            responses[index] = response
+
+        for index, future in waits:
+            response = await asyncio.shield(future)
+            responses[index] = {**response, "id": reqs[index].get("id")}
+        return responses
+
+    def settle(self, call: asyncio.Future, own: list):
+        """
+        Раздаёт результат вызова ноды ожидающим запросам и освобождает ключи
+        """
+        for _, key, future in own:
+            if key is not None and self.inflight.get(key) is future:
+                del self.inflight[key]
+        if call.cancelled():
+            # CancelledError в общем Future отменил бы чужие запросы
+            error = RuntimeError("Upstream request was cancelled")
+        else:
+            error = call.exception()
+        forwarded = call.result() if error is None else [None] * len(own)
+        for (_, _, future), response in zip(own, forwarded):
+            if future is None or future.done():
+                continue
+            if error is None:
+                future.set_result(response)
+            else:
+                future.set_exception(error)
+                # Исключение забирают ожидающие запросы, если они есть
+                future.exception()
+
+    def stats(self) -> dict:
+        return {
+            "inflight": len(self.inflight),
+            "upstream_calls": self.leaders,
+            "coalesced": self.followers,
+        }
+
+
+single_flight = SingleFlight()
+
+
+async def forward_coalesced(reqs: list) -> list:
+    return await single_flight.forward(reqs)
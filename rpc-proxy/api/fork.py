@@ -0,0 +1,269 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from web3 import Web3
+from .pool import upstream_pool
+
+
+logger = logging.getLogger(__name__)
+
+SIMULATION_NODE_URL = os.environ.get('SIMULATION_NODE_URL', 'http://hardhat-network:8545')
+# Пул нод для симуляций (hardhat или anvil) через запятую
+SIMULATION_NODE_URLS = [url.strip() for url in os.environ.get('SIMULATION_NODE_URLS', SIMULATION_NODE_URL).split(',') if url.strip()]
+# Сколько секунд ждать свободную ноду
+SIMULATION_LEASE_TIMEOUT = float(os.environ.get('SIMULATION_LEASE_TIMEOUT', '60'))
+# Форк делается на столько блоков назад от головы сети
+FORK_BLOCK_OFFSET = int(os.environ.get('FORK_BLOCK_OFFSET', '10'))
+# Перефорк выполняется, когда голова сети ушла вперёд на столько блоков
+FORK_REFRESH_BLOCKS = int(os.environ.get('FORK_REFRESH_BLOCKS', '50'))
+# Как часто проверять, не пора ли перефоркнуться
+FORK_REFRESH_INTERVAL = float(os.environ.get('FORK_REFRESH_INTERVAL', '15'))
+FORK_REQUEST_TIMEOUT = float(os.environ.get('FORK_REQUEST_TIMEOUT', '120'))
+
+
+class ForkManager:
+    """
+    Держит форк hardhat прогретым: после форка делается снапшот, и каждая симуляция
+    откатывается к нему вместо hardhat_reset, сохраняя кеш состояния, подтянутого из сети.
+    Перефорк выполняется в фоне, только когда голова сети ушла на FORK_REFRESH_BLOCKS блоков
+    и нода свободна.
+    """
+
+    def __init__(self, url: str = SIMULATION_NODE_URL):
+        self.url = url
+        self.w3 = Web3(Web3.HTTPProvider(url, request_kwargs={"timeout": FORK_REQUEST_TIMEOUT}))
+        self.lock = threading.Lock()
+        self.snapshot_id = None
+        self.fork_block = None
+        self.forked_at = None
+        self.refresher = None
+        self.resets = 0
+        self.simulations = 0
+        self.healthy = True
+        self.last_error = None
+
+    def head_block(self) -> int:
+        rpc_w3 = Web3(Web3.HTTPProvider(upstream_pool.best_url()))
+        return rpc_w3.eth.get_block_number()
+
+    def reset(self):
+        """
+        Перефоркивает ноду и делает чистый снапшот. Вызывается только под self.lock.
+        """
+        started = time.monotonic()
+        block = self.head_block() - FORK_BLOCK_OFFSET
+        params = [{
+            "forking": {
+                "jsonRpcUrl": upstream_pool.best_url(),
+                "blockNumber": block
+            }
+        }]
+        self.snapshot_id = None
+        self.w3.manager.request_blocking("hardhat_reset", params)
+        self.snapshot_id = self.w3.manager.request_blocking("evm_snapshot", [])
+        self.fork_block = block
+        self.forked_at = time.time()
+        self.resets += 1
+        logger.info(f"Форк {self.url} обновлён до блока {block} за {time.monotonic() - started:.1f} с")
+
+    def restore(self):
+        """
+        Откатывает ноду к чистому снапшоту. evm_revert удаляет снапшот, поэтому делается новый.
+        """
+        try:
+            reverted = self.w3.manager.request_blocking("evm_revert", [self.snapshot_id])
+            self.snapshot_id = self.w3.manager.request_blocking("evm_snapshot", []) if reverted else None
+        except Exception as e:
+            logger.error(f"Не удалось откатить форк {self.url}: {str(e)}")
+            self.mark_unhealthy(e)
+            self.snapshot_id = None
+
+    @contextmanager
+    def simulation(self, stateless: bool = False):
+        """
+        Даёт доступ к прогретому форку; после выхода состояние откатывается.
+        Для вызовов, не меняющих состояние (debug_traceCall), откат не нужен.
+        Вызывается под self.lock, который берёт SimulatorPool при выборе ноды.
+        """
+        if self.snapshot_id is None:
+            # Первый запуск или неудачный откат — без форка симулировать нельзя
+            try:
+                self.reset()
+            except Exception as e:
+                self.mark_unhealthy(e)
+                raise
+        self.simulations += 1
+        try:
+            yield self.w3
+        finally:
+            if not stateless:
+                self.restore()
+
+    def mark_unhealthy(self, error: Exception):
+        self.healthy = False
+        self.last_error = str(error)
+
+    def check_health(self):
+        """
+        Нода снова считается здоровой, как только отвечает на запросы
+        """
+        try:
+            self.w3.eth.get_block_number()
+            self.healthy = True
+        except Exception as e:
+            self.mark_unhealthy(e)
+
+    def needs_refresh(self) -> bool:
+        if self.fork_block is None:
+            return True
+        return self.head_block() - FORK_BLOCK_OFFSET - self.fork_block >= FORK_REFRESH_BLOCKS
+
+    def refresh(self) -> bool:
+        """
+        Перефоркивает ноду, если голова ушла вперёд и нода сейчас не занята симуляцией
+        """
+        try:
+            if not self.needs_refresh():
+                return False
+        except Exception as e:
+            logger.error(f"Не удалось получить номер блока: {str(e)}")
+            return False
+        if not self.lock.acquire(blocking=False):
+            return False
+        try:
+            self.reset()
+            return True
+        except Exception as e:
+            logger.error(f"Не удалось обновить форк {self.url}: {str(e)}")
+            self.mark_unhealthy(e)
+            self.snapshot_id = None
+            return False
+        finally:
+            self.lock.release()
+
+    def refresh_loop(self):
+        while True:
+            self.check_health()
+            self.refresh()
+            time.sleep(FORK_REFRESH_INTERVAL)
+
+    def start(self):
+        """
+        Запускает фоновое обновление форка
+        """
+        if self.refresher is None or not self.refresher.is_alive():
+            self.refresher = threading.Thread(target=self.refresh_loop, name=f"fork-refresher-{self.url}", daemon=True)
+            self.refresher.start()
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "fork_block": self.fork_block,
+            "forked_at": self.forked_at,
+            "warm": self.snapshot_id is not None,
+            "busy": self.lock.locked(),
+            "healthy": self.healthy,
+            "last_error": self.last_error,
+            "resets": self.resets,
+            "simulations": self.simulations,
+        }
+
+
+class SimulatorPool:
+    """
+    Пул нод для симуляций. Каждая симуляция получает эксклюзивную аренду одной ноды,
+    поэтому параллельные симуляции не портят состояние друг друга.
+    """
+
+    def __init__(self, urls: list):
+        self.nodes = [ForkManager(url) for url in urls]
+        self.idle = list(self.nodes)
+        self.condition = threading.Condition()
+        self.started_at = time.monotonic()
+        self.leases = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.busy_total = 0.0
+        self.waiting = 0
+
+    def pick(self):
+        """
+        Свободная здоровая нода, которая сейчас не перефоркивается. Блокировка ноды берётся
+        здесь же без ожидания: проверка locked() с захватом позже оставляла окно, в которое
+        успевал войти перефорк. Возвращённую ноду освобождает release.
+        """
+        # Здоровые и прогретые ноды в приоритете: на холодной придётся ждать форк.
+        # Если все ноды нездоровы, пробуем любую: ошибка всё равно уйдёт в повтор задачи
+        for node in sorted(self.idle, key=lambda node: (not node.healthy, node.snapshot_id is None)):
+            if node.lock.acquire(blocking=False):
+                return node
+        return None
+
+    def acquire(self, timeout: float) -> ForkManager:
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            self.waiting += 1
+            try:
+                while True:
+                    node = self.pick()
+                    if node is not None:
+                        self.idle.remove(node)
+                        return node
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise TimeoutError(f"No free simulation node in {timeout} s")
+                    # Нода, закончившая перефорк, не сигналит, поэтому ждём с коротким интервалом
+                    self.condition.wait(min(remaining, 0.5))
+            finally:
+                self.waiting -= 1
+
+    def release(self, node: ForkManager):
+        node.lock.release()
+        with self.condition:
+            self.idle.append(node)
+            self.condition.notify()
+
+    @contextmanager
+    def lease(self, timeout: float = SIMULATION_LEASE_TIMEOUT, stateless: bool = False):
+        """
+        Арендует ноду и даёт прогретый форк; после выхода состояние откатывается
+        """
+        started = time.monotonic()
+        node = self.acquire(timeout)
+        waited = time.monotonic() - started
+        leased_at = time.monotonic()
+        with self.condition:
+            self.leases += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        try:
+            with node.simulation(stateless) as w3:
+                yield w3
+        finally:
+            with self.condition:
+                self.busy_total += time.monotonic() - leased_at
+            self.release(node)
+
+    def start(self):
+        for node in self.nodes:
+            node.start()
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self.started_at
+        return {
+            "nodes": [node.stats() for node in self.nodes],
+            "idle": len(self.idle),
+            "waiting": self.waiting,
+            "leases": self.leases,
+            "timeouts": self.timeouts,
+            "wait_avg": self.wait_total / self.leases if self.leases else 0.0,
+            "wait_max": self.wait_max,
+            "utilization": self.busy_total / (elapsed * len(self.nodes)) if elapsed and self.nodes else 0.0,
+        }
+
+
+simulator_pool = SimulatorPool(SIMULATION_NODE_URLS)
@@ -0,0 +1,285 @@
+import asyncio
+import os
+import re
+import threading
+import time
+import openai
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from .llm_cache import llm_cache, prompt_key
+
+
+# Максимум одновременных запросов к LLM; фактический предел подстраивается по 429
+LLM_CONCURRENCY = int(os.environ.get('LLM_CONCURRENCY', '8'))
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', '6'))
+# Базовая задержка повтора, если API не сообщил, сколько ждать
+LLM_RETRY_DELAY = float(os.environ.get('LLM_RETRY_DELAY', '1'))
+LLM_TIMEOUT = float(os.environ.get('LLM_TIMEOUT', '600'))
+# Упаковка мелких функций в один запрос: лимит по оценке токенов и по числу функций
+LLM_PACK_MAX_TOKENS = int(os.environ.get('LLM_PACK_MAX_TOKENS', '3000'))
+LLM_PACK_MAX_FUNCTIONS = int(os.environ.get('LLM_PACK_MAX_FUNCTIONS', '8'))
+
+FUNCTION_MARKER = "### FUNCTION"
+FUNCTION_MARKER_RE = re.compile(rf"^\s*{FUNCTION_MARKER} (\d+)\s*$", re.MULTILINE)
+DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value: str | None) -> float | None:
+    """
+    Длительность из заголовков rate limit OpenAI: "20ms", "1s", "6m0s"
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_RE.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def retry_delay(headers) -> float | None:
+    if headers is None:
+        return None
+    if headers.get("retry-after-ms"):
+        return float(headers["retry-after-ms"]) / 1000
+    return parse_duration(headers.get("retry-after"))
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+class AdaptiveLimiter:
+    """
+    Ограничитель параллельности (AIMD): при 429 предел уменьшается вдвое,
+    после серии успешных запросов растёт на единицу. Если заголовки rate limit
+    говорят, что лимит исчерпан, новые запросы ждут его сброса.
+    """
+
+    def __init__(self, max_limit: int = LLM_CONCURRENCY):
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.inflight = 0
+        self.successes = 0
+        self.paused_until = 0.0
+        self.condition = None
+        self.rate_limited = 0
+
+    async def acquire(self):
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        async with self.condition:
+            while True:
+                delay = self.paused_until - time.monotonic()
+                if delay <= 0 and self.inflight < self.limit:
+                    self.inflight += 1
+                    return
+                try:
+                    await asyncio.wait_for(self.condition.wait(), delay if delay > 0 else None)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self):
+        async with self.condition:
+            self.inflight -= 1
+            self.condition.notify_all()
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def succeeded(self, headers):
+        self.successes += 1
+        if self.successes >= self.limit and self.limit < self.max_limit:
+            self.limit += 1
+            self.successes = 0
+        if headers is None:
+            return
+        for kind in ("requests", "tokens"):
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if remaining is not None and remaining.isdigit() and int(remaining) == 0:
+                self.pause(parse_duration(headers.get(f"x-ratelimit-reset-{kind}")) or LLM_RETRY_DELAY)
+
+    def throttled(self, headers, attempt: int):
+        self.rate_limited += 1
+        self.successes = 0
+        self.limit = max(1, self.limit // 2)
+        self.pause(retry_delay(headers) or LLM_RETRY_DELAY * 2 ** attempt)
+
+
+class LLMRunner:
+    """
+    Асинхронный слой запросов к LLM. Свой event loop в отдельном потоке позволяет
+    вызывать его из синхронного кода (анализ, воркеры) и при этом выполнять запросы конкурентно.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.client = None
+        self.limiter = AdaptiveLimiter()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.packed_requests = 0
+        self.packed_functions = 0
+
+    def ensure_loop(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.loop.run_forever, name="llm-runner", daemon=True)
+                self.thread.start()
+        return self.loop
+
+    def get_client(self) -> AsyncOpenAI:
+        if self.client is None:
+            self.client = AsyncOpenAI(
+                api_key=os.environ.get("OPENAI_API_KEY"),
+                http_client=DefaultAsyncHttpxClient(proxy=os.environ.get("SOCKS_URL")),
+                # Повторы выполняются здесь, чтобы учитывать их в ограничителе
+                max_retries=0,
+                timeout=LLM_TIMEOUT
+            )
+        return self.client
+
+    def run(self, coroutine):
+        """
+        Выполняет корутину в потоке LLM и ждёт результат
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.ensure_loop()).result()
+
+    async def complete(self, messages: list, model: str, **kwargs) -> str:
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            await self.limiter.acquire()
+            try:
+                self.requests += 1
+                raw = await self.get_client().chat.completions.with_raw_response.create(model=model, messages=messages, **kwargs)
+                self.limiter.succeeded(raw.headers)
+                return raw.parse().choices[0].message.content
+            except openai.RateLimitError as e:
+                if attempt == LLM_MAX_RETRIES:
+                    raise
+                self.limiter.throttled(e.response.headers, attempt)
+            except (openai.APIConnectionError, openai.InternalServerError):
+                if attempt == LLM_MAX_RETRIES:
+                    raise
+                await asyncio.sleep(LLM_RETRY_DELAY * 2 ** attempt)
+            finally:
+                await self.limiter.release()
+
+    def complete_sync(self, messages: list, model: str, **kwargs) -> str:
+        key = prompt_key(model, messages, kwargs)
+        cached = llm_cache.get(key)
+        if cached is not None:
+            return cached
+        response = self.run(self.complete(messages, model, **kwargs))
+        llm_cache.put(model, key, response)
+        return response
+
+    async def complete_packed(self, system: str, prompt: str, contents: list, model: str, **kwargs) -> list:
+        """
+        Отправляет несколько фрагментов одним запросом, разделяя их маркерами.
+        Фрагменты, которых нет в ответе, запрашиваются по отдельности.
+        """
+        if len(contents) == 1:
+            return [await self.complete(single_messages(system, prompt, contents[0]), model, **kwargs)]
+        self.packed_requests += 1
+        self.packed_functions += len(contents)
+        packed = "\n".join(f"{FUNCTION_MARKER} {index}\n{content}" for index, content in enumerate(contents))
+        instruction = (
+            f"Ниже несколько функций, каждая начинается со строки-маркера `{FUNCTION_MARKER} N`. "
+            f"Ответ для каждой функции начинай с той же строки-маркера `{FUNCTION_MARKER} N`.\n"
+        )
+        response = await self.complete(single_messages(system, prompt, packed, instruction), model, **kwargs)
+        results = split_packed(response, len(contents))
+        missing = [index for index, result in enumerate(results) if result is None]
+        retried = await asyncio.gather(*(
+            self.complete(single_messages(system, prompt, contents[index]), model, **kwargs) for index in missing
+        ))
+        for index, result in zip(missing, retried):
+            results[index] = result
+        return results
+
+    async def complete_many(self, system: str, prompt: str, contents: list, model: str, **kwargs) -> list:
+        """
+        Обрабатывает список фрагментов конкурентно, упаковывая мелкие в общие запросы.
+        Результаты возвращаются в порядке contents.
+        """
+        packs = pack_contents(contents)
+        responses = await asyncio.gather(*(
+            self.complete_packed(system, prompt, [contents[index] for index in pack], model, **kwargs) for pack in packs
+        ))
+        results = [None] * len(contents)
+        for pack, pack_results in zip(packs, responses):
+            for index, result in zip(pack, pack_results):
+                results[index] = result
+        return results
+
+    def complete_many_sync(self, system: str, prompt: str, contents: list, model: str, **kwargs) -> list:
+        """
+        Ключ кеша считается для каждого фрагмента как для отдельного запроса,
+        поэтому ответ не зависит от того, с какими фрагментами он был упакован
+        """
+        keys = [prompt_key(model, single_messages(system, prompt, content), kwargs) for content in contents]
+        cached = llm_cache.get_many(keys)
+        missing = [index for index, key in enumerate(keys) if key not in cached]
+        if missing:
+            responses = self.run(self.complete_many(system, prompt, [contents[index] for index in missing], model, **kwargs))
+            fresh = {keys[index]: response for index, response in zip(missing, responses)}
+            llm_cache.put_many(model, fresh)
+            cached.update(fresh)
+        return [cached[key] for key in keys]
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limiter.limit,
+            "inflight": self.limiter.inflight,
+            "paused_for": max(0.0, self.limiter.paused_until - time.monotonic()),
+            "rate_limited": self.limiter.rate_limited,
+            "requests": self.requests,
+            "packed_requests": self.packed_requests,
+            "packed_functions": self.packed_functions,
+        }
+
+
+def single_messages(system: str, prompt: str, content: str, instruction: str = "") -> list:
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": f"{prompt}\n{instruction}{content}."},
+    ]
+
+
+def pack_contents(contents: list) -> list:
+    """
+    Группирует индексы фрагментов в пачки, укладывающиеся в LLM_PACK_MAX_TOKENS
+    """
+    packs = []
+    current = []
+    tokens = 0
+    for index, content in enumerate(contents):
+        size = estimate_tokens(content)
+        if current and (tokens + size > LLM_PACK_MAX_TOKENS or len(current) >= LLM_PACK_MAX_FUNCTIONS):
+            packs.append(current)
+            current = []
+            tokens = 0
+        current.append(index)
+        tokens += size
+    if current:
+        packs.append(current)
+    return packs
+
+
+def split_packed(response: str, count: int) -> list:
+    results = [None] * count
+    matches = list(FUNCTION_MARKER_RE.finditer(response or ""))
+    for position, match in enumerate(matches):
+        index = int(match.group(1))
+        end = matches[position + 1].start() if position + 1 < len(matches) else len(response)
+        if 0 <= index < count:
+            results[index] = response[match.end():end].strip()
+    return results
+
+
+llm_runner = LLMRunner()
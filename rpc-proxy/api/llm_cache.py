@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import timedelta
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+from .models import LLMResponse
+
+
+# Сколько ответов хранить; при превышении удаляются давно не использованные
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get('LLM_CACHE_MAX_ENTRIES', '50000'))
+# Ответы, не использованные дольше этого срока (в днях), удаляются
+LLM_CACHE_MAX_AGE = float(os.environ.get('LLM_CACHE_MAX_AGE', '30'))
+# Как часто (в секундах) запускать очистку
+LLM_CACHE_EVICT_INTERVAL = float(os.environ.get('LLM_CACHE_EVICT_INTERVAL', '600'))
+LLM_CACHE_ENABLED = os.environ.get('LLM_CACHE_ENABLED', 'True') == 'True'
+
+
+def prompt_key(model: str, messages: list, kwargs: dict) -> str:
+    """
+    Ключ запроса: модель, параметры (temperature и т.п.) и все сообщения, включая системное
+    """
+    request = {"model": model, "messages": messages, "kwargs": kwargs}
+    return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    Постоянный кеш ответов LLM в БД. Запросы с одинаковыми промптами
+    (повторный анализ тех же контрактов) не отправляются в API повторно.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_evict = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evicted = 0
+
+    def get_many(self, keys: list) -> dict:
+        if not LLM_CACHE_ENABLED or not keys:
+            return {}
+        found = dict(LLMResponse.objects.filter(key__in=keys).values_list('key', 'response'))
+        if found:
+            LLMResponse.objects.filter(key__in=list(found)).update(hits=F('hits') + 1, last_used_at=timezone.now())
+        with self.lock:
+            self.hits += len(found)
+            self.misses += len(set(keys)) - len(found)
+        return found
+
+    def get(self, key: str) -> str | None:
+        return self.get_many([key]).get(key)
+
+    def put_many(self, model: str, responses: dict):
+        if not LLM_CACHE_ENABLED:
+            return
+        entries = [
+            LLMResponse(key=key, model=model, response=response, size=len(response))
+            for key, response in responses.items() if response is not None
+        ]
+        # Тот же ответ мог сохранить параллельный анализ
+        LLMResponse.objects.bulk_create(entries, ignore_conflicts=True)
+        with self.lock:
+            self.stores += len(entries)
+        self.evict()
+
+    def put(self, model: str, key: str, response: str):
+        self.put_many(model, {key: response})
+
+    def evict(self, force: bool = False):
+        """
+        Удаляет устаревшие ответы и лишние сверх LLM_CACHE_MAX_ENTRIES, не чаще раза в LLM_CACHE_EVICT_INTERVAL
+        """
+        with self.lock:
+            if not force and time.monotonic() < self.next_evict:
+                return
+            self.next_evict = time.monotonic() + LLM_CACHE_EVICT_INTERVAL
+        deleted, _ = LLMResponse.objects.filter(last_used_at__lt=timezone.now() - timedelta(days=LLM_CACHE_MAX_AGE)).delete()
+        oldest = (
+            LLMResponse.objects.order_by('-last_used_at')
+            .values_list('last_used_at', flat=True)[LLM_CACHE_MAX_ENTRIES:LLM_CACHE_MAX_ENTRIES + 1]
+        )
+        if oldest:
+            extra, _ = LLMResponse.objects.filter(last_used_at__lte=oldest[0]).delete()
+            deleted += extra
+        with self.lock:
+            self.evicted += deleted
+
+    def stats(self) -> dict:
+        """
+        Счётчики процесса и общая статистика по БД: каждая запись — один промах, hits — повторные обращения
+        """
+        stored = LLMResponse.objects.aggregate(entries=Count('key'), size=Sum('size'), hits=Sum('hits'))
+        entries = stored["entries"]
+        hits = stored["hits"] or 0
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "size": stored["size"] or 0,
+            "hits": hits,
+            "hit_rate": hits / (hits + entries) if hits + entries else 0.0,
+            "process_hits": self.hits,
+            "process_misses": self.misses,
+            "process_hit_rate": self.hits / lookups if lookups else 0.0,
+            "stores": self.stores,
+            "evicted": self.evicted,
+        }
+
+
+llm_cache = LLMResponseCache()
@@ -0,0 +1,14 @@
+import asyncio
+from django.core.management.base import BaseCommand
+from api.notifications import dispatch_forever
+
+
+class Command(BaseCommand):
+    help = "Доставляет уведомления из outbox в telegram-бот"
+
+    def handle(self, *args, **options):
+        self.stdout.write("Запуск диспетчера уведомлений")
+        try:
+            asyncio.run(dispatch_forever())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from api.worker import SIMULATION_WORKERS, run_workers
+
+
+class Command(BaseCommand):
+    help = "Разбирает очередь симуляций перехваченных транзакций"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=SIMULATION_WORKERS)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Запуск воркера симуляций ({options['concurrency']} потоков)")
+        run_workers(options['concurrency'])
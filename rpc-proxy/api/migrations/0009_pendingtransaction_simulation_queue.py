@@ -0,0 +1,54 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:51
+
+from django.db import migrations, models
+
+
+def mark_existing_simulated(apps, schema_editor):
+    # Транзакции, созданные до появления очереди, уже были просимулированы синхронно
+    PendingTransaction = apps.get_model('api', 'PendingTransaction')
+    PendingTransaction.objects.update(simulation_status='done')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_contractstaticanalysis_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pendingtransaction',
+            name='simulate_after',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='pendingtransaction',
+            name='simulation_attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='pendingtransaction',
+            name='simulation_error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='pendingtransaction',
+            name='simulation_started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='pendingtransaction',
+            name='simulation_status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='pendingtransaction',
+            name='simulation_timings',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddIndex(
+            model_name='pendingtransaction',
+            index=models.Index(fields=['simulation_status', 'simulate_after'], name='pendingtx_simulation_queue'),
+        ),
+        migrations.RunPython(mark_existing_simulated, migrations.RunPython.noop),
+    ]
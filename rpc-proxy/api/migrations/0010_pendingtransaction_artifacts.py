@@ -0,0 +1,96 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:59
+
+import django.db.models.deletion
+import json
+from django.db import migrations, models
+from api.artifacts import artifact_digest, compress
+
+ARTIFACT_FIELDS = ['raw_data', 'analyze_result', 'schemas', 'static_analysis_output', 'trace']
+
+
+def move_to_artifacts(apps, schema_editor):
+    # Большие колонки переносятся в сжатое хранилище артефактов
+    PendingTransaction = apps.get_model('api', 'PendingTransaction')
+    Artifact = apps.get_model('api', 'Artifact')
+    for pending_transaction in PendingTransaction.objects.iterator(chunk_size=100):
+        for name in ARTIFACT_FIELDS:
+            value = getattr(pending_transaction, name)
+            if value is None or value == '':
+                continue
+            content = (json.dumps(value) if name == 'raw_data' else value).encode()
+            artifact, _ = Artifact.objects.get_or_create(
+                digest=artifact_digest(content),
+                defaults={'data': compress(content), 'size': len(content)}
+            )
+            setattr(pending_transaction, f'{name}_artifact', artifact)
+        pending_transaction.save(update_fields=[f'{name}_artifact' for name in ARTIFACT_FIELDS])
+
+
+class Migration(migrations.Migration):
+    # Перенос данных заполняет FK-колонки, и на Postgres в той же транзакции остаются
+    # отложенные события триггеров: последующие ALTER TABLE и CREATE INDEX по таблице
+    # завершились бы ошибкой. Поэтому перенос выполняется в собственной транзакции,
+    # а удаление колонок и отложенные индексы — после её фиксации
+    atomic = False
+
+    dependencies = [
+        ('api', '0009_pendingtransaction_simulation_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Artifact',
+            fields=[
+                ('digest', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('data', models.BinaryField()),
+                ('size', models.IntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='pendingtransaction',
+            name='analyze_result_artifact',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='api.artifact'),
+        ),
+        migrations.AddField(
+            model_name='pendingtransaction',
+            name='raw_data_artifact',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='api.artifact'),
+        ),
+        migrations.AddField(
+            model_name='pendingtransaction',
+            name='schemas_artifact',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='api.artifact'),
+        ),
+        migrations.AddField(
+            model_name='pendingtransaction',
+            name='static_analysis_output_artifact',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='api.artifact'),
+        ),
+        migrations.AddField(
+            model_name='pendingtransaction',
+            name='trace_artifact',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='api.artifact'),
+        ),
+        migrations.RunPython(move_to_artifacts, migrations.RunPython.noop, atomic=True),
+        migrations.RemoveField(
+            model_name='pendingtransaction',
+            name='analyze_result',
+        ),
+        migrations.RemoveField(
+            model_name='pendingtransaction',
+            name='raw_data',
+        ),
+        migrations.RemoveField(
+            model_name='pendingtransaction',
+            name='schemas',
+        ),
+        migrations.RemoveField(
+            model_name='pendingtransaction',
+            name='static_analysis_output',
+        ),
+        migrations.RemoveField(
+            model_name='pendingtransaction',
+            name='trace',
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:59
+
+from django.db import migrations, models
+from eth_utils import keccak
+from hexbytes import HexBytes
+
+
+def normalize_transaction_ids(apps, schema_editor):
+    # Хеш пересчитывается из подписанных байт, чтобы все значения были в одном формате
+    PendingTransaction = apps.get_model('api', 'PendingTransaction')
+    for pending_transaction in PendingTransaction.objects.only('id', 'raw_transaction', 'transaction_id').iterator(chunk_size=500):
+        transaction_id = "0x" + keccak(HexBytes(pending_transaction.raw_transaction)).hex()
+        if transaction_id != pending_transaction.transaction_id:
+            PendingTransaction.objects.filter(id=pending_transaction.id).update(transaction_id=transaction_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_pendingtransaction_artifacts'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_transaction_ids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='pendingtransaction',
+            name='transaction_id',
+            field=models.CharField(max_length=66, unique=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:01
+
+from django.db import migrations, models
+from django.db.models.functions import Lower, Trim
+
+
+def normalize_addresses(apps, schema_editor):
+    UserAdress = apps.get_model('api', 'UserAdress')
+    UserAdress.objects.update(normalized_address=Lower(Trim('address')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_pendingtransaction_transaction_id_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='useradress',
+            name='normalized_address',
+            field=models.CharField(db_index=True, default='', max_length=255),
+        ),
+        migrations.RunPython(normalize_addresses, migrations.RunPython.noop),
+    ]
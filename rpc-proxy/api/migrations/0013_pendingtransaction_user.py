@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:03
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_useradress_normalized_address'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pendingtransaction',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='api.user'),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='telegram_id',
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name='pendingtransaction',
+            index=models.Index(condition=models.Q(('pending', True)), fields=['user', 'id'], name='pendingtx_user_pending'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_llmresponse'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContractCode',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address', models.CharField(max_length=42, unique=True)),
+                ('code_hash', models.CharField(db_index=True, max_length=66)),
+                ('is_proxy', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='contractstaticanalysis',
+            name='code_hash',
+            field=models.CharField(blank=True, default='', max_length=66),
+        ),
+        migrations.AddField(
+            model_name='disassembledcontractfunction',
+            name='code_hash',
+            field=models.CharField(blank=True, default='', max_length=66),
+        ),
+        migrations.AddConstraint(
+            model_name='contractstaticanalysis',
+            constraint=models.UniqueConstraint(condition=models.Q(('code_hash', ''), _negated=True), fields=('code_hash',), name='static_analysis_code'),
+        ),
+        migrations.AddConstraint(
+            model_name='disassembledcontractfunction',
+            constraint=models.UniqueConstraint(condition=models.Q(('code_hash', ''), _negated=True), fields=('code_hash', 'function_name'), name='disassembled_function_code'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+from django.db import migrations
+from django.db.models import OuterRef, Subquery
+
+
+def fill_user(apps, schema_editor):
+    PendingTransaction = apps.get_model('api', 'PendingTransaction')
+    UserAdress = apps.get_model('api', 'UserAdress')
+    PendingTransaction.objects.filter(user__isnull=True).update(
+        user=Subquery(UserAdress.objects.filter(id=OuterRef('address_id')).values('user_id')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+    # Заполнение FK оставляет на Postgres отложенные события триггеров до конца транзакции,
+    # поэтому оно вынесено в отдельную миграцию без изменений схемы
+
+    dependencies = [
+        ('api', '0016_contract_code_hash'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_user, migrations.RunPython.noop),
+    ]
@@ -1,8 +1,19 @@
-from django.db import models
+import io
+import json
+from django.db import models, transaction
+from django.utils import timezone
+from datetime import timedelta
+from .artifacts import ARTIFACT_GC_MIN_AGE, artifact_digest, compress, decompress, decompress_stream
+
+
+
+def normalize_address(address: str) -> str:
+    return address.strip().lower()
+
 
 # Create your models here.
 class User(models.Model):
-    telegram_id = models.CharField(max_length=255)
+    telegram_id = models.CharField(max_length=255, db_index=True)
     chat_id = models.CharField(max_length=255)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -10,31 +21,252 @@ class User(models.Model):
 class UserAdress(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     address = models.CharField(max_length=255)
+    # Адрес в нижнем регистре: пользователи вводят его как угодно, а отправитель приходит в checksum
+    normalized_address = models.CharField(max_length=255, db_index=True, default='')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+    def save(self, *args, **kwargs):
+        self.normalized_address = normalize_address(self.address)
+        super().save(*args, **kwargs)
     
+class Artifact(models.Model):
+    """
+    Большие данные (трейсы, результаты анализа) хранятся сжатыми в отдельной таблице,
+    адресуются по sha256 содержимого и загружаются только при обращении
+    """
+    digest = models.CharField(max_length=64, primary_key=True)
+    data = models.BinaryField()
+    size = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def store_many(cls, contents: list) -> list:
+        """
+        Сохраняет содержимое одним INSERT и возвращает digest'ы. При конфликте обновляется
+        created_at, чтобы сборка мусора не удалила артефакт, на который только что сослались
+        """
+        contents = [content.encode() if isinstance(content, str) else content for content in contents]
+        digests = [artifact_digest(content) for content in contents]
+        artifacts = {
+            digest: cls(digest=digest, data=compress(content), size=len(content))
+            for digest, content in zip(digests, contents)
+        }
+        cls.objects.bulk_create(list(artifacts.values()), update_conflicts=True, unique_fields=['digest'], update_fields=['created_at'])
+        return digests
+
+    @classmethod
+    def collect_garbage(cls, min_age: float = ARTIFACT_GC_MIN_AGE) -> int:
+        """
+        Удаляет артефакты, на которые не ссылается ни одна запись (перезаписанные значения)
+        """
+        unreferenced = cls.objects.filter(created_at__lt=timezone.now() - timedelta(seconds=min_age))
+        for relation in cls._meta.get_fields(include_hidden=True):
+            if relation.one_to_many and relation.auto_created:
+                unreferenced = unreferenced.exclude(
+                    models.Exists(relation.related_model.objects.filter(**{relation.field.name: models.OuterRef('pk')}))
+                )
+        deleted, _ = unreferenced.delete()
+        return deleted
+
+    def text(self) -> str:
+        return decompress(self.data).decode()
+
+    def open(self):
+        return decompress_stream(self.data)
+
+
+def artifact_property(name: str, is_json: bool = False):
+    """
+    Свойство модели поверх ссылки на Artifact: значение читается лениво,
+    присвоенное значение сохраняется в хранилище артефактов вместе с записью (save_artifacts)
+    """
+    field = f"{name}_artifact"
+
+    def getter(self):
+        pending = self.__dict__.get('_pending_artifacts', {})
+        if name in pending:
+            return pending[name][0]
+        if getattr(self, f"{field}_id") is None:
+            return None if is_json else ''
+        content = getattr(self, field).text()
+        return json.loads(content) if is_json else content
+
+    def setter(self, value):
+        pending = self.__dict__.setdefault('_pending_artifacts', {})
+        if value is None or value == '':
+            pending.pop(name, None)
+            setattr(self, field, None)
+            return
+        # Значение и его сериализованное содержимое для хранилища
+        pending[name] = (value, json.dumps(value) if is_json else value)
+
+    return property(getter, setter)
+
+
+def save_artifacts(instance, update_fields=None):
+    """
+    Сохраняет присвоенные значения artifact_property одним запросом и проставляет ссылки.
+    Вызывается в транзакции сохранения записи, поэтому при ошибке артефакты откатываются вместе с ней.
+    Возвращает update_fields, дополненный ссылками на артефакты.
+    """
+    pending = instance.__dict__.get('_pending_artifacts')
+    if not pending:
+        return update_fields
+    names = list(pending)
+    contents = [pending[name][1] for name in names]
+    for name, digest in zip(names, Artifact.store_many(contents)):
+        setattr(instance, f"{name}_artifact_id", digest)
+    if update_fields is not None:
+        update_fields = list(update_fields) + [f"{name}_artifact" for name in names]
+    return update_fields
+
+
 class PendingTransaction(models.Model):
+    SIMULATION_QUEUED = 'queued'
+    SIMULATION_RUNNING = 'running'
+    SIMULATION_DONE = 'done'
+    SIMULATION_FAILED = 'failed'
+    SIMULATION_STATUSES = [
+        (SIMULATION_QUEUED, 'Queued'),
+        (SIMULATION_RUNNING, 'Running'),
+        (SIMULATION_DONE, 'Done'),
+        (SIMULATION_FAILED, 'Failed'),
+    ]
+
     address = models.ForeignKey(UserAdress, on_delete=models.CASCADE)
-    transaction_id = models.CharField(max_length=255, unique=True)
-    raw_data = models.JSONField()
+    # Владелец адреса, чтобы списки транзакций пользователя не шли через join по адресам
+    user = models.ForeignKey(User, null=True, blank=True, on_delete=models.CASCADE)
+    # keccak подписанных байт (хеш транзакции), по нему же ищутся повторные отправки
+    transaction_id = models.CharField(max_length=66, unique=True)
     raw_transaction = models.CharField(max_length=4096)
     data = models.JSONField()
     confirmed = models.BooleanField(default=False)
     pending = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
-    analyze_result = models.TextField(blank=True)
-    schemas = models.TextField(blank=True)
-    static_analysis_output = models.TextField(blank=True)
-    trace = models.TextField(blank=True)
+    raw_data_artifact = models.ForeignKey(Artifact, null=True, blank=True, on_delete=models.PROTECT, related_name='+')
+    analyze_result_artifact = models.ForeignKey(Artifact, null=True, blank=True, on_delete=models.PROTECT, related_name='+')
+    schemas_artifact = models.ForeignKey(Artifact, null=True, blank=True, on_delete=models.PROTECT, related_name='+')
+    static_analysis_output_artifact = models.ForeignKey(Artifact, null=True, blank=True, on_delete=models.PROTECT, related_name='+')
+    trace_artifact = models.ForeignKey(Artifact, null=True, blank=True, on_delete=models.PROTECT, related_name='+')
+    simulation_status = models.CharField(max_length=16, choices=SIMULATION_STATUSES, default=SIMULATION_QUEUED)
+    simulation_attempts = models.IntegerField(default=0)
+    simulation_error = models.TextField(blank=True)
+    simulation_timings = models.JSONField(default=dict, blank=True)
+    simulate_after = models.DateTimeField(null=True, blank=True)
+    simulation_started_at = models.DateTimeField(null=True, blank=True)
+
+    raw_data = artifact_property('raw_data', is_json=True)
+    analyze_result = artifact_property('analyze_result')
+    schemas = artifact_property('schemas')
+    static_analysis_output = artifact_property('static_analysis_output')
+    trace = artifact_property('trace')
+
+    def save(self, *args, **kwargs):
+        if not self.__dict__.get('_pending_artifacts'):
+            return super().save(*args, **kwargs)
+        with transaction.atomic():
+            kwargs['update_fields'] = save_artifacts(self, kwargs.get('update_fields'))
+            super().save(*args, **kwargs)
+        self._pending_artifacts.clear()
+
+    def open_trace(self):
+        """
+        Трейс как поток байт: распаковывается по мере чтения, не собираясь в строку.
+        Каждый вызов открывает новый поток, поэтому метод можно передавать как трейс
+        в функции trace.py, читающие его несколько раз.
+        """
+        pending = self.__dict__.get('_pending_artifacts', {})
+        if 'trace' in pending:
+            return io.BytesIO(pending['trace'][1].encode())
+        if self.trace_artifact_id is None:
+            return None
+        return self.trace_artifact.open()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['simulation_status', 'simulate_after'], name='pendingtx_simulation_queue'),
+            models.Index(fields=['user', 'id'], condition=models.Q(pending=True), name='pendingtx_user_pending'),
+        ]
+
+class Notification(models.Model):
+    """
+    Исходящее уведомление в telegram (outbox). Создаётся в одной транзакции БД
+    с изменением PendingTransaction и доставляется диспетчером с повторами.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUSES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_SENT, 'Sent'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    pending_transaction = models.ForeignKey(PendingTransaction, null=True, blank=True, on_delete=models.CASCADE)
+    chat_id = models.CharField(max_length=255)
+    payload = models.JSONField()
+    status = models.CharField(max_length=16, choices=STATUSES, default=STATUS_PENDING)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['next_attempt_at'], condition=models.Q(status='pending'), name='notification_outbox'),
+        ]
+
+
+class ContractCode(models.Model):
+    """
+    Адрес контракта -> keccak его runtime-кода. Результаты анализа хранятся по хешу кода,
+    поэтому клоны, минимальные прокси и контракты фабрик анализируются один раз.
+    Для EIP-1967 прокси анализируется код реализации, который может смениться,
+    поэтому для них реализация каждый раз читается из storage.
+    """
+    address = models.CharField(max_length=42, unique=True)
+    code_hash = models.CharField(max_length=66, db_index=True)
+    is_proxy = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
 
 class DisassembledContractFunction(models.Model):
+    # Адрес, на котором функция была декомпилирована впервые
     contract_address = models.CharField(max_length=255)
+    code_hash = models.CharField(max_length=66, blank=True, default='')
     function_name = models.CharField(max_length=255)
     function_code = models.TextField()
     solidity_code = models.TextField()
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['code_hash', 'function_name'], condition=~models.Q(code_hash=''), name='disassembled_function_code'),
+        ]
+
 class ContractStaticAnalysis(models.Model):
+    # Адрес, на котором код был проанализирован впервые
     contract_address = models.CharField(max_length=255)
+    code_hash = models.CharField(max_length=66, blank=True, default='')
     raw = models.TextField(blank=True)
     bytecode_hash = models.CharField(max_length=255)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['code_hash'], condition=~models.Q(code_hash=''), name='static_analysis_code'),
+        ]
+
+class LLMResponse(models.Model):
+    """
+    Кеш ответов LLM: ключ — sha256 от модели, параметров и сообщений запроса
+    """
+    key = models.CharField(max_length=64, primary_key=True)
+    model = models.CharField(max_length=255)
+    response = models.TextField()
+    size = models.IntegerField()
+    hits = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True)
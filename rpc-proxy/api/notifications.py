@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import os
+from datetime import timedelta
+import httpx
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from .models import Notification
+
+
+logger = logging.getLogger(__name__)
+
+NOTIFICATION_BOT_URL = os.environ.get('NOTIFICATION_BOT_URL', 'http://telegram-bot:8000')
+# Сколько уведомлений отправляется в бот одним запросом
+NOTIFICATION_BATCH_SIZE = int(os.environ.get('NOTIFICATION_BATCH_SIZE', '50'))
+# Сколько раз пытаться доставить уведомление
+NOTIFICATION_MAX_ATTEMPTS = int(os.environ.get('NOTIFICATION_MAX_ATTEMPTS', '8'))
+# Базовая задержка перед повтором (удваивается с каждой попыткой)
+NOTIFICATION_RETRY_DELAY = float(os.environ.get('NOTIFICATION_RETRY_DELAY', '2'))
+# Через сколько секунд взятое, но не доставленное уведомление снова становится доступным
+NOTIFICATION_LEASE = float(os.environ.get('NOTIFICATION_LEASE', '60'))
+NOTIFICATION_POLL_INTERVAL = float(os.environ.get('NOTIFICATION_POLL_INTERVAL', '0.5'))
+# Бот отвечает на пачку, дождавшись отправки не дольше NOTIFY_SEND_TIMEOUT, а в один чат
+# пишет не чаще TELEGRAM_CHAT_RATE сообщений в секунду (общие настройки из .env)
+NOTIFY_SEND_TIMEOUT = float(os.environ.get('NOTIFY_SEND_TIMEOUT', '30'))
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', '1'))
+# Сколько уведомлений одного чата брать в пачку: с запасом успевают уйти за время ожидания бота
+NOTIFICATION_PER_CHAT = int(os.environ.get('NOTIFICATION_PER_CHAT', str(max(1, int(TELEGRAM_CHAT_RATE * NOTIFY_SEND_TIMEOUT / 2)))))
+# HTTP-таймаут больше времени ожидания бота, чтобы получить его ответ по каждому уведомлению
+NOTIFICATION_TIMEOUT = float(os.environ.get('NOTIFICATION_TIMEOUT', str(NOTIFY_SEND_TIMEOUT + 10)))
+
+
+def transaction_payload(pending_transaction) -> dict:
+    """
+    Уведомление содержит всё, что нужно боту для сообщения, без обратного запроса в API
+    """
+    return {
+        "chat_id": pending_transaction.address.user.chat_id,
+        "tx_id": pending_transaction.id,
+        "transaction": pending_transaction.data,
+        "pending": pending_transaction.pending,
+        "confirmed": pending_transaction.confirmed,
+        "simulation_status": pending_transaction.simulation_status,
+    }
+
+
+def enqueue_transaction_notification(pending_transaction) -> Notification:
+    """
+    Вызывается внутри transaction.atomic вместе с сохранением PendingTransaction
+    """
+    payload = transaction_payload(pending_transaction)
+    return Notification.objects.create(
+        pending_transaction=pending_transaction,
+        chat_id=payload["chat_id"],
+        payload=payload
+    )
+
+
+def claim_notifications(limit: int = NOTIFICATION_BATCH_SIZE) -> list:
+    """
+    Забирает пачку готовых к отправке уведомлений. Взятые уведомления откладываются
+    на NOTIFICATION_LEASE, поэтому упавший диспетчер не теряет их. Из одного чата
+    берётся не больше NOTIFICATION_PER_CHAT, остальные останутся следующим пачкам.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        candidates = (
+            Notification.objects
+            .select_for_update(skip_locked=True)
+            .filter(status=Notification.STATUS_PENDING, next_attempt_at__lte=now)
+            .order_by('next_attempt_at')[:limit * 2]
+        )
+        notifications = []
+        per_chat = {}
+        for notification in candidates:
+            if per_chat.get(notification.chat_id, 0) >= NOTIFICATION_PER_CHAT:
+                continue
+            per_chat[notification.chat_id] = per_chat.get(notification.chat_id, 0) + 1
+            notifications.append(notification)
+            if len(notifications) >= limit:
+                break
+        for notification in notifications:
+            notification.attempts += 1
+            notification.next_attempt_at = now + timedelta(seconds=NOTIFICATION_LEASE)
+        Notification.objects.bulk_update(notifications, ['attempts', 'next_attempt_at'])
+    return notifications
+
+
+def finish_notifications(notifications: list, errors: dict):
+    """
+    Отмечает доставленные уведомления, остальные откладывает с экспоненциальной задержкой
+    """
+    now = timezone.now()
+    for notification in notifications:
+        error = errors.get(notification.id)
+        if error is None:
+            notification.status = Notification.STATUS_SENT
+            notification.sent_at = now
+            notification.last_error = ''
+            continue
+        notification.last_error = error
+        if notification.attempts >= NOTIFICATION_MAX_ATTEMPTS:
+            notification.status = Notification.STATUS_FAILED
+            logger.error(f"Уведомление {notification.id} не доставлено: {error}")
+        else:
+            delay = NOTIFICATION_RETRY_DELAY * 2 ** (notification.attempts - 1)
+            notification.next_attempt_at = now + timedelta(seconds=delay)
+            logger.warning(f"Уведомление {notification.id} не доставлено, повтор через {delay} с: {error}")
+    Notification.objects.bulk_update(notifications, ['status', 'sent_at', 'last_error', 'next_attempt_at'])
+
+
+async def deliver(client: httpx.AsyncClient, notifications: list) -> dict:
+    """
+    Отправляет пачку в бот одним запросом. Возвращает ошибки по id уведомлений.
+    """
+    try:
+        response = await client.post(
+            f"{NOTIFICATION_BOT_URL}/notify-transactions",
+            json={"notifications": [{"id": notification.id, **notification.payload} for notification in notifications]}
+        )
+        response.raise_for_status()
+        results = {result.get("id"): result for result in response.json().get("results", [])}
+    except Exception as e:
+        return {notification.id: str(e) for notification in notifications}
+    errors = {}
+    for notification in notifications:
+        result = results.get(notification.id)
+        if not result:
+            errors[notification.id] = "No result from bot"
+        elif result.get("status") != "success":
+            errors[notification.id] = result.get("message") or "Unknown error"
+    return errors
+
+
+async def dispatch_forever(stop_event: asyncio.Event = None):
+    """
+    Диспетчер уведомлений: ответ кошельку никогда не ждёт telegram
+    """
+    stop_event = stop_event or asyncio.Event()
+    async with httpx.AsyncClient(timeout=NOTIFICATION_TIMEOUT) as client:
+        while not stop_event.is_set():
+            await sync_to_async(close_old_connections)()
+            try:
+                notifications = await sync_to_async(claim_notifications)()
+            except Exception as e:
+                logger.error(f"Ошибка при получении уведомлений: {str(e)}")
+                notifications = []
+            if not notifications:
+                try:
+                    await asyncio.wait_for(stop_event.wait(), NOTIFICATION_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            errors = await deliver(client, notifications)
+            await sync_to_async(finish_notifications)(notifications, errors)
@@ -0,0 +1,293 @@
+import asyncio
+import os
+import time
+from collections import deque
+import json
+import httpx
+import requests
+from web3.providers import JSONBaseProvider
+
+
+def parse_urls() -> list:
+    """
+    Список нод берётся из RPC_URLS (через запятую), для совместимости — из RPC_URL
+    """
+    urls = [url.strip() for url in os.environ.get('RPC_URLS', '').split(',') if url.strip()]
+    if not urls and os.environ.get('RPC_URL'):
+        urls = [os.environ.get('RPC_URL')]
+    return urls
+
+
+UPSTREAM_TIMEOUT = float(os.environ.get('UPSTREAM_TIMEOUT', '30'))
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get('UPSTREAM_MAX_CONNECTIONS', '100'))
+# Коэффициент сглаживания EWMA задержки
+RPC_EWMA_ALPHA = float(os.environ.get('RPC_EWMA_ALPHA', '0.3'))
+# Интервал health-check'ов нод в секундах
+RPC_HEALTH_INTERVAL = float(os.environ.get('RPC_HEALTH_INTERVAL', '10'))
+# После скольких ошибок подряд нода считается нездоровой
+RPC_MAX_FAILURES = int(os.environ.get('RPC_MAX_FAILURES', '3'))
+# На сколько блоков нода может отставать от самой свежей, оставаясь здоровой
+RPC_MAX_LAG = int(os.environ.get('RPC_MAX_LAG', '5'))
+# Хеджирование читающих запросов: дубль на вторую ноду, если первая не ответила за p95
+RPC_HEDGE = os.environ.get('RPC_HEDGE', 'False') == 'True'
+# Задержка хеджирования, пока по ноде недостаточно замеров для p95
+RPC_HEDGE_DELAY = float(os.environ.get('RPC_HEDGE_DELAY', '0.5'))
+RPC_HEDGE_MIN_SAMPLES = 20
+
+# Ответы, при которых запрос повторяется на следующей ноде
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class Endpoint:
+    def __init__(self, url: str):
+        self.url = url
+        self.ewma = None
+        self.samples = deque(maxlen=200)
+        self.failures = 0
+        self.healthy = True
+        self.block = None
+        self.requests = 0
+        self.errors = 0
+        self.last_error = None
+
+    def observe(self, latency: float):
+        self.samples.append(latency)
+        self.ewma = latency if self.ewma is None else RPC_EWMA_ALPHA * latency + (1 - RPC_EWMA_ALPHA) * self.ewma
+
+    def succeeded(self, latency: float):
+        self.requests += 1
+        self.failures = 0
+        self.observe(latency)
+
+    def failed(self, error: str, latency: float):
+        self.requests += 1
+        self.errors += 1
+        self.failures += 1
+        self.last_error = error
+        # Ошибка учитывается в задержке, чтобы нода опустилась в рейтинге
+        self.observe(max(latency, UPSTREAM_TIMEOUT))
+        if self.failures >= RPC_MAX_FAILURES:
+            self.healthy = False
+
+    def p95(self) -> float | None:
+        if len(self.samples) < RPC_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "ewma_latency": self.ewma,
+            "p95_latency": self.p95(),
+            "block": self.block,
+            "requests": self.requests,
+            "errors": self.errors,
+            "last_error": self.last_error,
+        }
+
+
+class UpstreamPool:
+    """
+    Пул нод: маршрутизирует запросы в самую быструю здоровую ноду по EWMA задержки,
+    переключается на следующую при 5xx и таймаутах и при необходимости хеджирует чтение
+    """
+
+    def __init__(self, urls: list):
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.client = None
+        self.health_task = None
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def get_client(self) -> httpx.AsyncClient:
+        """
+        Возвращает общий httpx-клиент с пулом keep-alive соединений к нодам
+        """
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                timeout=UPSTREAM_TIMEOUT,
+                limits=httpx.Limits(
+                    max_connections=UPSTREAM_MAX_CONNECTIONS,
+                    max_keepalive_connections=UPSTREAM_MAX_CONNECTIONS
+                ),
+                headers={"Content-Type": "application/json"}
+            )
+        return self.client
+
+    def ranked(self) -> list:
+        """
+        Здоровые ноды по возрастанию задержки, нездоровые — в конце как последний шанс
+        """
+        if not self.endpoints:
+            raise RuntimeError("RPC_URLS or RPC_URL is not configured")
+        def latency(endpoint):
+            return endpoint.ewma if endpoint.ewma is not None else 0.0
+        healthy = sorted([e for e in self.endpoints if e.healthy], key=latency)
+        unhealthy = sorted([e for e in self.endpoints if not e.healthy], key=latency)
+        return healthy + unhealthy
+
+    def best_url(self) -> str:
+        """
+        URL лучшей ноды для синхронного кода (web3, форк hardhat)
+        """
+        return self.ranked()[0].url
+
+    def ensure_health_checks(self):
+        if len(self.endpoints) > 1 and (self.health_task is None or self.health_task.done()):
+            self.health_task = asyncio.get_running_loop().create_task(self.health_loop())
+
+    async def health_loop(self):
+        while True:
+            await self.check_health()
+            await asyncio.sleep(RPC_HEALTH_INTERVAL)
+
+    async def check_health(self):
+        payload = {"jsonrpc": "2.0", "id": 0, "method": "eth_blockNumber", "params": []}
+
+        async def check(endpoint):
+            started = time.monotonic()
+            try:
+                response = await self.get_client().post(endpoint.url, json=payload)
+                response.raise_for_status()
+                endpoint.block = int(response.json()["result"], 16)
+                endpoint.observe(time.monotonic() - started)
+                endpoint.failures = 0
+                return True
+            except Exception as e:
+                endpoint.failed(f"health check: {str(e)}", time.monotonic() - started)
+                endpoint.block = None
+                return False
+
+        results = await asyncio.gather(*(check(endpoint) for endpoint in self.endpoints))
+        head = max([e.block for e in self.endpoints if e.block is not None], default=None)
+        for endpoint, ok in zip(self.endpoints, results):
+            endpoint.healthy = ok and head is not None and head - endpoint.block <= RPC_MAX_LAG
+
+    async def send(self, endpoint: Endpoint, payload) -> httpx.Response:
+        """
+        Отправляет запрос в одну ноду; 5xx и 429 считаются ошибкой ноды
+        """
+        started = time.monotonic()
+        try:
+            response = await self.get_client().post(endpoint.url, json=payload)
+        except Exception as e:
+            endpoint.failed(str(e), time.monotonic() - started)
+            raise
+        if response.status_code in RETRY_STATUSES:
+            endpoint.failed(f"HTTP {response.status_code}", time.monotonic() - started)
+        else:
+            endpoint.succeeded(time.monotonic() - started)
+        return response
+
+    async def send_hedged(self, primary: Endpoint, secondary: Endpoint, payload) -> httpx.Response:
+        """
+        Если основная нода не ответила за p95, дублирует запрос во вторую и берёт первый ответ
+        """
+        delay = primary.p95() or RPC_HEDGE_DELAY
+        first = asyncio.ensure_future(self.send(primary, payload))
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+        self.hedged += 1
+        second = asyncio.ensure_future(self.send(secondary, payload))
+        pending = {first, second}
+        result = None
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                    continue
+                if task.result().status_code not in RETRY_STATUSES:
+                    for other in pending:
+                        other.cancel()
+                    if task is second:
+                        self.hedge_wins += 1
+                    return task.result()
+                result = task.result()
+        if result is not None:
+            return result
+        raise error
+
+    async def post(self, payload, hedge: bool = False) -> httpx.Response:
+        """
+        Отправляет запрос в лучшую ноду, переключаясь на следующие при ошибках.
+        Возвращает последний полученный ответ или пробрасывает последнюю ошибку.
+        """
+        self.ensure_health_checks()
+        endpoints = self.ranked()
+        response = None
+        error = None
+        index = 0
+        while index < len(endpoints):
+            try:
+                if hedge and RPC_HEDGE and index + 1 < len(endpoints):
+                    response = await self.send_hedged(endpoints[index], endpoints[index + 1], payload)
+                    index += 2
+                else:
+                    response = await self.send(endpoints[index], payload)
+                    index += 1
+            except (httpx.TimeoutException, httpx.TransportError) as e:
+                error = e
+                index += 1
+                continue
+            if response.status_code not in RETRY_STATUSES:
+                return response
+        if response is not None:
+            return response
+        raise error
+
+    async def send_to(self, index: int, payload) -> httpx.Response:
+        """
+        Отправляет запрос в конкретную ноду без переключения (фильтры живут на одной ноде)
+        """
+        self.ensure_health_checks()
+        return await self.send(self.endpoints[index], payload)
+
+    def post_sync(self, payload) -> requests.Response:
+        """
+        Синхронный вариант post для кода вне event loop
+        """
+        response = None
+        error = None
+        for endpoint in self.ranked():
+            started = time.monotonic()
+            try:
+                response = requests.post(endpoint.url, json=payload, headers={"Content-Type": "application/json"}, timeout=UPSTREAM_TIMEOUT)
+            except requests.RequestException as e:
+                endpoint.failed(str(e), time.monotonic() - started)
+                error = e
+                continue
+            if response.status_code in RETRY_STATUSES:
+                endpoint.failed(f"HTTP {response.status_code}", time.monotonic() - started)
+                continue
+            endpoint.succeeded(time.monotonic() - started)
+            return response
+        if response is not None:
+            return response
+        raise error
+
+    def stats(self) -> dict:
+        return {
+            "endpoints": [endpoint.stats() for endpoint in self.endpoints],
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+        }
+
+
+upstream_pool = UpstreamPool(parse_urls())
+
+
+class UpstreamProvider(JSONBaseProvider):
+    """
+    Провайдер web3 поверх пула нод: синхронные чтения (код, storage) идут в основную сеть
+    с переключением между нодами, а не в ноды форка, которые сбрасываются симуляциями
+    """
+
+    def make_request(self, method, params):
+        response = upstream_pool.post_sync(json.loads(self.encode_rpc_request(method, params)))
+        response.raise_for_status()
+        return self.decode_rpc_response(response.content)
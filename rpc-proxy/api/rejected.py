@@ -0,0 +1,125 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from django.utils import timezone
+from .models import PendingTransaction
+
+
+# Размер фильтра Блума в битах (по умолчанию 1 МБ — ~1 млн хешей при ложных срабатываниях < 1%)
+REJECTED_BLOOM_BITS = int(os.environ.get('REJECTED_BLOOM_BITS', str(8 * 1024 * 1024)))
+REJECTED_BLOOM_HASHES = 7
+# Сколько последних отклонённых хешей хранится точно, ответ по ним без запроса в БД
+REJECTED_HOT_SIZE = int(os.environ.get('REJECTED_HOT_SIZE', '10000'))
+# Как часто подтягивать отклонения, сделанные другими процессами
+REJECTED_SYNC_INTERVAL = float(os.environ.get('REJECTED_SYNC_INTERVAL', '5'))
+
+
+class BloomFilter:
+    def __init__(self, bits: int = REJECTED_BLOOM_BITS, hashes: int = REJECTED_BLOOM_HASHES):
+        self.bits = bits
+        self.hashes = hashes
+        self.array = bytearray((bits + 7) // 8)
+        self.count = 0
+
+    def positions(self, key: str):
+        # Хеш транзакции уже равномерно распределён, но ключ может быть произвольной строкой
+        digest = hashlib.sha256(key.encode()).digest()
+        for index in range(self.hashes):
+            yield int.from_bytes(digest[index * 4:index * 4 + 4], 'big') % self.bits
+
+    def add(self, key: str):
+        for position in self.positions(key):
+            self.array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.array[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+
+class RejectedTransactions:
+    """
+    Отклонённые пользователем транзакции для перехвата eth_getTransactionReceipt.
+    Почти все запросы receipt — промахи, и фильтр Блума отвечает на них без обращения к БД.
+    Недавние отклонения хранятся точно, в БД идут только возможные совпадения фильтра.
+    """
+
+    def __init__(self):
+        self.bloom = BloomFilter()
+        self.hot = OrderedDict()
+        self.lock = threading.Lock()
+        self.seeded = False
+        self.synced_at = None
+        self.next_sync = 0.0
+        self.checks = 0
+        self.misses = 0
+        self.hot_hits = 0
+        self.db_checks = 0
+
+    def remember(self, tx_hash: str):
+        tx_hash = tx_hash.lower()
+        self.bloom.add(tx_hash)
+        self.hot[tx_hash] = True
+        self.hot.move_to_end(tx_hash)
+        while len(self.hot) > REJECTED_HOT_SIZE:
+            self.hot.popitem(last=False)
+
+    def sync(self):
+        """
+        При первом обращении загружает все отклонённые транзакции, затем раз в
+        REJECTED_SYNC_INTERVAL секунд догружает изменённые с прошлой синхронизации
+        """
+        if self.seeded and time.monotonic() < self.next_sync:
+            return
+        with self.lock:
+            if self.seeded and time.monotonic() < self.next_sync:
+                return
+            started = timezone.now()
+            rejected = PendingTransaction.objects.filter(pending=False, confirmed=False)
+            if self.synced_at is not None:
+                rejected = rejected.filter(updated_at__gte=self.synced_at)
+                # Транзакции, подтверждённые в другом процессе после отклонения
+                confirmed = PendingTransaction.objects.filter(confirmed=True, updated_at__gte=self.synced_at)
+                for tx_hash in confirmed.values_list('transaction_id', flat=True):
+                    self.hot.pop(tx_hash, None)
+            for tx_hash in rejected.values_list('transaction_id', flat=True).iterator():
+                self.remember(tx_hash)
+            self.synced_at = started
+            self.seeded = True
+            self.next_sync = time.monotonic() + REJECTED_SYNC_INTERVAL
+
+    def add(self, tx_hash: str):
+        with self.lock:
+            self.remember(tx_hash)
+
+    def discard(self, tx_hash: str):
+        # Из фильтра Блума удалить нельзя: ложное срабатывание просто уйдёт в БД
+        with self.lock:
+            self.hot.pop(tx_hash.lower(), None)
+
+    def is_rejected(self, tx_hash: str) -> bool:
+        tx_hash = tx_hash.lower()
+        self.sync()
+        self.checks += 1
+        if tx_hash not in self.bloom:
+            self.misses += 1
+            return False
+        if tx_hash in self.hot:
+            self.hot_hits += 1
+            return True
+        self.db_checks += 1
+        return PendingTransaction.objects.filter(transaction_id=tx_hash, pending=False, confirmed=False).exists()
+
+    def stats(self) -> dict:
+        return {
+            "bloom_items": self.bloom.count,
+            "hot_items": len(self.hot),
+            "checks": self.checks,
+            "misses": self.misses,
+            "hot_hits": self.hot_hits,
+            "db_checks": self.db_checks,
+        }
+
+
+rejected_transactions = RejectedTransactions()
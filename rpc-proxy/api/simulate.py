@@ -1,113 +1,295 @@
 from eth_account import Account
 from web3 import Web3
+from web3.exceptions import Web3RPCError
 from hexbytes import HexBytes
 from eth_utils import to_int, to_hex, event_abi_to_log_topic
 from eth_account.typed_transactions.typed_transaction import TypedTransaction
+from eth_account._utils.legacy_transactions import Transaction as LegacyTransaction
 import traceback
+import json
+import logging
 from web3._utils.events import get_event_data
 import os
+from .fork import simulator_pool
+from .trace import trace_transaction
 
 
-def simulate_transaction(signed_raw):
-    w3 = Web3(Web3.HTTPProvider("http://hardhat-network:8545", request_kwargs={"timeout": 100_000}))
-    transfer_abi = {
-        "anonymous": False,
-        "inputs": [
-            {"indexed": True,  "name": "from",    "type": "address"},
-            {"indexed": True,  "name": "to",      "type": "address"},
-            {"indexed": False, "name": "value",   "type": "uint256"},
-        ],
-        "name": "Transfer",
-        "type": "event",
-    }
-    approval_abi = {
-        "anonymous": False,
-        "inputs": [
-            {"indexed": True,  "name": "owner",   "type": "address"},
-            {"indexed": True,  "name": "spender", "type": "address"},
-            {"indexed": False, "name": "value",   "type": "uint256"},
-        ],
-        "name": "Approval",
-        "type": "event",
+logger = logging.getLogger(__name__)
+
+
+# Таймаут ожидания receipt при симуляции, в секундах
+SIMULATION_TIMEOUT = float(os.environ.get('SIMULATION_TIMEOUT', '120'))
+# fork — транзакция отправляется в форк и майнится, trace_call — выполняется через
+# debug_traceCall без изменения состояния ноды (нужна нода с callTracer, например anvil)
+SIMULATION_MODE = os.environ.get('SIMULATION_MODE', 'fork')
+# Дополнительно запрашивать изменения состояния (prestateTracer в diffMode) в режиме trace_call
+SIMULATION_STATE_DIFF = os.environ.get('SIMULATION_STATE_DIFF', 'False') == 'True'
+
+transfer_abi = {
+    "anonymous": False,
+    "inputs": [
+        {"indexed": True,  "name": "from",    "type": "address"},
+        {"indexed": True,  "name": "to",      "type": "address"},
+        {"indexed": False, "name": "value",   "type": "uint256"},
+    ],
+    "name": "Transfer",
+    "type": "event",
+}
+approval_abi = {
+    "anonymous": False,
+    "inputs": [
+        {"indexed": True,  "name": "owner",   "type": "address"},
+        {"indexed": True,  "name": "spender", "type": "address"},
+        {"indexed": False, "name": "value",   "type": "uint256"},
+    ],
+    "name": "Approval",
+    "type": "event",
+}
+event_abis = [transfer_abi, approval_abi]
+topic_map = {
+    event_abi_to_log_topic(abi).hex(): abi
+    for abi in event_abis
+}
+
+
+def parse_raw_transaction(signed_raw):
+    """
+    Разбирает подписанную транзакцию (legacy или typed) в словарь полей
+    """
+    raw_bytes = HexBytes(signed_raw)
+    if raw_bytes[0] <= 0x7f:
+        tx = TypedTransaction.from_bytes(raw_bytes).as_dict()
+        tx["chainId"] = tx.get("chainId")
+    else:
+        tx = LegacyTransaction.from_bytes(raw_bytes).as_dict()
+        tx["type"] = 0
+        # EIP-155: v = chainId * 2 + 35/36
+        tx["chainId"] = (tx["v"] - 35) // 2 if tx["v"] >= 35 else None
+    tx["to"] = Web3.to_checksum_address(tx["to"]) if tx.get("to") else None
+    return tx
+
+
+def transaction_hash(signed_raw) -> str:
+    """
+    Хеш транзакции — keccak подписанных байт, в нижнем регистре с префиксом 0x
+    """
+    return "0x" + Web3.keccak(HexBytes(signed_raw)).hex().removeprefix("0x").lower()
+
+
+def decode_transaction(signed_raw):
+    """
+    Разбирает подписанную транзакцию локально, без обращения к ноде.
+    Возвращает сводку в формате результата симуляции (без логов), хеш и отправителя.
+    """
+    raw_bytes = HexBytes(signed_raw)
+    tx_hash_hex = transaction_hash(raw_bytes)[2:]
+    from_address = Account.recover_transaction(raw_bytes)
+    tx = parse_raw_transaction(raw_bytes)
+    result = {
+        "tx_hash":      tx_hash_hex,
+        "from":         from_address,
+        "to":           tx["to"],
+        "value":        tx["value"],
+        "gas":          tx["gas"],
+        "gasPrice":     tx.get("gasPrice") or tx.get("maxFeePerGas"),
+        "input":        "0x" + HexBytes(tx["data"]).hex().removeprefix("0x"),
+        "type":         tx["type"],
+        "nonce":        tx["nonce"],
+        "chainId":      tx["chainId"],
+        "logs":         []
     }
-    event_abis = [transfer_abi, approval_abi]
-    topic_map = {
-        event_abi_to_log_topic(abi).hex(): abi
-        for abi in event_abis
+    return result, "0x" + tx_hash_hex, from_address
+
+
+def align_nonce(w3, signed_raw, from_address):
+    """
+    Форк отстаёт от сети на несколько блоков, поэтому nonce отправителя в нём может быть
+    меньше, чем у транзакции (например, предыдущая транзакция уже подтверждена)
+    """
+    result, _, _ = decode_transaction(signed_raw)
+    if w3.eth.get_transaction_count(from_address) < result["nonce"]:
+        w3.manager.request_blocking("hardhat_setNonce", [from_address, hex(result["nonce"])])
+
+
+def format_log(w3, log):
+    """
+    Приводит лог к формату результата симуляции и декодирует известные события
+    """
+    topics = []
+    for topic in log["topics"]:
+        if isinstance(topic, bytes):
+            topic = topic.hex()
+        topics.append(topic)
+
+    adding = {
+        "logIndex": log["logIndex"],
+        "address":   log["address"],
+        "topics":    topics,
+        "data":      HexBytes(log["data"]).hex(),
     }
-    # print("topic_map")
-    # print(topic_map)
+    t0 = log["topics"][0] if log["topics"] else ""
+    if isinstance(t0, bytes):
+        t0 = t0.hex()
+    abi = topic_map.get(t0.lower().removeprefix("0x"))
+    if abi:
+        ev = get_event_data(w3.codec, abi, log)
+        adding["decoded"] = {
+            "event": ev["event"],
+            "args":  dict(ev["args"]),
+        }
+    return adding
+
+
+def simulate_transaction(signed_raw):
+    """
+    Симулирует транзакцию за один прогон и возвращает сводку для пользователя,
+    хеш, отправителя и трейс для анализа
+    """
+    if SIMULATION_MODE == "trace_call":
+        return trace_call_transaction(signed_raw)
     from_address = Account.recover_transaction(signed_raw)
     print(from_address)
-    rpc_w3 = Web3(Web3.HTTPProvider(os.environ.get('RPC_URL')))
-    params = [{
-        "forking": {
-            "jsonRpcUrl": os.environ.get('RPC_URL'),
-            "blockNumber": rpc_w3.eth.get_block_number() - 10
-        }
-    }]
-    w3.manager.request_blocking("hardhat_reset", params)
-    snapshot_id = w3.provider.make_request("evm_snapshot", [])
     result = {}
+    trace = None
     tx_hash_hex = ''
-    try:
-        tx_hash = w3.eth.send_raw_transaction(HexBytes(signed_raw))
-        print("0x" + tx_hash.hex())
-        tx_hash_hex = tx_hash.hex()
-
-        tx: dict = w3.eth.get_transaction(tx_hash)
-        # print(tx)
-        result = {
-            "tx_hash":      tx_hash_hex,
-            "from":         tx["from"],
-            "to":           tx["to"],
-            "value":        tx["value"],
-            "gas":          tx["gas"],
-            "gasPrice":     tx.get("gasPrice") or tx.get("maxFeePerGas"),
-            "input":        "0x" + tx["input"].hex(),
-            "type":         tx["type"],
-            "nonce":        tx["nonce"],
-            "chainId":      tx["chainId"],
-            "logs":         []
-        }
-        receipt = w3.eth.wait_for_transaction_receipt(tx_hash)
-
-        for log in receipt.logs:
-            topics = []
-            for topic in log["topics"]:
-                if isinstance(topic, bytes):
-                    topic = topic.hex()
-                topics.append(topic)
-
-            adding = {
-                "logIndex": log["logIndex"],
-                "address":   log["address"],
-                "topics":    topics,
-                "data":      log["data"].hex(),
-            }
-            t0 = log["topics"][0]
-            if isinstance(t0, bytes):
-                t0 = t0.hex()
-            abi = topic_map.get(t0.lower())
-            print([key for key in topic_map.keys()])
-            print(t0)
-            if abi:
-                ev = get_event_data(w3.codec, abi, log)
-                adding["decoded"] = {
-                    "event": ev.event,
-                    "args":  dict(ev.args),
-                }
-            result["logs"].append(adding)
-    except Exception as e:
-        traceback.print_exc()
-    finally:
-        w3.provider.make_request("evm_revert", [snapshot_id])
-        params = [{
-            "forking": {
-                "jsonRpcUrl": os.environ.get('RPC_URL'),
-                "blockNumber": rpc_w3.eth.get_block_number() - 10
+    with simulator_pool.lease() as w3:
+        try:
+            align_nonce(w3, signed_raw, from_address)
+            tx_hash = w3.eth.send_raw_transaction(HexBytes(signed_raw))
+            print("0x" + tx_hash.hex())
+            tx_hash_hex = tx_hash.hex()
+
+            tx: dict = w3.eth.get_transaction(tx_hash)
+            # print(tx)
+            result = {
+                "tx_hash":      tx_hash_hex,
+                "from":         tx["from"],
+                "to":           tx["to"],
+                "value":        tx["value"],
+                "gas":          tx["gas"],
+                "gasPrice":     tx.get("gasPrice") or tx.get("maxFeePerGas"),
+                "input":        "0x" + tx["input"].hex(),
+                "type":         tx["type"],
+                "nonce":        tx["nonce"],
+                "chainId":      tx["chainId"],
+                "logs":         []
             }
-        }]
-        w3.manager.request_blocking("hardhat_reset", params)
+            receipt = w3.eth.wait_for_transaction_receipt(tx_hash, timeout=SIMULATION_TIMEOUT)
+
+            for log in receipt.logs:
+                result["logs"].append(format_log(w3, log))
+            # Трейс снимается в том же прогоне, чтобы анализ не исполнял транзакцию повторно
+            trace = trace_transaction(w3, tx_hash, {"from": result["from"], "to": result["to"]})
+            trace = json.loads(Web3.to_json(trace))
+        except Exception as e:
+            traceback.print_exc()
     # print("eth_call result:", result)
-    return result, "0x" + tx_hash_hex, from_address
\ No newline at end of file
+    return result, "0x" + tx_hash_hex, from_address, trace
+
+
+def transaction_call(signed_raw, from_address):
+    """
+    Собирает из подписанной транзакции объект вызова для eth_call / debug_traceCall
+    """
+    tx = parse_raw_transaction(signed_raw)
+    call = {
+        "from": from_address,
+        "gas": hex(tx["gas"]),
+        "value": hex(tx["value"]),
+        "data": "0x" + HexBytes(tx["data"]).hex().removeprefix("0x"),
+        "nonce": hex(tx["nonce"]),
+    }
+    if tx["to"]:
+        call["to"] = tx["to"]
+    if tx.get("maxFeePerGas") is not None:
+        call["maxFeePerGas"] = hex(tx["maxFeePerGas"])
+        call["maxPriorityFeePerGas"] = hex(tx["maxPriorityFeePerGas"])
+    elif tx.get("gasPrice") is not None:
+        call["gasPrice"] = hex(tx["gasPrice"])
+    return call
+
+
+def collect_logs(frame, logs=None):
+    """
+    Собирает логи из дерева вызовов callTracer в порядке выполнения.
+    Логи откатившихся фреймов в receipt не попадают, поэтому пропускаются.
+    """
+    logs = [] if logs is None else logs
+    if frame.get("error"):
+        return logs
+    calls = frame.get("calls") or []
+    frame_logs = frame.get("logs") or []
+    # position — индекс вложенного вызова, перед которым был сделан лог
+    position = 0
+    for log in frame_logs:
+        while position < len(calls) and position < log.get("position", len(calls)):
+            collect_logs(calls[position], logs)
+            position += 1
+        logs.append(log)
+    for call in calls[position:]:
+        collect_logs(call, logs)
+    return logs
+
+
+CALL_TRACER = {"tracer": "callTracer", "tracerConfig": {"withLog": True}}
+PRESTATE_TRACER = {"tracer": "prestateTracer", "tracerConfig": {"diffMode": True}}
+# Сбрасывается, если нода не знает muxTracer; тогда изменения состояния запрашиваются вторым вызовом
+mux_tracer_supported = True
+
+
+def trace_call(w3, call, block):
+    """
+    Возвращает дерево вызовов (callTracer) и, при SIMULATION_STATE_DIFF, изменения состояния.
+    Оба трейсера выполняются за один проход muxTracer-ом.
+    """
+    global mux_tracer_supported
+    if not SIMULATION_STATE_DIFF:
+        return w3.manager.request_blocking("debug_traceCall", [call, block, CALL_TRACER]), None
+    if mux_tracer_supported:
+        try:
+            trace = w3.manager.request_blocking("debug_traceCall", [call, block, {
+                "tracer": "muxTracer",
+                "tracerConfig": {
+                    "callTracer": CALL_TRACER["tracerConfig"],
+                    "prestateTracer": PRESTATE_TRACER["tracerConfig"],
+                }
+            }])
+            return trace["callTracer"], trace["prestateTracer"]
+        except Web3RPCError as e:
+            # Остальные ошибки ноды обрабатываются повтором симуляции в воркере
+            if "tracer" not in str(e).lower():
+                raise
+            mux_tracer_supported = False
+            logger.warning(f"muxTracer не поддерживается нодой, изменения состояния запрашиваются отдельно: {str(e)}")
+    trace = w3.manager.request_blocking("debug_traceCall", [call, block, CALL_TRACER])
+    return trace, w3.manager.request_blocking("debug_traceCall", [call, block, PRESTATE_TRACER])
+
+
+def trace_call_transaction(signed_raw):
+    """
+    Выполняет транзакцию один раз через debug_traceCall на зафиксированном блоке форка.
+    Состояние ноды не меняется, поэтому снапшот и откат не нужны.
+    """
+    result, tx_hash, from_address = decode_transaction(signed_raw)
+    call = transaction_call(signed_raw, from_address)
+    with simulator_pool.lease(stateless=True) as w3:
+        block = hex(w3.eth.get_block_number())
+        trace, state_diff = trace_call(w3, call, block)
+        trace = json.loads(Web3.to_json(trace))
+        result["block"] = int(block, 16)
+        if trace.get("error"):
+            result["error"] = trace.get("revertReason") or trace.get("error")
+        for index, log in enumerate(collect_logs(trace)):
+            result["logs"].append(format_log(w3, {
+                "logIndex": index,
+                "transactionIndex": 0,
+                "transactionHash": HexBytes(tx_hash),
+                "address": Web3.to_checksum_address(log["address"]),
+                "blockHash": None,
+                "blockNumber": result["block"],
+                "topics": [HexBytes(topic) for topic in log.get("topics", [])],
+                "data": HexBytes(log.get("data", "0x")),
+            }))
+        if state_diff is not None:
+            result["state_diff"] = json.loads(Web3.to_json(state_diff))
+    return result, tx_hash, from_address, {"result": trace}
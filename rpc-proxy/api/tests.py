@@ -1,3 +1,357 @@
-from django.test import TestCase
+import asyncio
+import json
+from datetime import timedelta
+from unittest import mock
+
+import httpx
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from . import api as api_module, cache, coalesce, rejected as rejected_module, upstream, worker
+from .api import ConfirmTransactionInput, ListPendingTransactionsInput, confirm_transaction, list_pending_transactions
+from .cache import CACHE_REORG_DEPTH, IMMUTABLE, LATEST, ResponseCache, request_scope
+from .coalesce import SingleFlight
+from .models import Notification, PendingTransaction, User, UserAdress
+from .pool import UpstreamPool
+from .rejected import BloomFilter, RejectedTransactions
+from .trace import related_contracts
+
 
 # Create your tests here.
+class PendingTransactionsListTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(telegram_id='1', chat_id='1')
+        other = User.objects.create(telegram_id='2', chat_id='2')
+        for user in (self.user, other):
+            for index in range(3):
+                address = UserAdress.objects.create(user=user, address=f'0x{user.id}{index}')
+                for nonce in range(5):
+                    PendingTransaction.objects.create(
+                        address=address,
+                        user=user,
+                        transaction_id=f'0x{user.id}{index}{nonce}',
+                        raw_transaction='0x',
+                        data={'nonce': nonce},
+                        pending=nonce != 0
+                    )
+
+    def test_single_query_per_page(self):
+        with self.assertNumQueries(1):
+            response = list_pending_transactions(None, ListPendingTransactionsInput(user_id='1', limit=100))
+        self.assertEqual(response['status'], 'success')
+        self.assertEqual(len(response['transactions']), 12)
+        self.assertIsNone(response['next_cursor'])
+
+    def test_cursor_pagination(self):
+        ids = []
+        cursor = None
+        while True:
+            with self.assertNumQueries(1):
+                response = list_pending_transactions(None, ListPendingTransactionsInput(user_id='1', cursor=cursor, limit=5))
+            ids.extend(transaction['id'] for transaction in response['transactions'])
+            cursor = response['next_cursor']
+            if cursor is None:
+                break
+        expected = PendingTransaction.objects.filter(user=self.user, pending=True).order_by('id').values_list('id', flat=True)
+        self.assertEqual(ids, list(expected))
+
+
+class ForwardBatchTest(SimpleTestCase):
+    def setUp(self):
+        self.sent = []
+        self.pool = UpstreamPool(['http://node-a', 'http://node-b'])
+        self.pool.client = httpx.AsyncClient(transport=httpx.MockTransport(self.handle))
+        self.pool.ensure_health_checks = lambda: None
+        patcher = mock.patch.object(upstream, 'upstream_pool', self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def handle(self, request):
+        payload = json.loads(request.content)
+        self.sent.append((str(request.url), payload))
+        if isinstance(payload, list):
+            # Нода отвечает в другом порядке и теряет один ответ
+            return httpx.Response(200, json=[
+                {"jsonrpc": "2.0", "id": req["id"], "result": req["params"][0]}
+                for req in reversed(payload) if req["params"][0] != "lost"
+            ])
+        if payload["method"] == "eth_newFilter":
+            return httpx.Response(200, json={"jsonrpc": "2.0", "id": payload["id"], "result": "0x1"})
+        return httpx.Response(200, json={"jsonrpc": "2.0", "id": payload["id"], "result": payload["params"]})
+
+    async def test_ids_are_remapped_and_restored(self):
+        reqs = [
+            {"jsonrpc": "2.0", "id": 7, "method": "eth_getBalance", "params": ["a"]},
+            {"jsonrpc": "2.0", "id": 7, "method": "eth_getBalance", "params": ["b"]},
+            {"jsonrpc": "2.0", "method": "eth_getBalance", "params": ["lost"]},
+        ]
+        responses = await upstream.forward_batch(reqs)
+        self.assertEqual([item["id"] for item in self.sent[0][1]], [0, 1, 2])
+        self.assertEqual(responses[0], {"jsonrpc": "2.0", "id": 7, "result": "a"})
+        self.assertEqual(responses[1], {"jsonrpc": "2.0", "id": 7, "result": "b"})
+        self.assertIsNone(responses[2]["id"])
+        self.assertEqual(responses[2]["error"]["code"], -32603)
+
+    async def test_filter_requests_are_pinned_to_creating_node(self):
+        self.pool.endpoints[0].ewma = 1.0
+        self.pool.endpoints[1].ewma = 0.1
+        created = await upstream.forward_requests([{"jsonrpc": "2.0", "id": 1, "method": "eth_newFilter", "params": [{}]}])
+        filter_id = created[0]["result"]
+        self.assertEqual(filter_id, "0x101")
+        # Нода, создавшая фильтр, стала медленнее, но запросы по фильтру всё равно идут в неё
+        self.pool.endpoints[1].ewma = 5.0
+        changes = await upstream.forward_requests([
+            {"jsonrpc": "2.0", "id": 2, "method": "eth_blockNumber", "params": ["x"]},
+            {"jsonrpc": "2.0", "id": 3, "method": "eth_getFilterChanges", "params": [filter_id]},
+        ])
+        self.assertEqual(changes[1], {"jsonrpc": "2.0", "id": 3, "result": ["0x1"]})
+        urls = {payload["method"]: url for url, payload in self.sent}
+        self.assertEqual(urls["eth_getFilterChanges"], "http://node-b")
+        self.assertEqual(urls["eth_blockNumber"], "http://node-a")
+
+    async def test_unknown_filter_node(self):
+        response = await upstream.forward_filter_request({"jsonrpc": "2.0", "id": 1, "method": "eth_uninstallFilter", "params": ["0x1ff"]})
+        self.assertEqual(response["error"]["message"], "filter not found")
+        self.assertEqual(self.sent, [])
+
+
+class ResponseCacheTest(SimpleTestCase):
+    def test_block_scopes(self):
+        def scope(params, head=None):
+            return request_scope({"method": "eth_getBalance", "params": ["0xab", *params]}, head)
+        self.assertEqual(scope([]), LATEST)
+        self.assertEqual(scope(["latest"]), LATEST)
+        self.assertIsNone(scope(["pending"]))
+        self.assertEqual(scope(["earliest"]), IMMUTABLE)
+        self.assertEqual(scope([{"blockHash": "0x01"}]), IMMUTABLE)
+        # Без известной головы и рядом с ней номер блока может быть реорганизован
+        self.assertEqual(scope(["0x64"]), LATEST)
+        self.assertEqual(scope(["0x64"], 100 + CACHE_REORG_DEPTH - 1), LATEST)
+        self.assertEqual(scope(["0x64"], 100 + CACHE_REORG_DEPTH), IMMUTABLE)
+        self.assertEqual(scope([{"blockNumber": "0x64"}], 100 + CACHE_REORG_DEPTH), IMMUTABLE)
+        self.assertIsNone(request_scope({"method": "eth_sendRawTransaction", "params": ["0x"]}))
+
+    def test_latest_entries_expire_with_head(self):
+        cache = ResponseCache()
+        cache.set("latest", "0x1", head=10)
+        cache.set("immutable", "0x2")
+        self.assertEqual(cache.get("latest", 10), (True, "0x1"))
+        self.assertEqual(cache.get("latest", 11), (False, None))
+        cache.drop_latest(11)
+        self.assertEqual(cache.get("immutable", 11), (True, "0x2"))
+        self.assertEqual(len(cache.entries), 1)
+
+    def test_lru_eviction_by_size(self):
+        cache = ResponseCache(max_bytes=30)
+        cache.set("a", "x" * 8)
+        cache.set("b", "x" * 8)
+        cache.get("a")
+        cache.set("c", "x" * 8)
+        self.assertEqual(list(cache.entries), ["a", "c"])
+        self.assertLessEqual(cache.size, 30)
+        self.assertEqual(cache.evictions, 1)
+        cache.set("huge", "x" * 100)
+        self.assertNotIn("huge", cache.entries)
+
+    async def test_recent_block_is_dropped_on_next_head(self):
+        forwarded = []
+
+        async def forward(reqs):
+            forwarded.extend(reqs)
+            return [{"jsonrpc": "2.0", "id": req["id"], "result": "0x5"} for req in reqs]
+
+        head = mock.AsyncMock(return_value=100)
+        req = {"jsonrpc": "2.0", "id": 1, "method": "eth_getBalance", "params": ["0xab", "0x63"]}
+        with mock.patch.object(cache, 'response_cache', ResponseCache()), \
+                mock.patch.object(cache, 'forward_coalesced', forward), \
+                mock.patch.object(cache.head_tracker, 'current', head):
+            await cache.forward_cached([req])
+            await cache.forward_cached([{**req, "id": 2}])
+            self.assertEqual(len(forwarded), 1)
+            head.return_value = 101
+            response = await cache.forward_cached([{**req, "id": 3}])
+        self.assertEqual(len(forwarded), 2)
+        self.assertEqual(response, [{"jsonrpc": "2.0", "id": 3, "result": "0x5"}])
+
+
+class SingleFlightTest(SimpleTestCase):
+    def request(self, request_id):
+        return {"jsonrpc": "2.0", "id": request_id, "method": "eth_blockNumber", "params": []}
+
+    async def test_identical_requests_share_one_call(self):
+        calls = []
+
+        async def forward(reqs):
+            calls.append(reqs)
+            await asyncio.sleep(0.01)
+            return [{"jsonrpc": "2.0", "id": req["id"], "result": "0x1"} for req in reqs]
+
+        single_flight = SingleFlight()
+        with mock.patch.object(coalesce, 'forward_requests', forward):
+            first, second = await asyncio.gather(
+                single_flight.forward([self.request(1)]),
+                single_flight.forward([self.request(2)]),
+            )
+        self.assertEqual(len([req for reqs in calls for req in reqs]), 1)
+        self.assertEqual(first[0]["id"], 1)
+        self.assertEqual(second[0], {"jsonrpc": "2.0", "id": 2, "result": "0x1"})
+        self.assertEqual(single_flight.inflight, {})
+
+    async def test_leader_cancellation_does_not_fail_followers(self):
+        async def forward(reqs):
+            await asyncio.sleep(0.05)
+            return [{"jsonrpc": "2.0", "id": req["id"], "result": "0x1"} for req in reqs]
+
+        single_flight = SingleFlight()
+        with mock.patch.object(coalesce, 'forward_requests', forward):
+            leader = asyncio.ensure_future(single_flight.forward([self.request(1)]))
+            await asyncio.sleep(0)
+            follower = asyncio.ensure_future(single_flight.forward([self.request(2)]))
+            await asyncio.sleep(0)
+            leader.cancel()
+            response = await follower
+        self.assertTrue(leader.cancelled())
+        self.assertEqual(response, [{"jsonrpc": "2.0", "id": 2, "result": "0x1"}])
+        self.assertEqual(single_flight.stats()["coalesced"], 1)
+        self.assertEqual(single_flight.inflight, {})
+
+    async def test_upstream_error_reaches_followers(self):
+        async def forward(reqs):
+            await asyncio.sleep(0.01)
+            raise ValueError("node is down")
+
+        single_flight = SingleFlight()
+        with mock.patch.object(coalesce, 'forward_requests', forward):
+            results = await asyncio.gather(
+                single_flight.forward([self.request(1)]),
+                single_flight.forward([self.request(2)]),
+                return_exceptions=True,
+            )
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertEqual(single_flight.inflight, {})
+
+
+class RelatedContractsTest(SimpleTestCase):
+    def test_struct_logs(self):
+        target = "0x" + "ab" * 20
+        trace = {"result": {"structLogs": [
+            {"op": "PUSH1", "stack": []},
+            {"op": "SLOAD", "stack": ["0x1", "0x" + "ee" * 20]},
+            {"op": "CALL", "stack": ["0x0", "0x0", "0x" + "00" * 12 + "cd" * 20, "0xffff"]},
+            {"op": "CALLCODE", "stack": ["0x0", "0x000000000000000000000000" + "AB" * 20, "0xffff"]},
+        ]}}
+        self.assertEqual(related_contracts(json.dumps(trace)), {"0x" + "cd" * 20, target})
+
+    def test_call_tracer(self):
+        trace = {"result": {
+            "type": "CALL", "to": "0x" + "11" * 20, "calls": [
+                {"type": "DELEGATECALL", "to": "0x" + "22" * 20, "calls": [
+                    {"type": "CALLCODE", "to": "0x" + "33" * 20},
+                ]},
+                {"type": "CREATE", "to": "0x" + "44" * 20},
+                {"type": "STATICCALL", "to": "0x" + "55" * 20},
+            ]
+        }}
+        self.assertEqual(related_contracts(trace), {"0x" + "11" * 20, "0x" + "22" * 20, "0x" + "33" * 20, "0x" + "55" * 20})
+
+
+class RejectedTransactionsTest(TestCase):
+    def setUp(self):
+        user = User.objects.create(telegram_id='1', chat_id='1')
+        self.address = UserAdress.objects.create(user=user, address='0x01')
+        self.user = user
+
+    def create(self, tx_hash, **kwargs):
+        return PendingTransaction.objects.create(
+            address=self.address, user=self.user, transaction_id=tx_hash, raw_transaction='0x', data={}, **kwargs
+        )
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        bloom = BloomFilter(bits=1024)
+        keys = [f"0x{index:064x}" for index in range(500)]
+        for key in keys:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in keys))
+
+    def test_misses_skip_database(self):
+        rejected = RejectedTransactions()
+        self.create('0xaa', pending=False)
+        rejected.sync()
+        with self.assertNumQueries(0):
+            self.assertFalse(rejected.is_rejected('0xbb'))
+            self.assertTrue(rejected.is_rejected('0xAA'))
+
+    def test_evicted_hashes_fall_back_to_database(self):
+        rejected = RejectedTransactions()
+        for tx_hash in ('0xa1', '0xa2', '0xa3'):
+            self.create(tx_hash, pending=False)
+        with mock.patch.object(rejected_module, 'REJECTED_HOT_SIZE', 1):
+            rejected.sync()
+        self.assertTrue(rejected.is_rejected('0xa1'))
+        self.assertEqual(rejected.db_checks, 1)
+
+    def test_confirmed_after_reject(self):
+        rejected = RejectedTransactions()
+        transaction = self.create('0xa1', pending=False)
+        rejected.sync()
+        transaction.confirmed = True
+        transaction.save()
+        rejected.discard('0xa1')
+        self.assertFalse(rejected.is_rejected('0xa1'))
+        self.assertEqual(rejected.db_checks, 1)
+
+
+class SimulationWorkerTest(TestCase):
+    def setUp(self):
+        user = User.objects.create(telegram_id='1', chat_id='1')
+        address = UserAdress.objects.create(user=user, address='0x01')
+        self.transaction = PendingTransaction.objects.create(
+            address=address, user=user, transaction_id='0x01', raw_transaction='0x', data={}
+        )
+
+    def test_claim_skips_decided_and_delayed(self):
+        PendingTransaction.objects.filter(id=self.transaction.id).update(pending=False)
+        self.assertIsNone(worker.claim_transaction())
+        PendingTransaction.objects.filter(id=self.transaction.id).update(
+            pending=True, simulate_after=timezone.now() + timedelta(minutes=1)
+        )
+        self.assertIsNone(worker.claim_transaction())
+        PendingTransaction.objects.filter(id=self.transaction.id).update(simulate_after=None)
+        claimed = worker.claim_transaction()
+        self.assertEqual(claimed.id, self.transaction.id)
+        self.assertEqual(claimed.simulation_status, PendingTransaction.SIMULATION_RUNNING)
+        self.assertEqual(claimed.simulation_attempts, 1)
+        self.assertIsNone(worker.claim_transaction())
+
+    def test_retry_then_fail(self):
+        with mock.patch.object(worker, 'simulate_transaction', side_effect=RuntimeError("node is down")), \
+                self.assertLogs(worker.logger, 'WARNING'):
+            for attempt in range(1, worker.SIMULATION_MAX_ATTEMPTS + 1):
+                PendingTransaction.objects.filter(id=self.transaction.id).update(simulate_after=None)
+                worker.process_transaction(worker.claim_transaction())
+                self.transaction.refresh_from_db()
+                self.assertEqual(self.transaction.simulation_attempts, attempt)
+                if attempt < worker.SIMULATION_MAX_ATTEMPTS:
+                    self.assertEqual(self.transaction.simulation_status, PendingTransaction.SIMULATION_QUEUED)
+                    self.assertIsNotNone(self.transaction.simulate_after)
+                    self.assertFalse(Notification.objects.exists())
+        self.assertEqual(self.transaction.simulation_status, PendingTransaction.SIMULATION_FAILED)
+        self.assertIn("node is down", self.transaction.simulation_error)
+        self.assertEqual(Notification.objects.get().payload["simulation_status"], PendingTransaction.SIMULATION_FAILED)
+
+    def test_confirm_during_simulation_is_kept(self):
+        claimed = worker.claim_transaction()
+
+        def simulate(raw_transaction):
+            confirm_transaction(None, ConfirmTransactionInput(tx_id=str(claimed.id)))
+            return {"logs": []}, claimed.transaction_id, '0x01', {"result": {}}
+
+        with mock.patch.object(worker, 'simulate_transaction', side_effect=simulate), \
+                mock.patch.object(api_module.upstream_pool, 'post_sync'):
+            worker.process_transaction(claimed)
+        self.transaction.refresh_from_db()
+        self.assertFalse(self.transaction.pending)
+        self.assertTrue(self.transaction.confirmed)
+        self.assertEqual(self.transaction.simulation_status, PendingTransaction.SIMULATION_DONE)
+        self.assertEqual(self.transaction.data, {"logs": []})
+        self.assertFalse(Notification.objects.exists())
@@ -0,0 +1,173 @@
+import io
+import json
+import os
+from collections import deque
+import ijson
+import requests
+from web3 import Web3
+
+
+# call — компактное дерево вызовов (callTracer или свёртка structLogs в дерево),
+# opcodes — structLogs, отфильтрованные по TRACE_OPCODES, full — полный structLogs
+TRACE_MODE = os.environ.get('TRACE_MODE', 'call')
+TRACE_OPCODES = set(os.environ.get('TRACE_OPCODES', 'CALL,DELEGATECALL,STATICCALL,CALLCODE,CREATE,CREATE2').split(','))
+# Память и storage на каждом шаге не нужны ни для одного режима
+STRUCT_LOGGER_CONFIG = {"disableStorage": True, "disableMemory": True}
+
+CALL_OPCODES = ("CALL", "DELEGATECALL", "STATICCALL", "CALLCODE")
+# Для CALL-опкодов адрес лежит во втором элементе с вершины стека, всего аргументов не больше 7
+CALL_STACK_DEPTH = 7
+
+
+def walk_frames(frame):
+    """
+    Обходит дерево вызовов callTracer в глубину
+    """
+    yield frame
+    for call in frame.get("calls") or []:
+        yield from walk_frames(call)
+
+
+STRUCT_LOG_PREFIX = "result.structLogs.item"
+
+
+def trace_stream(trace):
+    """
+    Трейс как поток байт: из сохранённой строки, байт, словаря, открытого ответа
+    или функции, открывающей новый поток (для трейсов, которые читаются несколько раз)
+    """
+    if callable(trace):
+        return trace()
+    if isinstance(trace, dict):
+        trace = json.dumps(trace)
+    if isinstance(trace, str):
+        trace = trace.encode()
+    if isinstance(trace, (bytes, bytearray, memoryview)):
+        return io.BytesIO(trace)
+    return trace
+
+
+def related_contracts(trace) -> set:
+    """
+    Собирает адреса контрактов, с которыми взаимодействовала транзакция.
+    Трейс читается потоково, в памяти держатся только открытые фреймы вызовов,
+    поэтому большие structLogs не загружаются целиком.
+    Поддерживает как structLogs стандартного трейсера, так и дерево вызовов callTracer.
+    """
+    related = set()
+    # prefix -> тип и адрес открытого фрейма callTracer
+    frames = {}
+    op = None
+    # для CALL-опкодов адрес лежит в stack[-2], остальной стек не нужен
+    stack_tail = deque(maxlen=2)
+    for prefix, event, value in ijson.parse(trace_stream(trace)):
+        if prefix == STRUCT_LOG_PREFIX:
+            if event == "start_map":
+                op = None
+                stack_tail.clear()
+            elif event == "end_map" and op in CALL_OPCODES and len(stack_tail) == 2:
+                related.add("0x" + stack_tail[0][-40:].lower())
+        elif prefix == STRUCT_LOG_PREFIX + ".op":
+            op = value
+        elif prefix == STRUCT_LOG_PREFIX + ".stack.item":
+            stack_tail.append(value)
+        elif prefix == "result" or prefix.endswith(".calls.item"):
+            if event == "start_map":
+                frames[prefix] = {}
+            elif event == "end_map":
+                frame = frames.pop(prefix, {})
+                if frame.get("type") in CALL_OPCODES and frame.get("to"):
+                    related.add(frame["to"].lower())
+        elif event == "string":
+            parent, _, key = prefix.rpartition(".")
+            if parent in frames and key in ("type", "to"):
+                frames[parent][key] = value
+    return related
+
+
+def is_struct_log_trace(trace) -> bool:
+    for prefix, event, value in ijson.parse(trace_stream(trace)):
+        if prefix == "result" and event == "map_key" and value == "structLogs":
+            return True
+    return False
+
+
+def trace_for_prompt(trace):
+    """
+    Часть трейса, которая передаётся в LLM вместе со схемами контрактов.
+    Старые трейсы с полными structLogs потоково сворачиваются в дерево вызовов.
+    """
+    if isinstance(trace, dict):
+        return trace["result"]
+    if is_struct_log_trace(trace):
+        struct_logs = ijson.items(trace_stream(trace), STRUCT_LOG_PREFIX)
+        return frames_from_struct_logs(struct_logs, {"type": "CALL"})
+    return json.load(trace_stream(trace))["result"]
+
+
+def compact_struct_log(struct: dict) -> dict:
+    return {
+        "pc": struct.get("pc"),
+        "op": struct["op"],
+        "depth": struct.get("depth"),
+        "stack": (struct.get("stack") or [])[-CALL_STACK_DEPTH:],
+    }
+
+
+def frames_from_struct_logs(struct_logs, root: dict) -> dict:
+    """
+    Сворачивает structLogs в дерево вызовов в формате callTracer.
+    Вложенный вызов на глубине depth добавляется к последнему фрейму глубины depth - 1.
+    """
+    stack = [root]
+    for struct in struct_logs:
+        op = struct["op"]
+        if op not in TRACE_OPCODES:
+            continue
+        depth = struct.get("depth", 1)
+        frame = {"type": op}
+        if op in CALL_OPCODES:
+            frame["to"] = "0x" + struct["stack"][-2][-40:].lower()
+        del stack[depth:]
+        stack[-1].setdefault("calls", []).append(frame)
+        stack.append(frame)
+    return root
+
+
+def raise_rpc_error(events):
+    for prefix, event, value in events:
+        if prefix == "error.message":
+            raise ValueError(f"debug_traceTransaction failed: {value}")
+        yield prefix, event, value
+
+
+def iter_struct_logs(w3, tx_hash, config: dict):
+    """
+    Потоково читает structLogs из ответа debug_traceTransaction, не загружая ответ целиком
+    """
+    payload = {"jsonrpc": "2.0", "id": 1, "method": "debug_traceTransaction", "params": [Web3.to_hex(tx_hash), config]}
+    with requests.post(w3.provider.endpoint_uri, json=payload, stream=True, **w3.provider.get_request_kwargs()) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        yield from ijson.items(raise_rpc_error(ijson.parse(response.raw)), STRUCT_LOG_PREFIX)
+
+
+def trace_transaction(w3, tx_hash, root: dict) -> dict:
+    """
+    Снимает трейс транзакции в режиме TRACE_MODE. root — верхний фрейм (from/to транзакции),
+    используется, если нода не поддерживает callTracer.
+    """
+    if TRACE_MODE == "call":
+        try:
+            trace = w3.manager.request_blocking("debug_traceTransaction", [tx_hash, {"tracer": "callTracer"}])
+            if "structLogs" not in trace:
+                return {"result": trace}
+        except Exception:
+            # Нода не поддерживает callTracer (hardhat): сворачиваем structLogs сами
+            pass
+        struct_logs = iter_struct_logs(w3, tx_hash, STRUCT_LOGGER_CONFIG)
+        return {"result": frames_from_struct_logs(struct_logs, {"type": "CALL", **root})}
+    if TRACE_MODE == "opcodes":
+        struct_logs = iter_struct_logs(w3, tx_hash, STRUCT_LOGGER_CONFIG)
+        return {"result": {"structLogs": [compact_struct_log(struct) for struct in struct_logs if struct["op"] in TRACE_OPCODES]}}
+    return {"result": w3.manager.request_blocking("debug_traceTransaction", [tx_hash, STRUCT_LOGGER_CONFIG])}
@@ -0,0 +1,191 @@
+import asyncio
+import json
+import os
+from .pool import upstream_pool
+
+
+# Сколько batch-запросов можно одновременно отправлять в ноду
+UPSTREAM_CONCURRENCY = int(os.environ.get('UPSTREAM_CONCURRENCY', '10'))
+# Максимальный размер batch, который отправляется в ноду одним запросом
+UPSTREAM_BATCH_SIZE = int(os.environ.get('UPSTREAM_BATCH_SIZE', '100'))
+# Методы с побочными эффектами: их нельзя объединять и хеджировать
+SIDE_EFFECT_PREFIXES = (
+    "eth_send",
+    "eth_sign",
+    "eth_newFilter",
+    "eth_newBlockFilter",
+    "eth_newPendingTransactionFilter",
+    "eth_uninstallFilter",
+    "eth_getFilter",
+    "eth_subscribe",
+    "eth_unsubscribe",
+    "personal_",
+)
+
+
+# Фильтры существуют только на ноде, которая их создала
+FILTER_CREATE_METHODS = {"eth_newFilter", "eth_newBlockFilter", "eth_newPendingTransactionFilter"}
+FILTER_ID_METHODS = {"eth_getFilterChanges", "eth_getFilterLogs", "eth_uninstallFilter"}
+
+
+def has_side_effects(req: dict) -> bool:
+    return (req.get("method") or "").startswith(SIDE_EFFECT_PREFIXES)
+
+
+def normalize_params(params) -> str:
+    """
+    Приводит параметры к каноническому виду: hex-строки в JSON-RPC регистронезависимы
+    """
+    def normalize(value):
+        if isinstance(value, str):
+            return value.lower()
+        if isinstance(value, list):
+            return [normalize(item) for item in value]
+        if isinstance(value, dict):
+            return {key: normalize(item) for key, item in value.items()}
+        return value
+    return json.dumps(normalize(params or []), sort_keys=True, separators=(",", ":"))
+
+
+def request_key(req: dict) -> str:
+    return f"{req.get('method')}:{normalize_params(req.get('params'))}"
+
+
+def rpc_error(req: dict, code: int, message: str) -> dict:
+    return {
+        "id": req.get("id"),
+        "jsonrpc": req.get("jsonrpc", "2.0"),
+        "error": {
+            "code": code,
+            "message": message
+        }
+    }
+
+
+async def forward_request(req: dict) -> dict:
+    """
+    Проксирует один JSON-RPC запрос к Ethereum ноде
+    """
+    try:
+        ethereum_response = await upstream_pool.post(req, hedge=not has_side_effects(req))
+        if ethereum_response.status_code == 200:
+            return ethereum_response.json()
+        return rpc_error(req, ethereum_response.status_code, f"Ethereum node returned error: {ethereum_response.text}")
+    except Exception as e:
+        return rpc_error(req, -32603, f"Internal error: {str(e)}")
+
+
+async def forward_batch(reqs: list) -> list:
+    """
+    Отправляет список запросов в ноду одним JSON-RPC batch и сопоставляет ответы по id.
+    На время отправки id заменяются на порядковые номера, чтобы одинаковые или
+    отсутствующие id клиента не мешали сопоставлению.
+    """
+    if len(reqs) == 1:
+        return [await forward_request(reqs[0])]
+    batch = [{**req, "id": index} for index, req in enumerate(reqs)]
+    try:
+        hedge = not any(has_side_effects(req) for req in reqs)
+        ethereum_response = await upstream_pool.post(batch, hedge=hedge)
+        if ethereum_response.status_code != 200:
+            error_msg = f"Ethereum node returned error: {ethereum_response.text}"
+            return [rpc_error(req, ethereum_response.status_code, error_msg) for req in reqs]
+        body = ethereum_response.json()
+    except Exception as e:
+        return [rpc_error(req, -32603, f"Internal error: {str(e)}") for req in reqs]
+    if not isinstance(body, list):
+        # Нода ответила одной ошибкой на весь batch
+        error = body.get("error", {}) if isinstance(body, dict) else {}
+        return [rpc_error(req, error.get("code", -32603), error.get("message", "Invalid batch response")) for req in reqs]
+
+    by_id = {item.get("id"): item for item in body if isinstance(item, dict)}
+    responses = []
+    for index, req in enumerate(reqs):
+        item = by_id.get(index)
+        if item is None:
+            responses.append(rpc_error(req, -32603, "Ethereum node returned no response for request"))
+        else:
+            responses.append({**item, "id": req.get("id")})
+    return responses
+
+
+def is_filter_request(req: dict) -> bool:
+    method = req.get("method")
+    return method in FILTER_CREATE_METHODS or method in FILTER_ID_METHODS
+
+
+def encode_filter_id(filter_id: str, index: int) -> str:
+    """
+    Дописывает к id фильтра номер ноды (два hex-символа), чтобы последующие запросы
+    по фильтру попадали в ту же ноду из любого процесса прокси
+    """
+    return f"{filter_id}{index:02x}"
+
+
+def decode_filter_id(filter_id) -> tuple:
+    if not isinstance(filter_id, str) or len(filter_id) < 5:
+        return None, None
+    try:
+        return filter_id[:-2], int(filter_id[-2:], 16)
+    except ValueError:
+        return None, None
+
+
+async def forward_filter_request(req: dict) -> dict:
+    """
+    Запросы фильтров идут в одну ноду без переключения и хеджирования:
+    создание — в лучшую ноду, остальные — в ноду, создавшую фильтр
+    """
+    if len(upstream_pool.endpoints) <= 1:
+        return await forward_request(req)
+    params = list(req.get("params") or [])
+    if req.get("method") in FILTER_CREATE_METHODS:
+        index = upstream_pool.endpoints.index(upstream_pool.ranked()[0])
+    else:
+        filter_id, index = decode_filter_id(params[0] if params else None)
+        if filter_id is None or index >= len(upstream_pool.endpoints):
+            return rpc_error(req, -32000, "filter not found")
+        params[0] = filter_id
+    try:
+        ethereum_response = await upstream_pool.send_to(index, {**req, "params": params})
+        if ethereum_response.status_code != 200:
+            return rpc_error(req, ethereum_response.status_code, f"Ethereum node returned error: {ethereum_response.text}")
+        body = ethereum_response.json()
+    except Exception as e:
+        return rpc_error(req, -32603, f"Internal error: {str(e)}")
+    if req.get("method") in FILTER_CREATE_METHODS and isinstance(body.get("result"), str):
+        body["result"] = encode_filter_id(body["result"], index)
+    return body
+
+
+async def forward_requests(reqs: list) -> list:
+    """
+    Проксирует список запросов batch-ами по UPSTREAM_BATCH_SIZE штук,
+    отправляя не более UPSTREAM_CONCURRENCY batch-ей одновременно.
+    Запросы фильтров отправляются отдельно, каждый в свою ноду.
+    Ответы возвращаются в том же порядке, что и запросы.
+    """
+    semaphore = asyncio.Semaphore(UPSTREAM_CONCURRENCY)
+
+    async def limited(chunk):
+        async with semaphore:
+            return await forward_batch(chunk)
+
+    async def limited_filter(req):
+        async with semaphore:
+            return [await forward_filter_request(req)]
+
+    filters = [index for index, req in enumerate(reqs) if is_filter_request(req)]
+    if not filters:
+        chunks = [reqs[i:i + UPSTREAM_BATCH_SIZE] for i in range(0, len(reqs), UPSTREAM_BATCH_SIZE)]
+        results = await asyncio.gather(*(limited(chunk) for chunk in chunks))
+        return [response for chunk in results for response in chunk]
+    filter_set = set(filters)
+    rest = [index for index in range(len(reqs)) if index not in filter_set]
+    responses = [None] * len(reqs)
+    forwarded = await asyncio.gather(forward_requests([reqs[index] for index in rest]), *(limited_filter(reqs[index]) for index in filters))
+    for index, response in zip(rest, forwarded[0]):
+        responses[index] = response
+    for index, response in zip(filters, forwarded[1:]):
+        responses[index] = response[0]
+    return responses
@@ -0,0 +1,168 @@
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+from datetime import timedelta
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from .models import Artifact, PendingTransaction, Notification
+from .artifacts import ARTIFACT_GC_INTERVAL
+from .simulate import simulate_transaction
+from .fork import simulator_pool
+from .notifications import enqueue_transaction_notification
+
+
+logger = logging.getLogger(__name__)
+
+# Сколько транзакций симулируется одновременно (по умолчанию — по числу нод)
+SIMULATION_WORKERS = int(os.environ.get('SIMULATION_WORKERS', str(len(simulator_pool.nodes))))
+# Как часто писать в лог метрики пула нод
+SIMULATION_STATS_INTERVAL = float(os.environ.get('SIMULATION_STATS_INTERVAL', '60'))
+# Сколько раз пытаться просимулировать транзакцию перед тем, как сдаться
+SIMULATION_MAX_ATTEMPTS = int(os.environ.get('SIMULATION_MAX_ATTEMPTS', '3'))
+# Базовая задержка перед повтором (удваивается с каждой попыткой)
+SIMULATION_RETRY_DELAY = float(os.environ.get('SIMULATION_RETRY_DELAY', '5'))
+# Через сколько секунд задача в статусе running считается брошенной (упавший воркер)
+SIMULATION_LEASE = float(os.environ.get('SIMULATION_LEASE', '600'))
+# Как часто опрашивать очередь, когда она пуста
+SIMULATION_POLL_INTERVAL = float(os.environ.get('SIMULATION_POLL_INTERVAL', '0.5'))
+
+# Поля, которые воркер пишет после симуляции; pending и confirmed меняет только пользователь
+SIMULATION_RETRY_FIELDS = ['simulation_status', 'simulate_after', 'simulation_error', 'simulation_timings', 'updated_at']
+SIMULATION_RESULT_FIELDS = ['data', 'simulation_status', 'simulation_error', 'simulation_timings', 'updated_at']
+
+
+def claim_transaction():
+    """
+    Забирает из очереди одну транзакцию, готовую к симуляции.
+    skip_locked позволяет нескольким воркерам не мешать друг другу.
+    Уже подтверждённые или отклонённые транзакции не симулируются.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        pending_transaction = (
+            PendingTransaction.objects
+            .select_for_update(skip_locked=True, of=('self',))
+            .select_related('address__user')
+            .filter(pending=True)
+            .filter(
+                Q(simulation_status=PendingTransaction.SIMULATION_QUEUED, simulate_after__isnull=True)
+                | Q(simulation_status=PendingTransaction.SIMULATION_QUEUED, simulate_after__lte=now)
+                | Q(simulation_status=PendingTransaction.SIMULATION_RUNNING, simulation_started_at__lte=now - timedelta(seconds=SIMULATION_LEASE))
+            )
+            .order_by('id')
+            .first()
+        )
+        if not pending_transaction:
+            return None
+        pending_transaction.simulation_status = PendingTransaction.SIMULATION_RUNNING
+        pending_transaction.simulation_started_at = now
+        pending_transaction.simulation_attempts += 1
+        pending_transaction.save(update_fields=['simulation_status', 'simulation_started_at', 'simulation_attempts', 'updated_at'])
+        return pending_transaction
+
+
+def process_transaction(pending_transaction):
+    """
+    Симулирует транзакцию, сохраняет результат и ставит уведомление пользователю в outbox.
+    Время каждого этапа сохраняется в simulation_timings.
+    """
+    timings = dict(pending_transaction.simulation_timings or {})
+    if 'queued' not in timings:
+        timings['queued'] = (pending_transaction.simulation_started_at - pending_transaction.created_at).total_seconds()
+    started = time.monotonic()
+    try:
+        result, _, _, trace = simulate_transaction(pending_transaction.raw_transaction)
+        if not result:
+            raise RuntimeError("Simulation returned no result")
+    except Exception as e:
+        timings[f'simulate_attempt_{pending_transaction.simulation_attempts}'] = time.monotonic() - started
+        pending_transaction.simulation_timings = timings
+        pending_transaction.simulation_error = traceback.format_exc()
+        if pending_transaction.simulation_attempts < SIMULATION_MAX_ATTEMPTS:
+            delay = SIMULATION_RETRY_DELAY * 2 ** (pending_transaction.simulation_attempts - 1)
+            pending_transaction.simulation_status = PendingTransaction.SIMULATION_QUEUED
+            pending_transaction.simulate_after = timezone.now() + timedelta(seconds=delay)
+            pending_transaction.save(update_fields=SIMULATION_RETRY_FIELDS)
+            logger.warning(f"Симуляция транзакции {pending_transaction.transaction_id} не удалась, повтор через {delay} с: {str(e)}")
+            return
+        # Попытки закончились: пользователь всё равно должен решить судьбу транзакции
+        pending_transaction.simulation_status = PendingTransaction.SIMULATION_FAILED
+        logger.error(f"Симуляция транзакции {pending_transaction.transaction_id} не удалась: {str(e)}")
+    else:
+        timings['simulate'] = time.monotonic() - started
+        pending_transaction.data = result
+        # Трейс сохраняется вместе с результатом, analyze_transaction его не пересчитывает
+        pending_transaction.trace = json.dumps(trace) if trace else ''
+        pending_transaction.simulation_status = PendingTransaction.SIMULATION_DONE
+        pending_transaction.simulation_error = ''
+
+    started = time.monotonic()
+    pending_transaction.simulation_timings = timings
+    # Уведомление попадает в outbox в той же транзакции, доставляет его notification_dispatcher.
+    # Повторная симуляция (из /resimulate_latest_transaction) не отправляет его второй раз.
+    # Симуляция идёт минутами, за это время пользователь мог подтвердить или отклонить транзакцию:
+    # сохраняются только поля симуляции, а строка блокируется, чтобы увидеть актуальный pending
+    with transaction.atomic():
+        still_pending = (
+            PendingTransaction.objects
+            .select_for_update()
+            .filter(id=pending_transaction.id)
+            .values_list('pending', flat=True)
+            .first()
+        )
+        pending_transaction.save(update_fields=SIMULATION_RESULT_FIELDS)
+        if still_pending and not Notification.objects.filter(pending_transaction=pending_transaction).exists():
+            enqueue_transaction_notification(pending_transaction)
+    timings['save'] = time.monotonic() - started
+    PendingTransaction.objects.filter(id=pending_transaction.id).update(simulation_timings=timings)
+
+
+def worker_loop(stop_event: threading.Event):
+    while not stop_event.is_set():
+        close_old_connections()
+        try:
+            pending_transaction = claim_transaction()
+        except Exception as e:
+            logger.error(f"Ошибка при получении транзакции из очереди: {str(e)}")
+            pending_transaction = None
+        if not pending_transaction:
+            stop_event.wait(SIMULATION_POLL_INTERVAL)
+            continue
+        try:
+            process_transaction(pending_transaction)
+        except Exception:
+            logger.error(traceback.format_exc())
+
+
+def run_workers(concurrency: int = SIMULATION_WORKERS, stop_event: threading.Event = None):
+    """
+    Запускает concurrency потоков, которые разбирают очередь симуляций
+    """
+    stop_event = stop_event or threading.Event()
+    simulator_pool.start()
+    threads = [
+        threading.Thread(target=worker_loop, args=(stop_event,), name=f"simulation-worker-{index}", daemon=True)
+        for index in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    next_gc = time.monotonic() + ARTIFACT_GC_INTERVAL
+    try:
+        while any(thread.is_alive() for thread in threads):
+            stop_event.wait(SIMULATION_STATS_INTERVAL)
+            logger.info(f"Пул нод симуляции: {json.dumps(simulator_pool.stats())}")
+            if time.monotonic() >= next_gc:
+                next_gc = time.monotonic() + ARTIFACT_GC_INTERVAL
+                # Перезаписанные трейсы и результаты анализа больше ни на что не ссылаются
+                try:
+                    logger.info(f"Удалено неиспользуемых артефактов: {Artifact.collect_garbage()}")
+                except Exception as e:
+                    logger.error(f"Ошибка при удалении артефактов: {str(e)}")
+                finally:
+                    close_old_connections()
+    except KeyboardInterrupt:
+        stop_event.set()